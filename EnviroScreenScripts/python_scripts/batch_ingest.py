@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+# Batch ingest of the gridded products of an EnviroScreen refresh (OMI,
+# TROPOMI, CAMx SIP, EQUATES) into zonal statistics over the tract and
+# county polygons, replacing the by-hand NetCDF -> GeoTIFF -> zonal steps of
+# the zonal_AQE_*.ipynb notebooks.
+#
+# A YAML manifest lists the (product, variable, period) jobs and their input
+# files (see ingest_manifest.yaml).  Each job reads its files with the reader
+# of its product (see the ingest package), aggregates every time step with
+# the cached coverage weights of each polygon layer, and writes one long
+# table like zonal_timeseries.py, named PRODUCT_VARIABLE_PERIOD in the output
+# directory.  The jobs run in a process pool.  The input files, settings
+# and shapefiles of each output are recorded next to it, and a job whose
+# output was made from the same ones is skipped.
+#
+# Example:
+#
+#   python batch_ingest.py ingest_manifest.yaml --num-workers 16
+
+import os
+import sys
+import glob
+import json
+import argparse
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import zonal_stats
+from zonal_stats import DEFAULT_STATS, STAT_OPS, _replace_atomic, default_layers, check_layers, read_layers
+from coverage_weights import load_weights, shapefile_hash
+from zonal_timeseries import TableWriter, chunk_table, DEFAULT_CHUNK_STEPS
+from ingest import get_reader
+
+
+# Bump this when the output tables change
+MANIFEST_VERSION = 1
+
+# Job settings that change the output
+JOB_SETTINGS = ['product', 'variable', 'period', 'lays', 'stats', 'chunk_steps']
+
+
+def read_manifest(manifest_file):
+    """Return the jobs of a manifest with their defaults, input files and output file filled in.
+
+    Raises FileNotFoundError when the shapefile of a layer is missing.
+    """
+    with open(manifest_file) as f:
+        manifest = yaml.safe_load(f)
+    base_dir = os.path.dirname(os.path.abspath(manifest_file))
+
+    def path(p):
+        return os.path.join(base_dir, os.path.expandvars(os.path.expanduser(p)))
+
+    output_dir = path(manifest.get('output_dir', '.'))
+    defaults = {
+        'stats': manifest.get('stats', DEFAULT_STATS),
+        'lays': manifest.get('lays'),
+        'chunk_steps': manifest.get('chunk_steps', DEFAULT_CHUNK_STEPS),
+        'format': manifest.get('format', 'parquet'),
+    }
+
+    jobs = []
+    for entry in manifest['jobs']:
+        job = {**defaults, **entry}
+        job['product'] = job['product'].lower()
+        job['stats'] = [s.upper() for s in job['stats']]
+        unknown = [s for s in job['stats'] if s not in STAT_OPS]
+        if unknown:
+            raise ValueError('Unknown statistics '+', '.join(unknown))
+        get_reader(job['product'])
+
+        # Input files, given as paths or glob patterns
+        patterns = job['files'] if isinstance(job['files'], list) else [job['files']]
+        files = []
+        for pattern in patterns:
+            matches = sorted(glob.glob(path(pattern)))
+            if not matches:
+                raise FileNotFoundError(f"No files match {pattern}")
+            files.extend(matches)
+        job['files'] = files
+
+        name = '_'.join(str(job[k]) for k in ('product', 'variable', 'period'))
+        job['output'] = os.path.join(output_dir, f"{name}.{job['format']}")
+        jobs.append(job)
+
+    layer_files = {name: path(p) for name, p in manifest['layers'].items()} if 'layers' in manifest else default_layers()
+    check_layers(layer_files)
+    weights_cache = path(manifest.get('weights_cache', os.path.join(output_dir, 'coverage_weights')))
+    return jobs, layer_files, weights_cache, manifest.get('num_workers')
+
+
+def manifest_path(output_file):
+    """Return the file recording what an output was made from."""
+    return output_file + '.manifest.json'
+
+
+def job_state(job, layer_hashes):
+    """Return what the output of a job depends on: its inputs, settings and shapefiles."""
+    inputs = []
+    for f in job['files']:
+        stat = os.stat(f)
+        inputs.append({'path': os.path.abspath(f), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns})
+    return {
+        'version': MANIFEST_VERSION,
+        'settings': {k: job.get(k) for k in JOB_SETTINGS},
+        'inputs': inputs,
+        'layers': layer_hashes,
+    }
+
+
+def job_current(job, state):
+    """Return whether the output of a job exists and was made from state."""
+    try:
+        with open(manifest_path(job['output'])) as f:
+            recorded = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return os.path.exists(job['output']) and recorded == state
+
+
+def write_state(job, state):
+    """Record what the output of a job was made from."""
+    def write(tmp_file):
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f, indent=1)
+    _replace_atomic(write, manifest_path(job['output']))
+
+
+def run_job(job, weights_cache):
+    """Aggregate the files of a job into its output table and return the rows written and the time it took."""
+    start = perf_counter()
+    reader_class = get_reader(job['product'])
+
+    writer = TableWriter(job['output'])
+    try:
+        for nc_file in job['files']:
+            with reader_class(nc_file, job['variable'], job.get('lays'), cache_dir=weights_cache) as reader:
+                grid, _ = reader.grid()
+                times = reader.times()
+                lays = reader.layer_values()
+                weights = {name: load_weights(zonal_stats._LAYER_FILES[name], grid, weights_cache, layer)
+                           for name, layer in zonal_stats._LAYERS.items()}
+                for t0, values in reader.chunks(job['chunk_steps']):
+                    chunk_times = times[t0:t0 + values.shape[0]]
+                    for name, w in weights.items():
+                        writer.write(chunk_table(w, values, name, job['variable'], chunk_times, lays, job['stats']))
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    return writer.rows, perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Aggregate the gridded products listed in a manifest '
+                                                 'to the tract and county polygons')
+    parser.add_argument('manifest', help='YAML manifest of the jobs')
+    parser.add_argument('--num-workers', type=int, help='Jobs run at once, all cores by default')
+    parser.add_argument('--force', action='store_true', help='Run every job, even when its output is current')
+    args = parser.parse_args()
+
+    try:
+        jobs, layer_files, weights_cache, num_workers = read_manifest(args.manifest)
+    except (FileNotFoundError, ValueError, KeyError) as err:
+        print(f"ERROR: {args.manifest}: {err}")
+        sys.exit(1)
+    num_workers = args.num_workers or num_workers or os.cpu_count()
+    layer_hashes = {name: shapefile_hash(f) for name, f in layer_files.items()}
+
+    # Skip the jobs whose outputs are current
+    todo = []
+    for job in jobs:
+        state = job_state(job, layer_hashes)
+        if not args.force and job_current(job, state):
+            print(f"{os.path.basename(job['output'])} is current")
+            continue
+        todo.append((job, state))
+
+    # Run the jobs in separate processes, reporting each one
+    start = perf_counter()
+    failed = 0
+    if todo:
+        # Read the layers here, so that one that cannot be read stops the
+        # run with its own error rather than break the worker pool
+        try:
+            layers = read_layers(layer_files)
+        except RuntimeError as err:
+            print(f"ERROR: {err}")
+            sys.exit(1)
+        with ProcessPoolExecutor(max_workers=min(num_workers, len(todo)),
+                                 initializer=zonal_stats._init_worker, initargs=(layer_files, layers)) as pool:
+            futures = {pool.submit(run_job, job, weights_cache): (job, state) for job, state in todo}
+            for future in as_completed(futures):
+                job, state = futures[future]
+                name = os.path.basename(job['output'])
+                try:
+                    rows, execution_time = future.result()
+                    write_state(job, state)
+                    print(f"{name}: {rows} rows in {execution_time:.3f} s")
+                except Exception as err:
+                    failed += 1
+                    print(f"ERROR: {name} failed: {err!r}")
+
+    print(f"Ran {len(todo) - failed} of {len(jobs)} jobs ({len(jobs) - len(todo)} current) "
+          f"in {perf_counter() - start:.3f} s")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
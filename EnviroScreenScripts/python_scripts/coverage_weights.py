@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+
+# Sparse polygon to grid cell coverage weights for repeated zonal statistics.
+#
+# The fraction of each grid cell covered by each polygon of a layer (tracts,
+# counties) is computed once for a grid definition and stored as a sparse
+# matrix with a row per polygon and a column per cell.  The matrices are
+# cached on disk, keyed by a hash of the shapefile and by the grid transform,
+# shape and CRS, so later runs on the same grid only read the matrix.
+#
+# The coverage weighted count, sum, mean and standard deviation of a raster
+# or of a stack of time slices on the grid are then sparse matrix products,
+# and the weighted median, minimum and maximum come from one sort of the
+# covered cells.  The statistics follow exact_extract: cells are weighted by
+# their coverage fraction only, COUNT is the sum of the coverage of the cells
+# with values and STD is the population standard deviation.
+#
+# Polygons in another CRS than the grid (the WGS84 shapefiles on the EQUATES
+# and WRF Lambert grids) are transformed to the CRS of the grid once and
+# cached, so the statistics are taken in the native grid of the model and
+# the rasters never need to be warped.
+
+import os
+import json
+import hashlib
+from collections import namedtuple
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from zonal_stats import ID_FIELD, AREA_FIELD, DEFAULT_STATS, STAT_OPS, _replace_atomic
+
+
+# Bump this when the cached matrices change
+CACHE_VERSION = 1
+
+# Files of a shapefile that define its polygons and attributes
+SHAPEFILE_PARTS = ['.shp', '.shx', '.dbf', '.prj']
+
+# Longest polygon edge in degrees before the polygons are projected, so that
+# long edges along parallels follow their curve in the projection
+SEGMENT_DEGREES = 0.01
+
+# Layers projected in this process, by shapefile and CRS
+_PROJECTED = {}
+
+
+# Grid of a raster: affine transform (a, b, c, d, e, f) as in rasterio, with
+# x = a*col + b*row + c and y = d*col + e*row + f at the cell corners, the
+# number of (rows, columns), and the CRS as WKT or PROJ text.  Cells are
+# numbered row by row in the order of the raster, so a grid with its first
+# row in the south works as well as one with its first row in the north.
+Grid = namedtuple('Grid', ['transform', 'shape', 'crs'])
+
+
+def raster_grid(src):
+    """Return the Grid of an open rasterio dataset."""
+    return Grid(tuple(src.transform)[:6], (src.height, src.width), src.crs.to_wkt() if src.crs else '')
+
+
+def raster_crs(raster):
+    """Return the CRS of a raster file as WKT, empty when it has none."""
+    import rasterio
+
+    with rasterio.open(raster) as src:
+        return src.crs.to_wkt() if src.crs else ''
+
+
+def read_raster(raster, band=1):
+    """Return the values of one band of a raster as float64 with NaN where missing, and its Grid."""
+    import rasterio
+
+    with rasterio.open(raster) as src:
+        values = src.read(band, masked=True).astype(np.float64).filled(np.nan)
+        return values, raster_grid(src)
+
+
+def grid_key(grid):
+    """Return the text identifying a grid in the cache key."""
+    transform = [float(v) for v in grid.transform]
+    return json.dumps({'transform': transform, 'shape': list(grid.shape), 'crs': grid.crs}, sort_keys=True)
+
+
+def shapefile_hash(shapefile):
+    """Return the sha1 of the files making up a shapefile, whose .shp must exist."""
+    h = hashlib.sha1()
+    base = os.path.splitext(shapefile)[0]
+    if not os.path.exists(base + '.shp'):
+        raise FileNotFoundError(f"Shapefile {base}.shp not found")
+    for ext in SHAPEFILE_PARTS:
+        part = base + ext
+        if os.path.exists(part):
+            h.update(ext.encode())
+            with open(part, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    h.update(block)
+    return h.hexdigest()
+
+
+def cache_file(cache_dir, shapefile, grid):
+    """Return the cache file of the weights of a shapefile on a grid."""
+    key = hashlib.sha1(f"{CACHE_VERSION}\n{shapefile_hash(shapefile)}\n{grid_key(grid)}".encode()).hexdigest()
+    stem = os.path.splitext(os.path.basename(shapefile))[0]
+    return os.path.join(cache_dir, f"{stem}_{key[:16]}.npz")
+
+
+def layer_cache_file(cache_dir, shapefile, crs):
+    """Return the cache file of the polygons of a shapefile transformed to crs."""
+    key = hashlib.sha1(f"{CACHE_VERSION}\n{shapefile_hash(shapefile)}\n{crs}".encode()).hexdigest()
+    stem = os.path.splitext(os.path.basename(shapefile))[0]
+    return os.path.join(cache_dir, f"{stem}_{key[:16]}.wkb.npz")
+
+
+def project_layer(layer, crs):
+    """Return a layer read with read_layer in zonal_stats transformed to crs."""
+    import shapely
+    import geopandas as gpd
+
+    geometries = np.asarray(layer.geometry.values)
+    if layer.crs.is_geographic:
+        geometries = shapely.segmentize(geometries, SEGMENT_DEGREES)
+    projected = gpd.GeoSeries(geometries, index=layer.index, crs=layer.crs).to_crs(crs)
+    return layer.set_geometry(projected)
+
+
+def _save_layer(layer, output_file):
+    import shapely
+
+    # WKB is binary, so store the polygons as one byte array and offsets
+    wkb = shapely.to_wkb(np.asarray(layer.geometry.values))
+    offsets = np.cumsum([0] + [len(g) for g in wkb])
+
+    def write(tmp_file):
+        with open(tmp_file, 'wb') as f:
+            np.savez_compressed(f, wkb=np.frombuffer(b''.join(wkb), dtype=np.uint8), offsets=offsets,
+                                ids=np.asarray(layer[ID_FIELD]).astype(str),
+                                area=np.asarray(layer[AREA_FIELD], dtype=np.float64))
+    _replace_atomic(write, output_file)
+
+
+def _load_layer(input_file, crs):
+    import shapely
+    import geopandas as gpd
+
+    with np.load(input_file) as cached:
+        wkb, offsets = cached['wkb'].tobytes(), cached['offsets']
+        geometries = shapely.from_wkb([wkb[i0:i1] for i0, i1 in zip(offsets[:-1], offsets[1:])])
+        return gpd.GeoDataFrame({ID_FIELD: cached['ids'], AREA_FIELD: cached['area']},
+                                geometry=geometries, crs=crs)
+
+
+def layer_in_crs(shapefile, layer, crs, cache_dir=None):
+    """Return a layer read with read_layer in crs.
+
+    A layer in another CRS is transformed once per process, and cached in
+    cache_dir when given, keyed by the hash of the shapefile and the CRS.
+    """
+    if layer.crs is None or _same_crs(layer.crs.to_wkt(), crs):
+        return layer
+    key = (os.path.abspath(shapefile), crs)
+    if key in _PROJECTED:
+        return _PROJECTED[key]
+
+    cfile = layer_cache_file(cache_dir, shapefile, crs) if cache_dir else None
+    projected = None
+    if cfile and os.path.exists(cfile):
+        try:
+            projected = _load_layer(cfile, crs)
+        except (OSError, ValueError, KeyError) as err:
+            print(f"WARNING: Recomputing {cfile}: {err!r}")
+    if projected is None:
+        start = perf_counter()
+        projected = project_layer(layer, crs)
+        if cfile:
+            _save_layer(projected, cfile)
+        print(f"Projected {os.path.basename(shapefile)} in {perf_counter() - start:.3f} s")
+    _PROJECTED[key] = projected
+    return projected
+
+
+def coverage_matrix(geometries, grid):
+    """Return the fraction of each grid cell covered by each geometry as a sparse CSR matrix.
+
+    The geometries must be in the CRS of the grid.  Cells completely inside
+    a polygon get 1 without computing an intersection.
+    """
+    import shapely
+
+    a, b, c, d, e, f = grid.transform
+    if b or d:
+        raise ValueError('Rotated grids are not supported')
+    nrows, ncols = grid.shape
+    cell_area = abs(a * e)
+
+    rows, cols, fractions = [], [], []
+    for i, geom in enumerate(geometries):
+        if geom is None or geom.is_empty:
+            continue
+        minx, miny, maxx, maxy = geom.bounds
+
+        # Cells overlapping the bounds of the polygon
+        x = sorted(((minx - c) / a, (maxx - c) / a))
+        y = sorted(((miny - f) / e, (maxy - f) / e))
+        c0, c1 = max(int(np.floor(x[0])), 0), min(int(np.ceil(x[1])), ncols)
+        r0, r1 = max(int(np.floor(y[0])), 0), min(int(np.ceil(y[1])), nrows)
+        if c0 >= c1 or r0 >= r1:
+            continue
+        cc, rr = np.meshgrid(np.arange(c0, c1), np.arange(r0, r1))
+        cc, rr = cc.ravel(), rr.ravel()
+        x0, y0 = c + cc * a, f + rr * e
+        boxes = shapely.box(np.minimum(x0, x0 + a), np.minimum(y0, y0 + e),
+                            np.maximum(x0, x0 + a), np.maximum(y0, y0 + e))
+
+        shapely.prepare(geom)
+        inside = shapely.contains_properly(geom, boxes)
+        fraction = inside.astype(np.float64)
+        edge = ~inside & shapely.intersects(geom, boxes)
+        fraction[edge] = shapely.area(shapely.intersection(boxes[edge], geom)) / cell_area
+
+        keep = fraction > 0
+        rows.append(np.full(keep.sum(), i))
+        cols.append(rr[keep] * ncols + cc[keep])
+        fractions.append(np.minimum(fraction[keep], 1.0))
+
+    if not rows:
+        return sp.csr_matrix((len(geometries), nrows * ncols))
+    return sp.csr_matrix((np.concatenate(fractions), (np.concatenate(rows), np.concatenate(cols))),
+                         shape=(len(geometries), nrows * ncols))
+
+
+def _same_crs(crs1, crs2):
+    from pyproj import CRS
+
+    if not crs1 or not crs2:
+        return True
+    # Shapefiles give longitude first and EPSG:4326 latitude first
+    return CRS.from_user_input(crs1).equals(CRS.from_user_input(crs2), ignore_axis_order=True)
+
+
+class CoverageWeights:
+    """Coverage fractions of the polygons of a layer on one grid, with the polygon FIPS and areas."""
+
+    def __init__(self, matrix, ids, area, grid):
+        self.matrix = matrix.tocsr()
+        self.ids = np.asarray(ids).astype(str)
+        self.area = np.asarray(area, dtype=np.float64)
+        self.grid = grid
+
+    @classmethod
+    def from_layer(cls, layer, grid):
+        """Compute the weights of a layer from read_layer in zonal_stats."""
+        if layer.crs is not None and not _same_crs(layer.crs.to_wkt(), grid.crs):
+            raise ValueError('The polygons are not in the CRS of the grid')
+        return cls(coverage_matrix(list(layer.geometry), grid), layer[ID_FIELD], layer[AREA_FIELD], grid)
+
+    def save(self, output_file):
+        """Write the weights to a compressed .npz file."""
+        def write(tmp_file):
+            with open(tmp_file, 'wb') as f:
+                np.savez_compressed(f, data=self.matrix.data, indices=self.matrix.indices,
+                                    indptr=self.matrix.indptr, shape=np.array(self.matrix.shape),
+                                    ids=self.ids, area=self.area, grid=np.array(grid_key(self.grid)))
+        _replace_atomic(write, output_file)
+
+    @classmethod
+    def load(cls, input_file, grid):
+        """Read weights written by save, checking they are for grid."""
+        with np.load(input_file) as cached:
+            if str(cached['grid']) != grid_key(grid):
+                raise ValueError(input_file+' is for another grid')
+            matrix = sp.csr_matrix((cached['data'], cached['indices'], cached['indptr']),
+                                   shape=tuple(cached['shape']))
+            return cls(matrix, cached['ids'], cached['area'], grid)
+
+    def stats(self, values, stats=DEFAULT_STATS):
+        """Return the statistics of the values on the grid over each polygon.
+
+        values holds one raster shaped like the grid, or a stack of them
+        with the grid dimensions last, NaN where missing.  Returns a dict
+        of an array per statistic, with a row per polygon and a column per
+        raster of a stack.
+        """
+        unknown = [s for s in stats if s not in STAT_OPS]
+        if unknown:
+            raise ValueError('Unknown statistics '+', '.join(unknown))
+        ncells = self.matrix.shape[1]
+        values = np.asarray(values, dtype=np.float64)
+        stack = values.ndim > len(self.grid.shape)
+        values = values.reshape(-1, ncells).T
+
+        valid = ~np.isnan(values)
+        filled = np.where(valid, values, 0.0)
+        count = self.matrix @ valid.astype(np.float64)
+        total = self.matrix @ filled
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(count > 0, total / count, np.nan)
+
+        result = {}
+        for stat in stats:
+            if stat == 'COUNT':
+                result[stat] = count
+            elif stat == 'SUM':
+                result[stat] = total
+            elif stat == 'MEAN':
+                result[stat] = mean
+            elif stat == 'STD':
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    variance = (self.matrix @ (filled * filled)) / count - mean * mean
+                result[stat] = np.sqrt(np.maximum(variance, 0.0))
+            else:
+                result[stat] = np.column_stack([self._sorted_stat(stat, values[:, j]) for j in range(values.shape[1])])
+
+        if not stack:
+            result = {stat: array[:, 0] for stat, array in result.items()}
+        return result
+
+    def _sorted_stat(self, stat, values):
+        # Median, minimum or maximum of each polygon from one sort of the
+        # covered cells with values, by polygon and then by value
+        npoly = self.matrix.shape[0]
+        result = np.full(npoly, np.nan)
+        poly = np.repeat(np.arange(npoly), np.diff(self.matrix.indptr))
+        x = values[self.matrix.indices]
+        w = self.matrix.data
+        keep = ~np.isnan(x) & (w > 0)
+        poly, x, w = poly[keep], x[keep], w[keep]
+        if not len(x):
+            return result
+        order = np.lexsort((x, poly))
+        poly, x, w = poly[order], x[order], w[order]
+        first = np.searchsorted(poly, np.arange(npoly))
+        last = np.searchsorted(poly, np.arange(npoly), side='right') - 1
+        has = last >= first
+
+        if stat == 'MIN':
+            result[has] = x[first[has]]
+            return result
+        if stat == 'MAX':
+            result[has] = x[last[has]]
+            return result
+
+        # Weighted median, interpolated like the type 7 quantile of R when
+        # all the weights are equal: s_k = (k-1) w_k + (n-1) sum(w_i, i<k)
+        # for the k-th smallest of n values, and the median lies where s
+        # reaches half of s_n
+        cum = np.cumsum(w)
+        before = np.concatenate([[0.0], cum])[first]
+        k = np.arange(len(x)) - first[poly]
+        n = (last - first + 1)[poly]
+        cum_prev = cum - w - before[poly]
+        s = k * w + (n - 1) * cum_prev
+        h = 0.5 * s[last][poly]
+
+        # First value of each polygon reaching h
+        reached = np.flatnonzero(s >= h)
+        at = reached[np.unique(poly[reached], return_index=True)[1]]
+        upper_poly = poly[at]
+        interior = (at > first[upper_poly]) & (s[at] > h[at])
+        median = x[at].copy()
+        lo, hi = at[interior] - 1, at[interior]
+        median[interior] = x[lo] + (h[hi] - s[lo]) * (x[hi] - x[lo]) / (s[hi] - s[lo])
+        result[upper_poly] = median
+        return result
+
+    def frame(self, values, stats=DEFAULT_STATS):
+        """Return the statistics of one raster as a frame like zonal_frame in zonal_stats."""
+        frame = pd.DataFrame({ID_FIELD: self.ids, AREA_FIELD: self.area})
+        for stat, array in self.stats(values, stats).items():
+            frame[stat] = array
+        return frame
+
+
+def load_weights(shapefile, grid, cache_dir, layer=None):
+    """Return the CoverageWeights of a shapefile on a grid, from the cache when there.
+
+    The weights are computed and cached when missing, with the polygons
+    transformed to the CRS of the grid when needed.  layer is the shapefile
+    already read with read_layer, read here when needed.
+    """
+    cfile = cache_file(cache_dir, shapefile, grid)
+    if os.path.exists(cfile):
+        try:
+            return CoverageWeights.load(cfile, grid)
+        except (OSError, ValueError, KeyError) as err:
+            print(f"WARNING: Recomputing {cfile}: {err!r}")
+
+    start = perf_counter()
+    if layer is None:
+        from zonal_stats import read_layer
+        layer = read_layer(shapefile)
+    layer = layer_in_crs(shapefile, layer, grid.crs, cache_dir)
+    weights = CoverageWeights.from_layer(layer, grid)
+    weights.save(cfile)
+    print(f"Cached the coverage of {os.path.basename(shapefile)} in {perf_counter() - start:.3f} s")
+    return weights
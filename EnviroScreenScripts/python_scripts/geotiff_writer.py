@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+# Block-streamed GeoTIFF writer for gridded products, replacing the
+# flipud / masked_invalid / filled / astype / dst.write sequence of the
+# zonal_AQE_*.ipynb conversion cells, which made several copies of the
+# whole array before writing it.
+#
+# The source variable is read one row of tiles at a time.  Grids whose first
+# row is in the south (OMI, TROPOMI, IOAPI files) are flipped by writing each
+# block, itself flipped, to the mirrored window of the north-up GeoTIFF, and
+# the missing values of each block are replaced with the nodata value as it
+# is written.  The output is tiled and deflate compressed with the floating
+# point predictor, so windowed reads of a few tracts or counties only
+# decompress the tiles they cover.  Overviews can be added, and a cloud
+# optimized GeoTIFF written instead.
+#
+# Example, the first EQUATES day on its native Lambert grid:
+#
+#   python geotiff_writer.py equates HR2DAY_LST_ACONC_EQUATES_v532_12US1_2016_MDA8_SIP_avg.nc \
+#       O3_MDA8 equates_MDA8_2016.tif --step 0 --lay 0
+
+import os
+import sys
+import argparse
+import tempfile
+from time import perf_counter
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from zonal_stats import _replace_atomic
+
+
+# Tile size, also the rows read at a time
+DEFAULT_BLOCKSIZE = 512
+
+# Missing value of the notebooks' GeoTIFFs
+DEFAULT_NODATA = -9999.0
+
+
+def north_up(grid):
+    """Return the transform of a grid with its first row in the north, and whether its rows are flipped."""
+    a, b, c, d, e, f = grid.transform
+    if b or d:
+        raise ValueError('Rotated grids are not supported')
+    if e < 0:
+        return (a, b, c, d, e, f), False
+    return (a, 0.0, c, 0.0, -e, f + e * grid.shape[0]), True
+
+
+def overview_levels(shape, blocksize=DEFAULT_BLOCKSIZE):
+    """Return the overview factors halving the grid until it fits in one tile."""
+    levels = []
+    factor = 2
+    while max(shape) / factor >= blocksize / 2:
+        levels.append(factor)
+        factor *= 2
+    return levels or [2]
+
+
+def _block(source, r0, r1, flip, fill_values, nodata):
+    # Source rows r0 to r1 as float32, flipped when needed, with every
+    # missing value set to nodata.  Masked cells, as netCDF4 variables
+    # return for their _FillValue, are filled before anything drops the mask
+    block = source[r0:r1]
+    block = getattr(block, 'values', block)
+    if np.ma.isMaskedArray(block):
+        block = np.ma.getdata(block.astype(np.float32).filled(np.nan))
+    else:
+        # A copy, as the missing values are set in place
+        block = np.array(block, dtype=np.float32)
+    missing = ~np.isfinite(block)
+    for fill in fill_values:
+        missing |= block == np.float32(fill)
+    block[missing] = nodata
+    return block[::-1] if flip else block
+
+
+def write_blocks(dst, source, shape, flip=False, fill_values=(), nodata=DEFAULT_NODATA, blocksize=DEFAULT_BLOCKSIZE):
+    """Write a 2-D source to band 1 of an open rasterio dataset a row of tiles at a time.
+
+    source is anything sliced by rows without reading the rest, such as a
+    netCDF4 variable, an xarray DataArray or a NumPy array.  With flip, the
+    first source row is the last row of the output.
+    """
+    from rasterio.windows import Window
+
+    nrows, ncols = shape
+    for o0 in range(0, nrows, blocksize):
+        o1 = min(o0 + blocksize, nrows)
+        r0, r1 = (nrows - o1, nrows - o0) if flip else (o0, o1)
+        dst.write(_block(source, r0, r1, flip, fill_values, nodata), 1, window=Window(0, o0, ncols, o1 - o0))
+
+
+def write_geotiff(output_file, source, grid, fill_values=(), nodata=DEFAULT_NODATA, blocksize=DEFAULT_BLOCKSIZE,
+                  overviews=False, cog=False):
+    """Write a 2-D source on a Grid to a tiled, compressed, north-up float32 GeoTIFF.
+
+    fill_values are source values that are missing besides NaN.  With
+    overviews, averaged overviews are added down to one tile, and with cog
+    a cloud optimized GeoTIFF (which always has them) is written instead.
+    """
+    import rasterio
+    from rasterio.enums import Resampling
+    from rasterio.transform import Affine
+
+    transform, flip = north_up(grid)
+    nrows, ncols = grid.shape
+    profile = {
+        'driver': 'GTiff',
+        'height': nrows,
+        'width': ncols,
+        'count': 1,
+        'dtype': 'float32',
+        'crs': grid.crs or None,
+        'transform': Affine(*transform),
+        'nodata': nodata,
+        'tiled': True,
+        'blockxsize': blocksize,
+        'blockysize': blocksize,
+        'compress': 'deflate',
+        'predictor': 3,
+        'BIGTIFF': 'IF_SAFER',
+    }
+
+    def write_tiled(path):
+        with rasterio.open(path, 'w', **profile) as dst:
+            write_blocks(dst, source, grid.shape, flip, fill_values, nodata, blocksize)
+            if overviews and not cog:
+                dst.build_overviews(overview_levels(grid.shape, blocksize), Resampling.average)
+                dst.update_tags(ns='rio_overview', resampling='average')
+
+    if not cog:
+        _replace_atomic(write_tiled, output_file)
+        return
+
+    # The COG driver only copies, so write a tiled GeoTIFF and copy it with
+    # the overviews the driver builds from it
+    from rasterio.shutil import copy as rio_copy
+
+    fd, tiled_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output_file)), suffix='.tif.tmp')
+    os.close(fd)
+    try:
+        write_tiled(tiled_file)
+        _replace_atomic(lambda f: rio_copy(tiled_file, f, driver='COG', COMPRESS='DEFLATE', PREDICTOR='YES',
+                                           BLOCKSIZE=blocksize, OVERVIEW_RESAMPLING='AVERAGE', BIGTIFF='IF_SAFER'),
+                        output_file)
+    finally:
+        os.remove(tiled_file)
+
+
+def main():
+    from ingest import get_reader
+
+    parser = argparse.ArgumentParser(description='Write one time step and layer of a gridded product variable '
+                                                 'to a tiled, compressed GeoTIFF a block at a time')
+    parser.add_argument('product', help='Product reader: omi, tropomi, camx or equates')
+    parser.add_argument('input', help='Product file')
+    parser.add_argument('variable', help='Variable to write')
+    parser.add_argument('output', help='Output GeoTIFF')
+    parser.add_argument('--step', type=int, default=0, help='Time step index (default: 0)')
+    parser.add_argument('--lay', type=int, default=0, help='Vertical layer index (default: 0)')
+    parser.add_argument('--nodata', type=float, default=DEFAULT_NODATA, help=f"Nodata value (default: {DEFAULT_NODATA:g})")
+    parser.add_argument('--blocksize', type=int, default=DEFAULT_BLOCKSIZE,
+                        help=f"Tile size, a multiple of 16 (default: {DEFAULT_BLOCKSIZE})")
+    parser.add_argument('--overviews', action='store_true', help='Add averaged overviews')
+    parser.add_argument('--cog', action='store_true', help='Write a cloud optimized GeoTIFF')
+    parser.add_argument('--cache-dir', help='Directory of the cached regridding index of curvilinear CAMx grids')
+    args = parser.parse_args()
+
+    start = perf_counter()
+    with get_reader(args.product)(args.input, args.variable, [args.lay], cache_dir=args.cache_dir) as reader:
+        grid, _ = reader.grid()
+        source = reader.slice_source(args.step)
+        write_geotiff(args.output, source, grid, reader.fill_values(), args.nodata, args.blocksize,
+                      args.overviews, args.cog)
+    print(f"Wrote {args.output} in {perf_counter() - start:.3f} s")
+
+
+if __name__ == "__main__":
+    main()
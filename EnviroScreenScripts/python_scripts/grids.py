@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+# Grid definitions of the gridded NetCDF products, as the Grid of
+# coverage_weights.py, taken from the file itself instead of the constants
+# in the notebooks.
+#
+# IOAPI files (EQUATES, CAMx) give the grid in their global attributes
+# (GDTYP, XORIG, YORIG, XCELL, YCELL, NCOLS, NROWS and the projection
+# parameters), with the first row in the south.  Regular latitude-longitude
+# products (OMI, TROPOMI, regridded SIP output) give it through 1-D lat and
+# lon coordinates, in either order.  WRF Lambert grids come from the MET grid
+# dictionary of convert_wrf_sfc.py (wrf_sfc.grid_attrs), for its north first
+# met_data, or from the wrfout global attributes, south first as in the file.
+
+import numpy as np
+import pandas as pd
+
+from coverage_weights import Grid
+
+
+# Sphere radius of the IOAPI/CMAQ projections
+IOAPI_EARTH_RADIUS = 6370000.0
+
+# IOAPI grid types
+IOAPI_LATLON = 1
+IOAPI_LAMBERT = 2
+
+# Sphere radius of the MET and WRF grids
+MET_EARTH_RADIUS_KM = 6371.2
+
+# WRF MAP_PROJ of the Lambert conformal grids
+WRF_LAMBERT = 1
+
+LAT_NAMES = ['lat', 'latitude', 'LAT', 'Latitude']
+LON_NAMES = ['lon', 'longitude', 'LON', 'Longitude']
+
+
+def is_ioapi(ds):
+    """Return whether a dataset has IOAPI grid attributes."""
+    return all(a in ds.attrs for a in ('GDTYP', 'XORIG', 'YORIG', 'XCELL', 'YCELL', 'NCOLS', 'NROWS'))
+
+
+def ioapi_crs(attrs):
+    """Return the PROJ definition of an IOAPI grid."""
+    gdtyp = int(attrs['GDTYP'])
+    if gdtyp == IOAPI_LAMBERT:
+        return (f"+proj=lcc +a={IOAPI_EARTH_RADIUS:.0f} +b={IOAPI_EARTH_RADIUS:.0f} "
+                f"+lat_1={float(attrs['P_ALP'])} +lat_2={float(attrs['P_BET'])} "
+                f"+lat_0={float(attrs['YCENT'])} +lon_0={float(attrs['P_GAM'])} "
+                f"+x_0=0 +y_0=0 +units=m +no_defs")
+    if gdtyp == IOAPI_LATLON:
+        return 'EPSG:4326'
+    raise ValueError(f"IOAPI grid type {gdtyp} is not supported")
+
+
+def ioapi_grid(attrs):
+    """Return the Grid of an IOAPI file from its global attributes, first row in the south."""
+    xcell, ycell = float(attrs['XCELL']), float(attrs['YCELL'])
+    transform = (xcell, 0.0, float(attrs['XORIG']), 0.0, ycell, float(attrs['YORIG']))
+    return Grid(transform, (int(attrs['NROWS']), int(attrs['NCOLS'])), ioapi_crs(attrs))
+
+
+def ioapi_times(ds, time_dim='TSTEP'):
+    """Return the start times of the time steps of an IOAPI file."""
+    if 'TFLAG' in ds.variables:
+        # TFLAG holds YYYYDDD and HHMMSS of each step and variable
+        tflag = np.asarray(ds['TFLAG'].values)[:, 0, :]
+        dates = pd.to_datetime(tflag[:, 0].astype(str), format='%Y%j')
+        return dates + pd.to_timedelta(tflag[:, 1] // 10000, unit='h') + \
+            pd.to_timedelta(tflag[:, 1] // 100 % 100, unit='min') + pd.to_timedelta(tflag[:, 1] % 100, unit='s')
+
+    # Otherwise from the start date, time and time step
+    def hms(t):
+        t = int(t)
+        return pd.Timedelta(hours=t // 10000, minutes=t // 100 % 100, seconds=t % 100)
+    start = pd.to_datetime(str(int(ds.attrs['SDATE'])), format='%Y%j') + hms(ds.attrs['STIME'])
+    return pd.DatetimeIndex([start + hms(ds.attrs['TSTEP']) * i for i in range(ds.sizes[time_dim])])
+
+
+def met_lambert_crs(grid):
+    """Return the PROJ definition of a MET Lambert conformal grid dictionary."""
+    radius = float(grid.get('r_km', MET_EARTH_RADIUS_KM)) * 1000
+    return (f"+proj=lcc +a={radius:.1f} +b={radius:.1f} "
+            f"+lat_1={float(grid['scale_lat_1'])} +lat_2={float(grid['scale_lat_2'])} "
+            f"+lat_0={float(grid['scale_lat_1'])} +lon_0={float(grid['lon_orient'])} "
+            f"+x_0=0 +y_0=0 +units=m +no_defs")
+
+
+def met_grid(grid, north_first=True):
+    """Return the Grid of a MET Lambert conformal grid dictionary, as from wrf_sfc.grid_attrs.
+
+    MET grid point (x_pin, y_pin), counted from the south-west, is at
+    (lon_pin, lat_pin).  The rows are north first as in met_data, or south
+    first as in the wrfout file without north_first.
+    """
+    from pyproj import Transformer
+
+    crs = met_lambert_crs(grid)
+    d = float(grid['d_km']) * 1000
+    nx, ny = int(grid['nx']), int(grid['ny'])
+    to_grid = Transformer.from_crs('EPSG:4326', crs, always_xy=True)
+    x_pin, y_pin = to_grid.transform(float(grid['lon_pin']), float(grid['lat_pin']))
+
+    # South-west corner of the grid
+    x0 = x_pin - (float(grid['x_pin']) + 0.5) * d
+    y0 = y_pin - (float(grid['y_pin']) + 0.5) * d
+    if north_first:
+        return Grid((d, 0.0, x0, 0.0, -d, y0 + ny * d), (ny, nx), crs)
+    return Grid((d, 0.0, x0, 0.0, d, y0), (ny, nx), crs)
+
+
+def is_wrf(ds):
+    """Return whether a dataset has WRF map projection attributes."""
+    return all(a in ds.attrs for a in ('MAP_PROJ', 'DX', 'CEN_LAT', 'CEN_LON', 'TRUELAT1', 'TRUELAT2', 'STAND_LON'))
+
+
+def wrf_grid(ds):
+    """Return the Grid of the mass points of a wrfout dataset, south first as in the file."""
+    if int(ds.attrs['MAP_PROJ']) != WRF_LAMBERT:
+        raise ValueError(f"WRF MAP_PROJ {ds.attrs['MAP_PROJ']} is not supported")
+
+    # As wrf_sfc.grid_attrs, pinned at the centre of the grid
+    nx, ny = ds.sizes['west_east'], ds.sizes['south_north']
+    grid = {
+        'nx': nx, 'ny': ny,
+        'lat_pin': float(ds.attrs['CEN_LAT']), 'lon_pin': float(ds.attrs['CEN_LON']),
+        'x_pin': (nx - 1) * 0.5, 'y_pin': (ny - 1) * 0.5,
+        'lon_orient': float(ds.attrs['STAND_LON']),
+        'd_km': float(ds.attrs['DX']) / 1000,
+        'r_km': MET_EARTH_RADIUS_KM,
+        'scale_lat_1': float(ds.attrs['TRUELAT1']), 'scale_lat_2': float(ds.attrs['TRUELAT2']),
+    }
+    return met_grid(grid, north_first=False)
+
+
+def wrf_times(ds):
+    """Return the times of a wrfout dataset from its Times variable."""
+    times = np.asarray(ds['Times'].values)
+    if times.dtype.kind == 'S' and times.ndim == 2:
+        times = [b''.join(t).decode() for t in times]
+    else:
+        times = [t.decode() if isinstance(t, bytes) else str(t) for t in times]
+    return pd.DatetimeIndex(pd.to_datetime(times, format='%Y-%m-%d_%H:%M:%S'))
+
+
+def _coord(ds, names):
+    for name in names:
+        if name in ds.variables and ds[name].ndim == 1:
+            return name
+    return None
+
+
+def latlon_grid(ds, var):
+    """Return the Grid of a variable on 1-D lat and lon coordinates, and their dimensions (y, x)."""
+    lat_name, lon_name = _coord(ds, LAT_NAMES), _coord(ds, LON_NAMES)
+    if lat_name is None or lon_name is None:
+        raise ValueError(f"No 1-D latitude and longitude coordinates for {var}")
+    lat, lon = np.asarray(ds[lat_name].values, dtype=np.float64), np.asarray(ds[lon_name].values, dtype=np.float64)
+    dlat, dlon = np.diff(lat), np.diff(lon)
+    if len(lat) < 2 or len(lon) < 2 or not (np.allclose(dlat, dlat[0]) and np.allclose(dlon, dlon[0])):
+        raise ValueError(f"The latitudes and longitudes of {var} are not a regular grid")
+
+    # The coordinates are cell centres
+    dy, dx = float(dlat.mean()), float(dlon.mean())
+    transform = (dx, 0.0, float(lon[0]) - dx / 2, 0.0, dy, float(lat[0]) - dy / 2)
+    return Grid(transform, (len(lat), len(lon)), 'EPSG:4326'), (ds[lat_name].dims[0], ds[lon_name].dims[0])
+
+
+def dataset_grid(ds, var):
+    """Return the Grid of a variable and its grid dimensions (y, x)."""
+    if is_ioapi(ds):
+        return ioapi_grid(ds.attrs), ds[var].dims[-2:]
+    if is_wrf(ds):
+        return wrf_grid(ds), ('south_north', 'west_east')
+    return latlon_grid(ds, var)
@@ -0,0 +1,27 @@
+# Readers of the gridded products aggregated for EnviroScreen, by product
+# name.  A reader gives the grid of one variable of a product file and its
+# values a few time steps at a time (see base.py), so batch_ingest.py can
+# aggregate any product the same way.  A new product registers its reader
+# class with @register('name') in a module imported below.
+
+READERS = {}
+
+
+def register(name):
+    """Class decorator registering a reader under a product name."""
+    def add(cls):
+        READERS[name] = cls
+        cls.product = name
+        return cls
+    return add
+
+
+def get_reader(product):
+    """Return the reader class of a product."""
+    try:
+        return READERS[product.lower()]
+    except KeyError:
+        raise KeyError(f"No reader for product {product}, known products: {', '.join(sorted(READERS))}") from None
+
+
+from ingest import omi, tropomi, camx, equates  # noqa: E402,F401  (registers the readers)
@@ -0,0 +1,110 @@
+# Base reader of one variable of a gridded NetCDF product file.
+#
+# The grid comes from the file (IOAPI attributes or 1-D latitudes and
+# longitudes, see grids.py), the values are read a few time steps at a time
+# for the selected vertical layers, and products without a time dimension
+# take the first date in their file name, as in
+# OMI-Aura_L3-OMNO2d_20160516-20160820.he5.
+
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from grids import dataset_grid
+from zonal_timeseries import TIME_DIMS, LAY_DIMS, _find_dim, slice_times, iter_chunks
+
+
+# Attributes marking missing values that xarray does not decode, as in
+# HDF-EOS files
+MISSING_ATTRS = ['MissingValue']
+
+
+def file_date(path):
+    """Return the first YYYYMMDD date in a file name, NaT when there is none."""
+    match = re.search(r'(?<!\d)((?:19|20)\d{2})(\d{2})(\d{2})(?!\d)', os.path.basename(path))
+    if not match:
+        return pd.NaT
+    return pd.Timestamp(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+
+
+class ProductReader:
+    """One variable of a gridded product file.
+
+    lays selects vertical layers by index, the first one by default as in
+    the notebooks, or all of them with 'all'.  cache_dir is where readers
+    that need to can cache what they derive from the grid.
+    """
+
+    product = None
+
+    def __init__(self, path, variable, lays=None, cache_dir=None):
+        self.path = path
+        self.cache_dir = cache_dir
+        self.variable = variable
+        self.ds = self.open()
+        if variable not in self.ds:
+            self.ds.close()
+            raise KeyError(f"{variable} not found in {path}")
+        self.da = self.ds[variable]
+        self.time_dim = _find_dim(self.da.dims, TIME_DIMS)
+        self.lay_dim = _find_dim(self.da.dims, LAY_DIMS)
+        self.lays = None
+        if self.lay_dim:
+            self.lays = list(range(self.da.sizes[self.lay_dim])) if lays == 'all' else list(lays or [0])
+
+    def open(self):
+        import xarray as xr
+
+        return xr.open_dataset(self.path)
+
+    def close(self):
+        self.ds.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def grid(self):
+        """Return the Grid of the values and the names of its dimensions (y, x)."""
+        return dataset_grid(self.ds, self.variable)
+
+    def times(self):
+        """Return the times of the steps, the date in the file name for a single step."""
+        times = slice_times(self.ds, self.da, self.time_dim)
+        if self.time_dim is None:
+            return pd.DatetimeIndex([file_date(self.path)])
+        return times
+
+    def layer_values(self):
+        """Return the vertical layers read, [0] when the variable has none."""
+        return self.lays or [0]
+
+    def fill_values(self):
+        """Return the values marking missing data that xarray left in place."""
+        return [float(np.ravel(self.da.attrs[attr])[0]) for attr in MISSING_ATTRS if attr in self.da.attrs]
+
+    def _mask(self, values):
+        for fill in self.fill_values():
+            values[values == fill] = np.nan
+        values[~np.isfinite(values)] = np.nan
+        return values
+
+    def slice_source(self, step=0):
+        """Return one time step of the first layer read, shaped (rows, columns), read from the file as it is sliced by rows."""
+        _, grid_dims = self.grid()
+        da = self.da
+        if self.time_dim:
+            da = da.isel({self.time_dim: step})
+        if self.lay_dim:
+            da = da.isel({self.lay_dim: self.lays[0]})
+        return da.transpose(*grid_dims)
+
+    def chunks(self, steps):
+        """Yield the first step and the values of each chunk of steps, shaped (steps, layers, rows, columns)."""
+        _, grid_dims = self.grid()
+        for t0, values in iter_chunks(self.da, grid_dims, self.time_dim, self.lay_dim, self.lays, steps):
+            yield t0, self._mask(values)
@@ -0,0 +1,69 @@
+# CAMx SIP output (PM25, ...).  With 2-D latitudes and longitudes the values
+# are regridded to the regular grid of zonal_AQE_SIP.ipynb by the cached
+# nearest neighbour index of regrid_nearest.py as they are read; with 1-D
+# ones they are used as they are.
+
+import numpy as np
+
+from grids import latlon_grid
+from regrid_nearest import regular_grid, load_regridder
+from zonal_timeseries import iter_chunks
+from ingest import register
+from ingest.base import ProductReader
+
+
+LAT_NAME = 'latitude'
+LON_NAME = 'longitude'
+
+
+@register('camx')
+class CamxReader(ProductReader):
+    """One variable of a CAMx file, on a regular latitude-longitude grid.
+
+    cache_dir holds the nearest neighbour index of curvilinear grids.
+    """
+
+    def __init__(self, path, variable, lays=None, cache_dir=None):
+        super().__init__(path, variable, lays, cache_dir)
+        self._regridder = None
+        self._grid = None
+
+    def _curvilinear(self):
+        return self.ds[LAT_NAME].ndim == 2
+
+    def grid(self):
+        if self._grid is not None:
+            return self._grid
+        if not self._curvilinear():
+            self._grid = latlon_grid(self.ds, self.variable)
+            return self._grid
+
+        from coverage_weights import Grid
+
+        lat2d = np.asarray(self.ds[LAT_NAME].values, dtype=np.float64)
+        lon2d = np.asarray(self.ds[LON_NAME].values, dtype=np.float64)
+        lat_new, lon_new = regular_grid(lat2d, lon2d)
+        self._regridder = load_regridder(lat2d, lon2d, lat_new, lon_new, self.cache_dir)
+
+        # The regridded rows follow the increasing latitudes
+        dlat = float(lat_new[-1] - lat_new[0]) / (len(lat_new) - 1)
+        dlon = float(lon_new[-1] - lon_new[0]) / (len(lon_new) - 1)
+        transform = (dlon, 0.0, float(lon_new[0]) - dlon / 2, 0.0, dlat, float(lat_new[0]) - dlat / 2)
+        self._grid = (Grid(transform, (len(lat_new), len(lon_new)), 'EPSG:4326'), self.ds[LAT_NAME].dims)
+        return self._grid
+
+    def chunks(self, steps):
+        _, grid_dims = self.grid()
+        for t0, values in iter_chunks(self.da, grid_dims, self.time_dim, self.lay_dim, self.lays, steps):
+            values = self._mask(values)
+            if self._regridder is not None:
+                values = self._regridder(values).astype(np.float64)
+            yield t0, values
+
+    def slice_source(self, step=0):
+        source = super().slice_source(step)
+        if self._regridder is None:
+            return source
+        # A curvilinear step is regridded as a whole
+        values = self._mask(np.asarray(source.values, dtype=np.float64))
+        return self._regridder(values[None, None])[0, 0]
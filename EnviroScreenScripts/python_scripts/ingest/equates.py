@@ -0,0 +1,38 @@
+# EQUATES CMAQ output on the 12US1 Lambert grid (O3_MDA8, PM25_AVG, ...).
+#
+# The grid comes from the IOAPI attributes of the file.  Files converted by
+# the first step of zonal_AQE_EQUATE.ipynb lost them, and use the 12US1
+# grid and projection of that notebook instead.
+
+from coverage_weights import Grid
+from grids import is_ioapi
+from ingest import register
+from ingest.base import ProductReader
+
+
+# 12US1 grid of zonal_AQE_EQUATE.ipynb
+XORIG = -2556000.0
+YORIG = -1728000.0
+CELLSIZE = 12000.0
+NCOLS = 459
+NROWS = 299
+PROJ4 = ("+proj=lcc +a=6370000 +b=6370000 +lat_1=30 +lat_2=60 +lat_0=40.0000076293945 "
+         "+lon_0=-97 +x_0=0 +y_0=0 +units=m +no_defs")
+
+ROW_DIMS = ['ROW', 'row', 'y']
+COL_DIMS = ['COL', 'col', 'x']
+
+
+@register('equates')
+class EquatesReader(ProductReader):
+    """One variable of an EQUATES file, on its native Lambert grid with the first row in the south."""
+
+    def grid(self):
+        if is_ioapi(self.ds):
+            return super().grid()
+        row_dim = next(d for d in ROW_DIMS if d in self.da.dims)
+        col_dim = next(d for d in COL_DIMS if d in self.da.dims)
+        if (self.da.sizes[row_dim], self.da.sizes[col_dim]) != (NROWS, NCOLS):
+            raise ValueError(f"{self.variable} in {self.path} is not on the 12US1 grid and has no IOAPI attributes")
+        transform = (CELLSIZE, 0.0, XORIG, 0.0, CELLSIZE, YORIG)
+        return Grid(transform, (NROWS, NCOLS), PROJ4), (row_dim, col_dim)
@@ -0,0 +1,39 @@
+# OMI L3 HDF-EOS5 products (OMNO2d ColumnAmountNO2, OMDOAO3e ColumnAmountO3,
+# ...) on the global grid given to gdal_translate in zonal_AQE_Omi.ipynb,
+# -a_ullr -180 -90 180 90, so the first row is in the south.
+#
+# The variable is found in the HDF-EOS groups of the file, such as
+# HDFEOS/GRIDS/ColumnAmountNO2/Data Fields, and read through netCDF4.
+
+from coverage_weights import Grid
+from ingest import register
+from ingest.base import ProductReader
+
+
+def find_group(path, variable):
+    """Return the path of the group holding a variable in a netCDF4/HDF5 file."""
+    import netCDF4
+
+    with netCDF4.Dataset(path) as nc:
+        groups = [nc]
+        while groups:
+            group = groups.pop(0)
+            if variable in group.variables:
+                return group.path
+            groups.extend(group.groups.values())
+    raise KeyError(f"{variable} not found in {path}")
+
+
+@register('omi')
+class OmiReader(ProductReader):
+    """One variable of an OMI L3 HDF-EOS5 file."""
+
+    def open(self):
+        import xarray as xr
+
+        return xr.open_dataset(self.path, group=find_group(self.path, self.variable))
+
+    def grid(self):
+        ny, nx = self.da.shape[-2:]
+        transform = (360.0 / nx, 0.0, -180.0, 0.0, 180.0 / ny, -90.0)
+        return Grid(transform, (ny, nx), 'EPSG:4326'), self.da.dims[-2:]
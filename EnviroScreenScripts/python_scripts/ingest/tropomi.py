@@ -0,0 +1,12 @@
+# TROPOMI L3 products on a regular latitude-longitude grid (Tropospheric_NO2,
+# ...), with 1-D Latitude and Longitude cell centres as in
+# zonal_AQE_tropOmi.ipynb.  The rows are used in the order of the file, so
+# they need no flip.
+
+from ingest import register
+from ingest.base import ProductReader
+
+
+@register('tropomi')
+class TropomiReader(ProductReader):
+    """One variable of a TROPOMI L3 file."""
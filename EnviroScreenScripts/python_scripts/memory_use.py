@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+# Memory accounting of the chunked NetCDF processing: the peak resident set
+# size of the process, and the number of time steps to read at a time to
+# keep it under a given budget.
+
+import sys
+import resource
+
+
+def rss_mb():
+    """Return the current resident set size of this process in MB, or the peak where it is not available."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / 2**20
+    except OSError:
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    """Return the peak resident set size of this process in MB."""
+    # VmHWM starts over in a new program, while ru_maxrss keeps the peak of
+    # the process that started it
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kB, macOS bytes
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def chunk_steps(step_bytes, max_memory_mb=None, default=1, nsteps=None):
+    """Return the time steps to process at a time.
+
+    step_bytes is the memory one step needs while it is processed.  With
+    max_memory_mb, as many steps as fit in the budget left over the current
+    resident size, at least one, and default steps otherwise.  The result
+    is capped at nsteps.
+    """
+    if max_memory_mb:
+        free = max_memory_mb * 2**20 - rss_mb() * 2**20
+        steps = max(int(free // max(step_bytes, 1)), 1)
+    else:
+        steps = default
+    return min(steps, nsteps) if nsteps else steps
+
+
+def report(label):
+    """Print the peak resident set size so far."""
+    print(f"{label}: peak RSS {peak_rss_mb():.0f} MB")
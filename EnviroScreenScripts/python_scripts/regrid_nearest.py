@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+
+# Nearest neighbour regridding of CAMx/SIP output on 2-D latitudes and
+# longitudes to a regular latitude-longitude grid, replacing CASE B of the
+# first cell of zonal_AQE_SIP.ipynb.
+#
+# The notebook ran scipy.interpolate.griddata(..., method="nearest") for
+# every time and layer slice, building the same search tree from the same
+# points each time.  Here a KD-tree is built once per source and target
+# grid, and the few nearest source points of every target point are cached
+# on disk, keyed by a hash of the coordinates.  Every slice is then regridded
+# by one gather of those points.  As with griddata on the finite points of a
+# slice, a target point takes the nearest source point with a value: the
+# next nearest cached point when the nearest is missing, and a search of the
+# valid points of the slice only when all of them are.
+#
+# The variable is read a few time steps at a time, and each regridded chunk
+# is written straight to the compressed float32 output, so memory is
+# bounded by a chunk rather than by twice the whole variable.  The number of
+# steps per chunk can be set, or derived from a peak memory budget, and the
+# peak resident size is reported at the end.
+#
+# Variables whose latitudes and longitudes are already 1-D are written with
+# the coordinates attached as in CASE A.
+#
+# Example:
+#
+#   python regrid_nearest.py camxv72_cb6r5_2016_PM25_avg.nc sip_pm25_avg.nc --var PM25
+
+import os
+import argparse
+import hashlib
+from time import perf_counter
+
+import numpy as np
+
+from zonal_stats import _replace_atomic
+from memory_use import chunk_steps, report
+
+
+# Bump this when the cached neighbours change
+CACHE_VERSION = 1
+
+# Nearest source points kept for each target point
+DEFAULT_NEIGHBOURS = 4
+
+# Time steps regridded at a time without a memory budget
+DEFAULT_CHUNK_STEPS = 24
+
+
+def regular_grid(lat2d, lon2d):
+    """Return the 1-D latitudes and longitudes of a regular grid covering 2-D coordinates, at their median spacing."""
+    def med_step(a, axis):
+        d = np.nanmedian(np.abs(np.diff(a, axis=axis)))
+        return float(d) if np.isfinite(d) and d > 0 else None
+
+    dlat = med_step(lat2d, axis=0) or med_step(lat2d, axis=1) or 0.01
+    dlon = med_step(lon2d, axis=1) or med_step(lon2d, axis=0) or 0.01
+
+    lat_min, lat_max = np.nanmin(lat2d), np.nanmax(lat2d)
+    lon_min, lon_max = np.nanmin(lon2d), np.nanmax(lon2d)
+
+    lat_new = np.arange(lat_min, lat_max + dlat * 0.5, dlat, dtype=np.float32)
+    lon_new = np.arange(lon_min, lon_max + dlon * 0.5, dlon, dtype=np.float32)
+    return lat_new, lon_new
+
+
+def _points(lat, lon):
+    # (lon, lat) pairs as griddata was given them
+    return np.column_stack((np.asarray(lon, dtype=np.float64).ravel(), np.asarray(lat, dtype=np.float64).ravel()))
+
+
+def grid_hash(src_lat, src_lon, dst_lat, dst_lon, neighbours=DEFAULT_NEIGHBOURS):
+    """Return the sha1 identifying a source and target grid pair."""
+    h = hashlib.sha1(f"{CACHE_VERSION} {neighbours}".encode())
+    for a in (src_lat, src_lon, dst_lat, dst_lon):
+        a = np.ascontiguousarray(a, dtype=np.float64)
+        h.update(str(a.shape).encode())
+        h.update(a.tobytes())
+    return h.hexdigest()
+
+
+class NearestRegridder:
+    """Nearest source points of each target point of a grid pair, applied to any number of slices."""
+
+    def __init__(self, src_points, dst_points, src_shape, dst_shape, index):
+        self.src_points = src_points
+        self.dst_points = dst_points
+        self.src_shape = tuple(src_shape)
+        self.dst_shape = tuple(dst_shape)
+        self.index = index
+
+    @classmethod
+    def build(cls, src_lat, src_lon, dst_lat, dst_lon, neighbours=DEFAULT_NEIGHBOURS):
+        """Build the KD-tree of the source points and query the target points once.
+
+        dst_lat and dst_lon are 2-D, or 1-D for a regular grid.
+        """
+        from scipy.spatial import cKDTree
+
+        if np.ndim(dst_lat) == 1:
+            dst_lon, dst_lat = np.meshgrid(dst_lon, dst_lat)
+        src_points, dst_points = _points(src_lat, src_lon), _points(dst_lat, dst_lon)
+
+        # Source points without coordinates never match
+        usable = np.flatnonzero(np.isfinite(src_points).all(axis=1))
+        neighbours = min(neighbours, len(usable))
+        _, nearest = cKDTree(src_points[usable]).query(dst_points, k=neighbours)
+        index = usable[nearest.reshape(len(dst_points), neighbours)].astype(np.int64)
+        return cls(src_points, dst_points, np.shape(src_lat), np.shape(dst_lat), index)
+
+    def save(self, output_file):
+        """Write the regridder to a compressed .npz file."""
+        def write(tmp_file):
+            with open(tmp_file, 'wb') as f:
+                np.savez_compressed(f, src_points=self.src_points, dst_points=self.dst_points,
+                                    src_shape=np.array(self.src_shape), dst_shape=np.array(self.dst_shape),
+                                    index=self.index)
+        _replace_atomic(write, output_file)
+
+    @classmethod
+    def load(cls, input_file):
+        """Read a regridder written by save."""
+        with np.load(input_file) as cached:
+            return cls(cached['src_points'], cached['dst_points'], cached['src_shape'], cached['dst_shape'],
+                       cached['index'])
+
+    def __call__(self, values):
+        """Return the slices of values, shaped (..., source rows, source columns), on the target grid as float32."""
+        from scipy.spatial import cKDTree
+
+        values = np.asarray(values, dtype=np.float32)
+        lead = values.shape[:-len(self.src_shape)]
+        flat = values.reshape(-1, int(np.prod(self.src_shape)))
+        out = flat[:, self.index[:, 0]]
+
+        # Missing nearest points take the next nearest ones with values
+        missing = ~np.isfinite(out)
+        for j in range(1, self.index.shape[1]):
+            if not missing.any():
+                break
+            slices, points = np.nonzero(missing)
+            candidate = flat[slices, self.index[points, j]]
+            found = np.isfinite(candidate)
+            out[slices[found], points[found]] = candidate[found]
+            missing[slices[found], points[found]] = False
+
+        # Points with all their cached neighbours missing search the valid
+        # points of their slice, as griddata would
+        for i in np.flatnonzero(missing.any(axis=1)):
+            valid = np.isfinite(flat[i]) & np.isfinite(self.src_points).all(axis=1)
+            if not valid.any():
+                out[i] = np.nan
+                continue
+            _, nearest = cKDTree(self.src_points[valid]).query(self.dst_points[missing[i]])
+            out[i, missing[i]] = flat[i, valid][nearest]
+
+        return out.reshape(lead + self.dst_shape)
+
+
+def load_regridder(src_lat, src_lon, dst_lat, dst_lon, cache_dir=None, neighbours=DEFAULT_NEIGHBOURS):
+    """Return the NearestRegridder of a grid pair, from cache_dir when it is there, building and caching it otherwise."""
+    cfile = None
+    if cache_dir:
+        key = grid_hash(src_lat, src_lon, dst_lat, dst_lon, neighbours)
+        cfile = os.path.join(cache_dir, f"nearest_{key[:16]}.npz")
+        if os.path.exists(cfile):
+            try:
+                return NearestRegridder.load(cfile)
+            except (OSError, ValueError, KeyError) as err:
+                print(f"WARNING: Rebuilding {cfile}: {err!r}")
+
+    start = perf_counter()
+    regridder = NearestRegridder.build(src_lat, src_lon, dst_lat, dst_lon, neighbours)
+    if cfile:
+        regridder.save(cfile)
+    print(f"Built the nearest neighbour index in {perf_counter() - start:.3f} s")
+    return regridder
+
+
+def write_out(dataset, path, varname):
+    """Write a dataset with light compression, keeping the variable float32."""
+    encoding = {v: {"zlib": True, "complevel": 4} for v in dataset.data_vars}
+    encoding[varname] = {**encoding.get(varname, {}), "dtype": "float32", "_FillValue": np.float32(np.nan)}
+    _replace_atomic(lambda f: dataset.to_netcdf(f, encoding=encoding), path)
+
+
+def _coord_values(ds, dim):
+    # Values and attributes of the coordinate of a dimension, the indices
+    # when it has none, and times as seconds since 1970
+    if dim not in ds.coords:
+        return np.arange(ds.sizes[dim]), {}
+    values, attrs = ds.coords[dim].values, dict(ds.coords[dim].attrs)
+    if np.issubdtype(values.dtype, np.datetime64):
+        values = (values - np.datetime64('1970-01-01T00:00:00')) // np.timedelta64(1, 's')
+        attrs.update(units='seconds since 1970-01-01 00:00:00', calendar='standard')
+    return values, attrs
+
+
+def write_regridded(output_file, ds, da, regridder, lat_new, lon_new, steps=DEFAULT_CHUNK_STEPS,
+                    max_memory_mb=None, complevel=4):
+    """Regrid a variable chunk by chunk along its first dimension, writing each chunk to a new NetCDF file.
+
+    With max_memory_mb, the steps per chunk are those fitting in the memory
+    left under that many MB.
+    """
+    import netCDF4
+
+    varname = da.name
+    other_dims = da.dims[:-2]
+    ny, nx = len(lat_new), len(lon_new)
+    with netCDF4.Dataset(output_file, 'w') as nc:
+        for d in other_dims:
+            nc.createDimension(d, da.sizes[d])
+            values, attrs = _coord_values(ds, d)
+            coord = nc.createVariable(d, values.dtype, (d,))
+            coord.setncatts(attrs)
+            coord[:] = values
+        nc.createDimension('latitude', ny)
+        nc.createDimension('longitude', nx)
+        for name, values, units in (('latitude', lat_new, 'degrees_north'), ('longitude', lon_new, 'degrees_east')):
+            coord = nc.createVariable(name, 'f4', (name,))
+            coord.setncatts({'standard_name': name, 'units': units})
+            coord[:] = values
+
+        # One output chunk per 2-D slice, so every chunk is written whole
+        ncvar = nc.createVariable(varname, 'f4', (*other_dims, 'latitude', 'longitude'), zlib=True,
+                                  complevel=complevel, fill_value=np.float32(np.nan),
+                                  chunksizes=(1,) * len(other_dims) + (ny, nx))
+        ncvar.setncatts({k: v for k, v in da.attrs.items() if k not in ('_FillValue', 'missing_value')})
+
+        if not other_dims:
+            ncvar[:] = regridder(da.values)
+            return
+
+        # Memory of a step: its input and output as float32, plus the
+        # float32 copy and missing value masks of the gather
+        nsteps = da.sizes[other_dims[0]]
+        step_slices = int(np.prod([da.sizes[d] for d in other_dims[1:]]))
+        step_bytes = step_slices * (2 * int(np.prod(regridder.src_shape)) + 3 * ny * nx) * 4
+        steps = chunk_steps(step_bytes, max_memory_mb, steps, nsteps)
+        for t0 in range(0, nsteps, steps):
+            chunk = da.isel({other_dims[0]: slice(t0, t0 + steps)}).values
+            ncvar[t0:t0 + chunk.shape[0]] = regridder(chunk)
+
+
+def regrid_file(nc_in, nc_out, varname, latname='latitude', lonname='longitude', cache_dir=None,
+                neighbours=DEFAULT_NEIGHBOURS, steps=DEFAULT_CHUNK_STEPS, max_memory_mb=None):
+    """Write a variable of nc_in on a regular latitude-longitude grid to nc_out.
+
+    Time steps are regridded and written steps at a time, or as many as
+    fit under max_memory_mb MB when given.
+    """
+    import xarray as xr
+
+    with xr.open_dataset(nc_in) as ds:
+        if varname not in ds:
+            raise ValueError(f"{varname} not found in {nc_in}")
+        if latname not in ds or lonname not in ds:
+            raise ValueError(f"Expected variables {latname} and {lonname} in {nc_in}")
+
+        da = ds[varname]
+        latv = ds[latname]
+        lonv = ds[lonname]
+        if da.ndim < 2:
+            raise ValueError(f"{varname} must be at least 2D (row, col). Got {da.dims}")
+        row_dim, col_dim = da.dims[-2], da.dims[-1]
+
+        # 1-D lat/lon, attach them as coordinates
+        if latv.ndim == 1 and lonv.ndim == 1 and latv.dims[0] == row_dim and lonv.dims[0] == col_dim:
+            out = ds.assign_coords({
+                "latitude": (row_dim, latv.values.astype(np.float32)),
+                "longitude": (col_dim, lonv.values.astype(np.float32)),
+            }).swap_dims({row_dim: "latitude", col_dim: "longitude"})
+            out[varname] = out[varname].astype("float32")
+            out["latitude"].attrs.update(dict(standard_name="latitude", units="degrees_north"))
+            out["longitude"].attrs.update(dict(standard_name="longitude", units="degrees_east"))
+            write_out(out, nc_out, varname)
+            print(f"Wrote {nc_out} with {varname}(latitude, longitude).")
+            return
+
+        if not (latv.ndim == 2 and lonv.ndim == 2 and latv.dims == (row_dim, col_dim) and lonv.dims == (row_dim, col_dim)):
+            raise ValueError(
+                f"Unsupported shapes:\n"
+                f"  {varname} dims: {da.dims}\n"
+                f"  {latname} dims: {latv.dims}\n"
+                f"  {lonname} dims: {lonv.dims}\n"
+                "Expect 1-D lat(row) & lon(col), or 2-D lat(row,col) & lon(row,col)."
+            )
+
+        # 2-D lat/lon, regrid every slice with one nearest neighbour index
+        lat2d = np.asarray(latv.values, dtype=np.float64)
+        lon2d = np.asarray(lonv.values, dtype=np.float64)
+        lat_new, lon_new = regular_grid(lat2d, lon2d)
+        regridder = load_regridder(lat2d, lon2d, lat_new, lon_new, cache_dir, neighbours)
+
+        start = perf_counter()
+        _replace_atomic(lambda f: write_regridded(f, ds, da, regridder, lat_new, lon_new, steps, max_memory_mb),
+                        nc_out)
+        print(f"Wrote {nc_out} after regridding {varname} to regular (latitude, longitude) "
+              f"in {perf_counter() - start:.3f} s.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Regrid a CAMx/SIP variable on 2-D latitudes and longitudes '
+                                                 'to a regular latitude-longitude grid by nearest neighbour')
+    parser.add_argument('nc_in', help='Input NetCDF file')
+    parser.add_argument('nc_out', help='Output NetCDF file')
+    parser.add_argument('--var', required=True, help='Variable to regrid')
+    parser.add_argument('--lat', default='latitude', help='Latitude variable (default: latitude)')
+    parser.add_argument('--lon', default='longitude', help='Longitude variable (default: longitude)')
+    parser.add_argument('--cache-dir', help='Directory caching the nearest neighbour index of each grid pair')
+    parser.add_argument('--neighbours', type=int, default=DEFAULT_NEIGHBOURS,
+                        help=f"Nearest points kept per target point for missing values (default: {DEFAULT_NEIGHBOURS})")
+    parser.add_argument('--chunk-steps', type=int, default=DEFAULT_CHUNK_STEPS,
+                        help=f"Time steps regridded at a time (default: {DEFAULT_CHUNK_STEPS})")
+    parser.add_argument('--max-memory', type=float, metavar='MB',
+                        help='Peak memory budget in MB, setting the time steps regridded at a time')
+    args = parser.parse_args()
+
+    regrid_file(args.nc_in, args.nc_out, args.var, args.lat, args.lon, args.cache_dir, args.neighbours,
+                args.chunk_steps, args.max_memory)
+    report(os.path.basename(args.nc_out))
+
+
+if __name__ == "__main__":
+    main()
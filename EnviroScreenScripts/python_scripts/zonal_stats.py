@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+
+# Zonal statistics of gridded products (OMI, TROPOMI, CAMx SIP, EQUATES) over
+# the Colorado tract and county polygons, replacing the zonal cells of the
+# zonal_AQE_*.ipynb notebooks.
+#
+# All the statistics of a raster over a polygon layer come from a single
+# exact_extract call, so the coverage fractions of each polygon are computed
+# once instead of once per statistic.  Each polygon layer is read once, up
+# front, and shared with the processes the rasters run in.  The result is one tidy table with
+# a row per layer, FIPS, raster and statistic, which can also be written as
+# the per layer CSV files the notebooks made (FIPS, SQKM, COUNT, MEAN, ...).
+#
+# With a weights cache directory, the coverage fractions of each layer are
+# instead computed once per grid and kept on disk as sparse matrices (see
+# coverage_weights.py), and the statistics of every later raster on the
+# same grid are read off them.
+#
+# The polygons are transformed to the CRS of each raster (once per process,
+# and cached with the weights), so rasters in the native projection of the
+# model, such as the EQUATES Lambert grid, need no warp to latitude and
+# longitude first.
+#
+# Example, with the bundled tract and county shapefiles (the layers whose
+# .shp is missing are left out):
+#
+#   python zonal_stats.py zonal_2016.csv \
+#       --raster omi_no2=output_no2.tif --raster omi_ozone=output_ozone3.tif \
+#       --wide-dir output
+
+import os
+import sys
+import argparse
+import tempfile
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+
+# Statistics and the exact_extract operations computing them
+STAT_OPS = {
+    'COUNT': 'count',
+    'MEAN': 'mean',
+    'MEDIAN': 'median',
+    'STD': 'stdev',
+    'MIN': 'min',
+    'MAX': 'max',
+    'SUM': 'sum',
+}
+DEFAULT_STATS = ['COUNT', 'MEAN', 'MEDIAN', 'STD']
+
+# Polygon ID and area columns of the shapefiles
+ID_FIELD = 'FIPS'
+AREA_FIELD = 'SQKM'
+
+# Shapefiles bundled with the notebooks
+SHAPEFILE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'shapefiles')
+DEFAULT_LAYERS = {
+    'tract': os.path.join(SHAPEFILE_DIR, 'Colorado_tracts.shp'),
+    'county': os.path.join(SHAPEFILE_DIR, 'Colorado_Counties.shp'),
+}
+
+TABLE_COLUMNS = ['LAYER', ID_FIELD, AREA_FIELD, 'RASTER', 'STAT', 'VALUE']
+
+
+# Polygon layers read once per process, and their shapefiles
+_LAYERS = {}
+_LAYER_FILES = {}
+
+
+def read_layer(shapefile):
+    """Return the FIPS, area and geometry of the polygons in a shapefile."""
+    import geopandas as gpd
+
+    layer = gpd.read_file(shapefile)
+    missing = [c for c in (ID_FIELD, AREA_FIELD) if c not in layer.columns]
+    if missing:
+        raise KeyError('Columns '+', '.join(missing)+' not in '+shapefile)
+    layer[ID_FIELD] = layer[ID_FIELD].astype(str)
+    return layer[[ID_FIELD, AREA_FIELD, 'geometry']]
+
+
+def check_layers(layer_files):
+    """Raise FileNotFoundError naming the layers whose .shp is missing, before any worker reads them."""
+    if not layer_files:
+        raise FileNotFoundError('No polygon layers to use')
+    missing = [f"{name} ({shapefile})" for name, shapefile in layer_files.items() if not os.path.exists(shapefile)]
+    if missing:
+        raise FileNotFoundError('Shapefiles missing for the layers '+', '.join(missing))
+
+
+def default_layers():
+    """Return the bundled layers whose shapefiles are there, warning about the others."""
+    layers = {}
+    for name, shapefile in DEFAULT_LAYERS.items():
+        if os.path.exists(shapefile):
+            layers[name] = shapefile
+        else:
+            print(f"WARNING: Leaving out the bundled {name} layer, {shapefile} is missing")
+    return layers
+
+
+def read_layers(layer_files):
+    """Read every polygon layer, raising an error naming the layer that cannot be read."""
+    check_layers(layer_files)
+    layers = {}
+    for name, shapefile in layer_files.items():
+        try:
+            layers[name] = read_layer(shapefile)
+        except Exception as err:
+            raise RuntimeError(f"Cannot read the {name} layer {shapefile}: {err!r}") from err
+    return layers
+
+
+def _init_worker(layer_files, layers=None):
+    # Keep the polygon layers read by the parent, or read them here, once
+    # for all the rasters of this worker
+    for name, shapefile in layer_files.items():
+        _LAYERS[name] = layers[name] if layers else read_layer(shapefile)
+        _LAYER_FILES[name] = shapefile
+
+
+def zonal_frame(raster, layer, stats=DEFAULT_STATS):
+    """Return the statistics of a single band raster over a polygon layer, a column per statistic.
+
+    Every statistic comes from one exact_extract call on the raster, so the
+    polygon coverage fractions are only computed once.
+    """
+    from exactextract import exact_extract
+
+    unknown = [s for s in stats if s not in STAT_OPS]
+    if unknown:
+        raise ValueError('Unknown statistics '+', '.join(unknown))
+    ops = [STAT_OPS[s] for s in stats]
+    frame = exact_extract(raster, layer, ops, include_cols=[ID_FIELD, AREA_FIELD], output='pandas')
+    return frame.rename(columns={op: s for s, op in zip(stats, ops)})[[ID_FIELD, AREA_FIELD] + list(stats)]
+
+
+def tidy(frame, layer_name, raster_name, stats):
+    """Return a frame of zonal_frame as rows of the tidy table."""
+    table = frame.melt(id_vars=[ID_FIELD, AREA_FIELD], value_vars=list(stats), var_name='STAT', value_name='VALUE')
+    table.insert(0, 'LAYER', layer_name)
+    table.insert(3, 'RASTER', raster_name)
+    return table[TABLE_COLUMNS]
+
+
+def raster_stats(raster_name, raster, stats=DEFAULT_STATS, weights_cache=None):
+    """Return the tidy statistics of one raster over every layer of this process and the time it took.
+
+    With weights_cache, the statistics come from the coverage weights of
+    each layer on the grid of the raster cached in that directory.
+    """
+    start = perf_counter()
+    if weights_cache:
+        from coverage_weights import read_raster, load_weights
+
+        values, grid = read_raster(raster)
+        frames = {layer_name: load_weights(_LAYER_FILES[layer_name], grid, weights_cache, layer).frame(values, stats)
+                  for layer_name, layer in _LAYERS.items()}
+    else:
+        from coverage_weights import raster_crs, layer_in_crs
+
+        crs = raster_crs(raster)
+        frames = {layer_name: zonal_frame(raster, layer_in_crs(_LAYER_FILES[layer_name], layer, crs), stats)
+                  for layer_name, layer in _LAYERS.items()}
+    tables = [tidy(frame, layer_name, raster_name, stats) for layer_name, frame in frames.items()]
+    return pd.concat(tables, ignore_index=True), perf_counter() - start
+
+
+def zonal_stats(rasters, layer_files=None, stats=DEFAULT_STATS, num_workers=None, weights_cache=None):
+    """Return the tidy table of the statistics of every raster over every polygon layer.
+
+    rasters maps a raster name to its file and layer_files a layer name to
+    its shapefile (the bundled tracts and counties that are there by
+    default), which must all exist.  The rasters
+    run in num_workers processes, all cores by default.  Rasters that fail
+    are reported and left out, and their names are returned with the table.
+    weights_cache is the directory of the cached coverage weights, which
+    are used instead of exact_extract when given.
+    """
+    # The layers are read here first, so that a layer that cannot be read
+    # stops the run with its own error rather than break the worker pool
+    layer_files = layer_files or default_layers()
+    layers = read_layers(layer_files)
+    num_workers = num_workers or os.cpu_count()
+
+    tables = []
+    failed = []
+    with ProcessPoolExecutor(max_workers=min(num_workers, max(len(rasters), 1)),
+                             initializer=_init_worker, initargs=(layer_files, layers)) as pool:
+        futures = {pool.submit(raster_stats, name, raster, list(stats), weights_cache): name
+                   for name, raster in rasters.items()}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                table, execution_time = future.result()
+                tables.append(table)
+                print(f"{name} in {execution_time:.3f} s")
+            except Exception as err:
+                failed.append(name)
+                print(f"ERROR: {name} failed: {err!r}")
+
+    if not tables:
+        return pd.DataFrame(columns=TABLE_COLUMNS), failed
+    # Keep the rasters and layers in the order given
+    table = pd.concat(tables, ignore_index=True)
+    order = {name: i for i, name in enumerate(rasters)}
+    table = table.sort_values('RASTER', key=lambda r: r.map(order), kind='stable')
+    return table.reset_index(drop=True), failed
+
+
+def _replace_atomic(write, output_file):
+    # Write to a temporary file and rename it, so a failed run never leaves
+    # a partial table behind
+    output_dir = os.path.dirname(os.path.abspath(output_file))
+    os.makedirs(output_dir, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=output_dir, suffix='.tmp')
+    os.close(fd)
+    try:
+        write(tmp_file)
+        os.chmod(tmp_file, 0o644)
+        os.replace(tmp_file, output_file)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+
+
+def write_table(table, output_file):
+    """Write a table as Parquet when the file name ends in .parquet and as CSV otherwise."""
+    if output_file.endswith('.parquet'):
+        _replace_atomic(lambda f: table.to_parquet(f, index=False), output_file)
+    else:
+        _replace_atomic(lambda f: table.to_csv(f, index=False), output_file)
+
+
+def write_wide(table, output_dir, stats=DEFAULT_STATS):
+    """Write a CSV per raster and layer with the columns of the notebooks, FIPS, SQKM and the statistics."""
+    written = []
+    for (raster_name, layer_name), rows in table.groupby(['RASTER', 'LAYER'], sort=False):
+        wide = rows.pivot(index=[ID_FIELD, AREA_FIELD], columns='STAT', values='VALUE')
+        wide = wide.reindex(columns=list(stats)).reset_index()
+        output_file = os.path.join(output_dir, f"{raster_name}_{layer_name}.csv")
+        write_table(wide, output_file)
+        written.append(output_file)
+    return written
+
+
+def _named_files(values, what):
+    # NAME=PATH pairs, or a path named after its file
+    named = {}
+    for value in values:
+        name, sep, path = value.partition('=')
+        if not sep:
+            name, path = os.path.splitext(os.path.basename(value))[0], value
+        if name in named:
+            raise ValueError(f"{what} name {name} given twice")
+        named[name] = path
+    return named
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Zonal statistics of rasters over the tract and county polygons, '
+                                                 'written as one table keyed by FIPS')
+    parser.add_argument('output', help='Output table, .csv or .parquet')
+    parser.add_argument('--raster', action='append', required=True, metavar='[NAME=]PATH',
+                        help='Single band raster, named after its file by default (repeatable)')
+    parser.add_argument('--layer', action='append', metavar='NAME=SHAPEFILE',
+                        help='Polygon layer with FIPS and SQKM columns (repeatable), '
+                             'the bundled tracts and counties by default')
+    parser.add_argument('--stats', default=','.join(DEFAULT_STATS),
+                        help='Comma separated statistics, from '+', '.join(STAT_OPS))
+    parser.add_argument('--num-workers', type=int, help='Rasters processed at once, all cores by default')
+    parser.add_argument('--wide-dir', help='Also write a RASTER_LAYER.csv per raster and layer here')
+    parser.add_argument('--weights-cache', help='Directory caching the coverage weights of each layer and grid, '
+                                                'used instead of exact_extract when given')
+    args = parser.parse_args()
+
+    rasters = _named_files(args.raster, 'Raster')
+    layer_files = _named_files(args.layer, 'Layer') if args.layer else default_layers()
+    try:
+        check_layers(layer_files)
+    except FileNotFoundError as err:
+        parser.error(str(err))
+    stats = [s.strip().upper() for s in args.stats.split(',') if s.strip()]
+    unknown = [s for s in stats if s not in STAT_OPS]
+    if unknown:
+        parser.error('Unknown statistics '+', '.join(unknown))
+
+    start = perf_counter()
+    try:
+        table, failed = zonal_stats(rasters, layer_files, stats, args.num_workers, args.weights_cache)
+    except (FileNotFoundError, RuntimeError) as err:
+        print(f"ERROR: {err}")
+        sys.exit(1)
+    write_table(table, args.output)
+    print(f"Wrote {len(table)} rows to {args.output}")
+    if args.wide_dir:
+        for output_file in write_wide(table, args.wide_dir, stats):
+            print(f"Wrote {output_file}")
+    print(f"Zonal statistics of {len(rasters) - len(failed)} rasters in {perf_counter() - start:.3f} s")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+# Time series of zonal statistics straight from gridded NetCDF files (EQUATES
+# and CAMx IOAPI files, WRF output, regular lat-lon products), in the native
+# grid of the file with the polygons transformed to it, without the GeoTIFF of
+# each time step made by zonal_AQE_EQUATE.ipynb and zonal_AQE_SIP.ipynb.
+#
+# Each variable is read a few time steps at a time (and for the selected
+# vertical layers only) from the source file, and every slice of a chunk is
+# aggregated at once with the cached coverage weights of coverage_weights.py.
+# The rows of each chunk are appended to one long table with a row per
+# polygon layer, FIPS, variable, time, model layer and statistic, so memory
+# is bounded by a chunk and the source is read once.  The time steps per
+# chunk can be set, or derived from a peak memory budget, and the peak
+# resident size is reported at the end.
+#
+# Example, daily EQUATES values over the bundled tracts and counties:
+#
+#   python zonal_timeseries.py equates_2019.parquet EQUATES_12US1_2019.nc \
+#       --var O3_MDA8 --var PM25_AVG --layer tract=Colorado_tracts.shp \
+#       --layer county=Colorado_Counties.shp
+
+import os
+import sys
+import argparse
+import tempfile
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+from zonal_stats import (ID_FIELD, AREA_FIELD, DEFAULT_STATS, STAT_OPS,
+                         default_layers, read_layers, _named_files)
+from coverage_weights import load_weights
+from grids import dataset_grid, is_ioapi, ioapi_times, wrf_times
+from memory_use import chunk_steps as budget_steps, report
+
+
+TABLE_COLUMNS = ['LAYER', ID_FIELD, AREA_FIELD, 'VARIABLE', 'TIME', 'LAY', 'STAT', 'VALUE']
+
+# Time steps read and aggregated at a time
+DEFAULT_CHUNK_STEPS = 24
+
+# Approximate memory of a row of the long table while it is built and written
+ROW_BYTES = 200
+
+TIME_DIMS = ['TSTEP', 'time', 'Time']
+LAY_DIMS = ['LAY', 'bottom_top', 'lev', 'z']
+
+
+def _find_dim(dims, names, given=None):
+    if given:
+        if given not in dims:
+            raise ValueError(f"No dimension {given}")
+        return given
+    return next((d for d in names if d in dims), None)
+
+
+def slice_times(ds, da, time_dim):
+    """Return the times of the steps of a variable, or their indices when the file has none."""
+    if time_dim is None:
+        return pd.DatetimeIndex([pd.NaT])
+    if is_ioapi(ds):
+        return ioapi_times(ds, time_dim)
+    if 'Times' in ds.variables:
+        return wrf_times(ds)
+    if time_dim in da.coords and np.issubdtype(da[time_dim].dtype, np.datetime64):
+        return pd.DatetimeIndex(da[time_dim].values)
+    return pd.RangeIndex(da.sizes[time_dim])
+
+
+def iter_chunks(da, grid_dims, time_dim=None, lay_dim=None, lays=None, chunk_steps=DEFAULT_CHUNK_STEPS):
+    """Yield the first step and the values of each chunk of time steps of a variable.
+
+    The values are float64 with NaN where missing, shaped (steps, layers,
+    rows, columns).  Only the selected layers of each chunk are read.
+    """
+    other = [d for d in da.dims if d not in (time_dim, lay_dim) + tuple(grid_dims)]
+    if other:
+        raise ValueError(f"{da.name} has dimensions {', '.join(other)} besides time, layer and grid")
+    if lay_dim is not None and lays is not None:
+        da = da.isel({lay_dim: list(lays)})
+    nsteps = da.sizes[time_dim] if time_dim else 1
+    for t0 in range(0, nsteps, chunk_steps):
+        chunk = da.isel({time_dim: slice(t0, t0 + chunk_steps)}) if time_dim else da
+        values = chunk.transpose(*[d for d in (time_dim, lay_dim) if d] + list(grid_dims)).values
+        values = np.asarray(values, dtype=np.float64)
+        if not time_dim:
+            values = values[np.newaxis]
+        if not lay_dim:
+            values = values[:, np.newaxis]
+        yield t0, values
+
+
+def chunk_table(weights, values, layer_name, var, times, lays, stats):
+    """Return the long table rows of the statistics of a chunk, values shaped as from iter_chunks."""
+    nsteps, nlays = values.shape[:2]
+    result = weights.stats(values.reshape((nsteps * nlays,) + values.shape[2:]), stats)
+    npoly = len(weights.ids)
+    nslices = nsteps * nlays
+
+    # Rows by statistic, then time, then model layer, then polygon
+    frame = pd.DataFrame({
+        'LAYER': layer_name,
+        ID_FIELD: np.tile(weights.ids, nslices * len(stats)),
+        AREA_FIELD: np.tile(weights.area, nslices * len(stats)),
+        'VARIABLE': var,
+        'TIME': np.tile(np.repeat(np.asarray(times), nlays * npoly), len(stats)),
+        'LAY': np.tile(np.repeat(np.asarray(lays), npoly), nsteps * len(stats)),
+        'STAT': np.repeat(list(stats), nslices * npoly),
+        'VALUE': np.concatenate([result[s].T.ravel() for s in stats]),
+    })
+    return frame[TABLE_COLUMNS]
+
+
+class TableWriter:
+    """Long table written a chunk at a time, as Parquet when the file name ends in .parquet and CSV otherwise.
+
+    The rows go to a temporary file that replaces the output when closed,
+    so a failed run never leaves a partial table behind.
+    """
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+        output_dir = os.path.dirname(os.path.abspath(output_file))
+        os.makedirs(output_dir, exist_ok=True)
+        fd, self.tmp_file = tempfile.mkstemp(dir=output_dir, suffix='.tmp')
+        os.close(fd)
+        self.parquet = output_file.endswith('.parquet')
+        self._writer = None
+        self._schema = None
+        self.rows = 0
+
+    def write(self, frame):
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+            if self._writer is None:
+                self._schema = table.schema
+                self._writer = pq.ParquetWriter(self.tmp_file, self._schema, compression='zstd')
+            self._writer.write_table(table.cast(self._schema))
+        else:
+            frame.to_csv(self.tmp_file, mode='a', header=self.rows == 0, index=False)
+        self.rows += len(frame)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        elif self.parquet:
+            pd.DataFrame(columns=TABLE_COLUMNS).to_parquet(self.tmp_file, index=False)
+        elif self.rows == 0:
+            pd.DataFrame(columns=TABLE_COLUMNS).to_csv(self.tmp_file, index=False)
+        os.chmod(self.tmp_file, 0o644)
+        os.replace(self.tmp_file, self.output_file)
+
+    def abort(self):
+        if self._writer is not None:
+            self._writer.close()
+        os.remove(self.tmp_file)
+
+
+def step_bytes(grid, nlays, weights, stats):
+    """Return the approximate memory needed to aggregate one time step."""
+    # The float64 values, their mask, filled and squared copies, and the rows
+    ncells = int(np.prod(grid.shape))
+    npoly = sum(len(w.ids) for w in weights.values())
+    return nlays * (4 * 8 * ncells + npoly * len(stats) * ROW_BYTES)
+
+
+def aggregate_file(nc_file, variables, layers, writer, weights_cache, stats=DEFAULT_STATS,
+                   time_dim=None, lay_dim=None, lays=None, chunk_steps=DEFAULT_CHUNK_STEPS, max_memory_mb=None):
+    """Append the zonal statistics of every time step of variables in a NetCDF file to writer.
+
+    layers maps a layer name to its shapefile and the layer read with
+    read_layer.  lays selects model layers by index, the first one by
+    default as in the notebooks, or all of them with 'all'.  Time steps are
+    read chunk_steps at a time, or as many as fit under max_memory_mb MB
+    when given.
+    """
+    import xarray as xr
+
+    with xr.open_dataset(nc_file, mask_and_scale=True) as ds:
+        for var in variables:
+            start = perf_counter()
+            da = ds[var]
+            grid, grid_dims = dataset_grid(ds, var)
+            tdim = _find_dim(da.dims, TIME_DIMS, time_dim)
+            ldim = _find_dim(da.dims, LAY_DIMS, lay_dim)
+            var_lays = None
+            if ldim:
+                var_lays = list(range(da.sizes[ldim])) if lays == 'all' else list(lays or [0])
+            times = slice_times(ds, da, tdim)
+            weights = {name: load_weights(shapefile, grid, weights_cache, layer)
+                       for name, (shapefile, layer) in layers.items()}
+            steps = budget_steps(step_bytes(grid, len(var_lays or [0]), weights, stats), max_memory_mb,
+                                 chunk_steps, len(times))
+
+            for t0, values in iter_chunks(da, grid_dims, tdim, ldim, var_lays, steps):
+                chunk_times = times[t0:t0 + values.shape[0]]
+                for name, w in weights.items():
+                    writer.write(chunk_table(w, values, name, var, chunk_times, var_lays or [0], stats))
+            print(f"{os.path.basename(nc_file)} {var}: {len(times)} steps in {perf_counter() - start:.3f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Zonal statistics of every time step of NetCDF variables, '
+                                                 'written as one long table of FIPS, time and statistic')
+    parser.add_argument('output', help='Output table, .csv or .parquet')
+    parser.add_argument('nc_files', nargs='+', help='IOAPI, wrfout or regular lat-lon NetCDF files')
+    parser.add_argument('--var', action='append', required=True, help='Variable to aggregate (repeatable)')
+    parser.add_argument('--layer', action='append', metavar='NAME=SHAPEFILE',
+                        help='Polygon layer with FIPS and SQKM columns (repeatable), '
+                             'the bundled tracts and counties by default')
+    parser.add_argument('--stats', default=','.join(DEFAULT_STATS),
+                        help='Comma separated statistics, from '+', '.join(STAT_OPS))
+    parser.add_argument('--time-dim', help='Time dimension, TSTEP or time by default')
+    parser.add_argument('--lay-dim', help='Vertical layer dimension, LAY by default')
+    parser.add_argument('--lays', default='0',
+                        help='Comma separated model layer indices, or all (default: 0)')
+    parser.add_argument('--chunk-steps', type=int, default=DEFAULT_CHUNK_STEPS,
+                        help=f"Time steps read at a time (default: {DEFAULT_CHUNK_STEPS})")
+    parser.add_argument('--max-memory', type=float, metavar='MB',
+                        help='Peak memory budget in MB, setting the time steps read at a time')
+    parser.add_argument('--weights-cache',
+                        help='Directory caching the coverage weights, coverage_weights next to the output by default')
+    args = parser.parse_args()
+
+    stats = [s.strip().upper() for s in args.stats.split(',') if s.strip()]
+    unknown = [s for s in stats if s not in STAT_OPS]
+    if unknown:
+        parser.error('Unknown statistics '+', '.join(unknown))
+    lays = 'all' if args.lays.strip() == 'all' else [int(i) for i in args.lays.split(',')]
+    weights_cache = args.weights_cache or os.path.join(os.path.dirname(os.path.abspath(args.output)),
+                                                       'coverage_weights')
+
+    layer_files = _named_files(args.layer, 'Layer') if args.layer else default_layers()
+    try:
+        layers = {name: (layer_files[name], layer) for name, layer in read_layers(layer_files).items()}
+    except (FileNotFoundError, RuntimeError) as err:
+        print(f"ERROR: {err}")
+        sys.exit(1)
+
+    start = perf_counter()
+    writer = TableWriter(args.output)
+    try:
+        for nc_file in args.nc_files:
+            aggregate_file(nc_file, args.var, layers, writer, weights_cache, stats,
+                           args.time_dim, args.lay_dim, lays, args.chunk_steps, args.max_memory)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    print(f"Wrote {writer.rows} rows to {args.output} in {perf_counter() - start:.3f} s")
+    report(os.path.basename(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# Block writes of geotiff_writer.py into a stand-in for an open rasterio
+# dataset, so that masked sources can be checked without GDAL.
+
+import os
+import sys
+import types
+from collections import namedtuple
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'python_scripts'))
+from geotiff_writer import write_blocks
+
+
+NODATA = -9999.0
+
+
+class ArrayDataset:
+    """Band 1 of a rasterio dataset, kept in an array."""
+
+    def __init__(self, shape):
+        self.band = np.zeros(shape, dtype=np.float32)
+
+    def write(self, block, band, window):
+        self.band[window.row_off:window.row_off + window.height, window.col_off:window.col_off + window.width] = block
+
+
+@pytest.fixture(autouse=True)
+def windows(monkeypatch):
+    # write_blocks only needs rasterio.windows.Window
+    try:
+        import rasterio.windows  # noqa: F401
+    except ImportError:
+        module = types.ModuleType('rasterio.windows')
+        module.Window = namedtuple('Window', 'col_off row_off width height')
+        monkeypatch.setitem(sys.modules, 'rasterio', types.ModuleType('rasterio'))
+        monkeypatch.setitem(sys.modules, 'rasterio.windows', module)
+
+
+def expected(values, mask, flip):
+    out = np.where(mask, NODATA, values).astype(np.float32)
+    return out[::-1] if flip else out
+
+
+def masked_values(shape=(37, 23), seed=0):
+    rng = np.random.default_rng(seed)
+    values = rng.uniform(1., 2., shape)
+    mask = rng.random(shape) < 0.2
+    return values, mask
+
+
+@pytest.mark.parametrize('flip', [False, True])
+def test_masked_array(flip):
+    values, mask = masked_values()
+    source = np.ma.masked_array(np.where(mask, -1., values), mask=mask)
+    dst = ArrayDataset(values.shape)
+    write_blocks(dst, source, values.shape, flip, nodata=NODATA, blocksize=16)
+    np.testing.assert_array_equal(dst.band, expected(values, mask, flip))
+
+
+@pytest.mark.parametrize('flip', [False, True])
+def test_netcdf_fill_value(tmp_path, flip):
+    netCDF4 = pytest.importorskip('netCDF4')
+
+    values, mask = masked_values()
+    with netCDF4.Dataset(tmp_path / 'fill.nc', 'w') as ncout:
+        ncout.createDimension('y', values.shape[0])
+        ncout.createDimension('x', values.shape[1])
+        ncvar = ncout.createVariable('v', 'f4', ('y', 'x'), fill_value=-1.)
+        ncvar[:] = np.ma.masked_array(values, mask=mask)
+
+    dst = ArrayDataset(values.shape)
+    with netCDF4.Dataset(tmp_path / 'fill.nc') as ncin:
+        write_blocks(dst, ncin['v'], values.shape, flip, nodata=NODATA, blocksize=16)
+    np.testing.assert_array_equal(dst.band, expected(values.astype(np.float32), mask, flip))
+
+
+def test_source_left_unchanged():
+    values, mask = masked_values()
+    source = np.where(mask, np.nan, values).astype(np.float32)
+    before = source.copy()
+    dst = ArrayDataset(values.shape)
+    write_blocks(dst, source, values.shape, nodata=NODATA, blocksize=16)
+    np.testing.assert_array_equal(source, before)
+    np.testing.assert_array_equal(dst.band, expected(values, mask, False))
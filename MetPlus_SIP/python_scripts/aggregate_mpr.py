@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+
+# Aggregate MPR lines into CNT and VCNT statistics, like the STAT-Analysis
+# aggregate_stat jobs with -line_type MPR, for any grouping.
+#
+# The MPR .stat files are read once (optionally through the stat_reader
+# Parquet cache) into one table, and each job groups it by its -by columns
+# and computes the statistics for all groups at once with pandas group
+# sums, so a new grouping does not mean re-running stat_analysis over all
+# the point_stat output.  Besides MPR columns, the groups can use
+#   FCST_VALID_HOUR, FCST_VALID_DATE  from FCST_VALID_BEG
+#   OBS_ELV_BAND                      OBS_ELV rounded down to --elv-band-width
+# and any column of a --station-table CSV joined on OBS_SID (e.g. NETWORK).
+#
+# The output is a .stat file with a header line, like stat_analysis -out_stat
+# writes, which plot_bias_stations.py, stat_reader.py, and the reformat step
+# can read.  Header columns hold the value shared by a group, or the
+# comma separated values when they differ, and FCST_VALID_BEG/END and
+# OBS_VALID_BEG/END the first and last times.  Bootstrap confidence limits
+# are NA, as with stat_analysis without bootstrapping, and so are the rank
+# correlations and the climatology statistics.
+#
+# For example STAT_ANALYSIS_JOB2 and JOB7 are
+#   aggregate_mpr.py <AllVars MPR dump> --job CNT FCST_VAR,OBS_SID <out>_CNT.stat \
+#       --job VCNT FCST_VAR,OBS_SID <out>_VCNT.stat --set-hdr VX_MASK=OBS_SID
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from stat_reader import HEADER_COLUMNS, read_stat
+
+
+# MPR columns read
+MPR_COLUMNS = [c for c in HEADER_COLUMNS if c not in ('ALPHA', 'LINE_TYPE')] + \
+              ['OBS_SID', 'OBS_LAT', 'OBS_LON', 'OBS_LVL', 'OBS_ELV', 'FCST', 'OBS']
+
+
+def _with_ci(names, ci):
+    return [n+s for n in names for s in [''] + ci]
+
+
+CNT_COLUMNS = (
+    ['TOTAL'] +
+    _with_ci(['FBAR', 'FSTDEV', 'OBAR', 'OSTDEV', 'PR_CORR'], ['_NCL', '_NCU', '_BCL', '_BCU']) +
+    ['SP_CORR', 'KT_CORR', 'RANKS', 'FRANK_TIES', 'ORANK_TIES'] +
+    _with_ci(['ME', 'ESTDEV'], ['_NCL', '_NCU', '_BCL', '_BCU']) +
+    _with_ci(['MBIAS', 'MAE', 'MSE', 'BCMSE', 'RMSE', 'E10', 'E25', 'E50', 'E75', 'E90', 'EIQR', 'MAD'],
+             ['_BCL', '_BCU']) +
+    _with_ci(['ANOM_CORR'], ['_NCL', '_NCU', '_BCL', '_BCU']) +
+    _with_ci(['ME2', 'MSESS', 'RMSFA', 'RMSOA', 'ANOM_CORR_UNCNTR', 'SI'], ['_BCL', '_BCU'])
+)
+
+VCNT_COLUMNS = (
+    ['TOTAL'] +
+    _with_ci(['FBAR', 'OBAR', 'FS_RMS', 'OS_RMS', 'MSVE', 'RMSVE', 'FSTDEV', 'OSTDEV', 'FDIR', 'ODIR',
+              'FBAR_SPEED', 'OBAR_SPEED', 'VDIFF_SPEED', 'VDIFF_DIR', 'SPEED_ERR', 'SPEED_ABSERR',
+              'DIR_ERR', 'DIR_ABSERR'], ['_BCL', '_BCU']) +
+    _with_ci(['ANOM_CORR'], ['_NCL', '_NCU', '_BCL', '_BCU']) +
+    _with_ci(['ANOM_CORR_UNCNTR'], ['_BCL', '_BCU']) +
+    ['TOTAL_DIR'] +
+    _with_ci(['DIR_ME', 'DIR_MAE', 'DIR_MSE', 'DIR_RMSE'], ['_BCL', '_BCU'])
+)
+
+LINE_TYPE_COLUMNS = {'CNT': CNT_COLUMNS, 'VCNT': VCNT_COLUMNS}
+
+# Integer statistics columns
+COUNT_COLUMNS = {'TOTAL', 'RANKS', 'FRANK_TIES', 'ORANK_TIES', 'TOTAL_DIR'}
+
+# Columns that identify a wind pair, matching the UGRD and VGRD lines of
+# one observation
+WIND_PAIR_COLUMNS = ['MODEL', 'DESC', 'FCST_LEAD', 'FCST_VALID_BEG', 'FCST_VALID_END', 'OBS_LEAD',
+                     'OBS_VALID_BEG', 'OBS_VALID_END', 'FCST_LEV', 'OBS_LEV', 'OBTYPE', 'VX_MASK',
+                     'INTERP_MTHD', 'INTERP_PNTS', 'OBS_SID', 'OBS_LAT', 'OBS_LON', 'OBS_LVL', 'OBS_ELV']
+
+DEFAULT_ALPHA = 0.05
+DEFAULT_ELV_BAND_WIDTH = 500.
+
+
+def read_mpr(mpr_files, filters=None, cache=False):
+    """Read MPR .stat files into one table, dropping pairs with missing values."""
+    frames = [read_stat(mpr_file, columns=MPR_COLUMNS, filters=filters, cache=cache) for mpr_file in mpr_files]
+    mpr = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+    mpr = mpr.loc[mpr['FCST'].notna() & mpr['OBS'].notna()].reset_index(drop=True)
+    # Header columns are grouped and written as text
+    mpr['INTERP_PNTS'] = mpr['INTERP_PNTS'].astype('Int64').astype(str).replace('<NA>', 'NA')
+    return mpr
+
+
+def add_keys(mpr, by, elv_band_width=DEFAULT_ELV_BAND_WIDTH, stations=None):
+    """Add the derived grouping columns in by that are not MPR columns."""
+    if 'FCST_VALID_HOUR' in by:
+        mpr['FCST_VALID_HOUR'] = mpr['FCST_VALID_BEG'].str.slice(9, 11)
+    if 'FCST_VALID_DATE' in by:
+        mpr['FCST_VALID_DATE'] = mpr['FCST_VALID_BEG'].str.slice(0, 8)
+    if 'OBS_ELV_BAND' in by:
+        band = np.floor(mpr['OBS_ELV'] / elv_band_width) * elv_band_width
+        mpr['OBS_ELV_BAND'] = band.map('{:g}'.format)
+    if stations is not None:
+        extra = [c for c in by if c in stations.columns and c not in mpr.columns]
+        if extra:
+            mpr = mpr.merge(stations[['OBS_SID'] + extra].drop_duplicates('OBS_SID'), on='OBS_SID', how='left')
+            mpr[extra] = mpr[extra].fillna('NA').astype(str)
+    missing = [c for c in by if c not in mpr.columns]
+    if missing:
+        raise KeyError('Unknown -by columns '+', '.join(missing))
+    return mpr
+
+
+def group_header(frame, by, line_type, alpha, set_hdr=None):
+    """Return the header columns of each group."""
+    frame = frame.reset_index(drop=True)
+    keys = [frame[c] for c in by]
+    header = pd.DataFrame(index=frame.groupby(keys, sort=True).size().index)
+    for column in HEADER_COLUMNS:
+        if column == 'ALPHA':
+            header[column] = '{:.5f}'.format(alpha)
+            continue
+        if column == 'LINE_TYPE':
+            header[column] = line_type
+            continue
+        if column in by:
+            header[column] = header.index.get_level_values(column)
+            continue
+
+        # Work on sorted codes of the text values, which group much faster
+        codes, uniques = pd.factorize(frame[column], sort=True)
+        grouped = pd.Series(codes).groupby(keys, sort=True)
+        if column.endswith('_VALID_BEG'):
+            header[column] = uniques[grouped.min().to_numpy()]
+        elif column.endswith('_VALID_END'):
+            header[column] = uniques[grouped.max().to_numpy()]
+        else:
+            # The shared value, or the values in order of appearance
+            values = pd.Series(uniques[grouped.first().to_numpy()], index=header.index, dtype=object)
+            several = (grouped.nunique() > 1).to_numpy()
+            if several.any():
+                uniq = frame[by + [column]].drop_duplicates()
+                joined = uniq.groupby(by, sort=True)[column].agg(','.join)
+                values[several] = joined.reindex(header.index[several]).to_numpy()
+            header[column] = values.to_numpy()
+
+    # -set_hdr: a -by column name sets the column to the group's value
+    for column, value in (set_hdr or {}).items():
+        if value in by:
+            header[column] = header.index.get_level_values(value)
+        else:
+            header[column] = value
+    return header
+
+
+def _mean_ci(mean, stdev, n, alpha):
+    # Normal confidence limits of a mean, with the t distribution for
+    # fewer than 30 values
+    cv = np.where(n >= 30, stats.norm.ppf(1 - alpha/2), stats.t.ppf(1 - alpha/2, np.maximum(n - 1, 1)))
+    half = cv * stdev / np.sqrt(n)
+    return mean - half, mean + half
+
+
+def _stdev_ci(stdev, n, alpha):
+    # Chi-square confidence limits of a standard deviation
+    dof = np.maximum(n - 1, 1)
+    var = stdev**2 * dof
+    return np.sqrt(var / stats.chi2.ppf(1 - alpha/2, dof)), np.sqrt(var / stats.chi2.ppf(alpha/2, dof))
+
+
+def _corr_ci(corr, n, alpha):
+    # Fisher z confidence limits of a correlation
+    cv = stats.norm.ppf(1 - alpha/2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = np.arctanh(np.clip(corr, -1, 1))
+        half = cv / np.sqrt(n - 3)
+        return np.tanh(z - half), np.tanh(z + half)
+
+
+def _ratio(num, den):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(den == 0, np.nan, num / den)
+
+
+def cnt_stats(frame, by, alpha=DEFAULT_ALPHA):
+    """Return the CNT statistics of each group of MPR lines."""
+    frame = frame.reset_index(drop=True)
+    f = frame['FCST'].to_numpy(np.float64)
+    o = frame['OBS'].to_numpy(np.float64)
+    e = f - o
+    keys = [frame[c] for c in by]
+    pairs = pd.DataFrame({'F': f, 'O': o, 'E': e, 'AE': np.abs(e), 'EE': e*e})
+    grouped = pairs.groupby(keys, sort=True)
+
+    n = grouped.size().to_numpy(np.float64)
+    means = grouped[['F', 'O', 'E', 'AE', 'EE']].mean()
+    stdevs = grouped[['F', 'O', 'E']].std(ddof=1)
+
+    # Correlation from the deviations from the group means
+    fc = f - grouped['F'].transform('mean').to_numpy()
+    oc = o - grouped['O'].transform('mean').to_numpy()
+    sums = pd.DataFrame({'FO': fc*oc, 'FF': fc*fc, 'OO': oc*oc}).groupby(keys, sort=True).sum()
+    pr_corr = _ratio(sums['FO'].to_numpy(), np.sqrt(sums['FF'].to_numpy() * sums['OO'].to_numpy()))
+
+    # Error percentiles and the median absolute deviation
+    pct = grouped['E'].quantile([0.1, 0.25, 0.5, 0.75, 0.9]).unstack()
+    ad = np.abs(e - grouped['E'].transform('median').to_numpy())
+    mad = pd.Series(ad).groupby(keys, sort=True).median().to_numpy()
+
+    out = pd.DataFrame(index=means.index, columns=CNT_COLUMNS, dtype=np.float64)
+    fbar, obar, me = means['F'].to_numpy(), means['O'].to_numpy(), means['E'].to_numpy()
+    fstdev, ostdev, estdev = stdevs['F'].to_numpy(), stdevs['O'].to_numpy(), stdevs['E'].to_numpy()
+    mse = means['EE'].to_numpy()
+    ovar = np.maximum(stdevs['O'].to_numpy()**2 * (n - 1) / n, 0)
+
+    out['TOTAL'] = n
+    out['FBAR'] = fbar
+    out['FBAR_NCL'], out['FBAR_NCU'] = _mean_ci(fbar, fstdev, n, alpha)
+    out['FSTDEV'] = fstdev
+    out['FSTDEV_NCL'], out['FSTDEV_NCU'] = _stdev_ci(fstdev, n, alpha)
+    out['OBAR'] = obar
+    out['OBAR_NCL'], out['OBAR_NCU'] = _mean_ci(obar, ostdev, n, alpha)
+    out['OSTDEV'] = ostdev
+    out['OSTDEV_NCL'], out['OSTDEV_NCU'] = _stdev_ci(ostdev, n, alpha)
+    out['PR_CORR'] = pr_corr
+    out['PR_CORR_NCL'], out['PR_CORR_NCU'] = _corr_ci(pr_corr, n, alpha)
+    out['RANKS'] = 0
+    out['FRANK_TIES'] = 0
+    out['ORANK_TIES'] = 0
+    out['ME'] = me
+    out['ME_NCL'], out['ME_NCU'] = _mean_ci(me, estdev, n, alpha)
+    out['ESTDEV'] = estdev
+    out['ESTDEV_NCL'], out['ESTDEV_NCU'] = _stdev_ci(estdev, n, alpha)
+    out['MBIAS'] = _ratio(fbar, obar)
+    out['MAE'] = means['AE'].to_numpy()
+    out['MSE'] = mse
+    out['BCMSE'] = mse - me**2
+    out['RMSE'] = np.sqrt(mse)
+    for p, column in zip(pct.columns, ['E10', 'E25', 'E50', 'E75', 'E90']):
+        out[column] = pct[p].to_numpy()
+    out['EIQR'] = out['E75'] - out['E25']
+    out['MAD'] = mad
+    out['ME2'] = me**2
+    out['MSESS'] = 1 - _ratio(mse, ovar)
+    out['SI'] = _ratio(np.sqrt(mse), obar)
+
+    # Limits need enough values
+    out.loc[n < 2, ['FBAR_NCL', 'FBAR_NCU', 'OBAR_NCL', 'OBAR_NCU', 'ME_NCL', 'ME_NCU']] = np.nan
+    out.loc[n < 4, ['PR_CORR_NCL', 'PR_CORR_NCU']] = np.nan
+    return out
+
+
+def wind_dir(u, v):
+    """Return the direction the wind blows from, in degrees."""
+    return np.mod(np.degrees(np.arctan2(u, v)) + 180, 360)
+
+
+def _dir_diff(d):
+    # Wrap a direction difference to -180 to 180 degrees
+    return np.mod(d + 180, 360) - 180
+
+
+def pair_winds(frame):
+    """Return the UGRD and VGRD lines of each observation joined into one line.
+
+    FCST and OBS hold the u components and VFCST and VOBS the v components.
+    FCST_VAR and OBS_VAR are set to UGRD_VGRD.
+    """
+    u = frame.loc[frame['FCST_VAR'].eq('UGRD')]
+    v = frame.loc[frame['FCST_VAR'].eq('VGRD')]
+
+    # Pair repeated observations in order
+    keys = [c for c in WIND_PAIR_COLUMNS if c in frame.columns]
+    u = u.assign(PAIR_INDEX=u.groupby(keys, sort=False, dropna=False).cumcount())
+    v = v.assign(PAIR_INDEX=v.groupby(keys, sort=False, dropna=False).cumcount())
+    v = v[keys + ['PAIR_INDEX', 'FCST', 'OBS']].rename(columns={'FCST': 'VFCST', 'OBS': 'VOBS'})
+    winds = u.merge(v, on=keys + ['PAIR_INDEX'], how='inner').drop(columns='PAIR_INDEX')
+    winds['FCST_VAR'] = 'UGRD_VGRD'
+    winds['OBS_VAR'] = 'UGRD_VGRD'
+    return winds
+
+
+def vcnt_stats(winds, by):
+    """Return the VCNT statistics of each group of wind pairs from pair_winds."""
+    winds = winds.reset_index(drop=True)
+    uf = winds['FCST'].to_numpy(np.float64)
+    vf = winds['VFCST'].to_numpy(np.float64)
+    uo = winds['OBS'].to_numpy(np.float64)
+    vo = winds['VOBS'].to_numpy(np.float64)
+    fspd = np.hypot(uf, vf)
+    ospd = np.hypot(uo, vo)
+
+    # Direction errors of the pairs where neither wind is calm
+    has_dir = (fspd > 0) & (ospd > 0)
+    dir_err = np.where(has_dir, _dir_diff(wind_dir(uf, vf) - wind_dir(uo, vo)), np.nan)
+
+    keys = [winds[c] for c in by]
+    pairs = pd.DataFrame({
+        'UF': uf, 'VF': vf, 'UO': uo, 'VO': vo, 'FSPD': fspd, 'OSPD': ospd,
+        'FF': uf*uf + vf*vf, 'OO': uo*uo + vo*vo, 'VE': (uf - uo)**2 + (vf - vo)**2,
+        'HAS_DIR': has_dir, 'DE': dir_err, 'ADE': np.abs(dir_err), 'DEE': dir_err**2,
+    })
+    grouped = pairs.groupby(keys, sort=True)
+    n = grouped.size().to_numpy(np.float64)
+    means = grouped[['UF', 'VF', 'UO', 'VO', 'FSPD', 'OSPD', 'FF', 'OO', 'VE', 'DE', 'ADE', 'DEE']].mean()
+    stdevs = grouped[['FSPD', 'OSPD']].std(ddof=1)
+
+    out = pd.DataFrame(index=means.index, columns=VCNT_COLUMNS, dtype=np.float64)
+    ufbar, vfbar = means['UF'].to_numpy(), means['VF'].to_numpy()
+    uobar, vobar = means['UO'].to_numpy(), means['VO'].to_numpy()
+
+    out['TOTAL'] = n
+    out['FBAR'] = means['FSPD'].to_numpy()
+    out['OBAR'] = means['OSPD'].to_numpy()
+    out['FS_RMS'] = np.sqrt(means['FF'].to_numpy())
+    out['OS_RMS'] = np.sqrt(means['OO'].to_numpy())
+    out['MSVE'] = means['VE'].to_numpy()
+    out['RMSVE'] = np.sqrt(out['MSVE'])
+    out['FSTDEV'] = stdevs['FSPD'].to_numpy()
+    out['OSTDEV'] = stdevs['OSPD'].to_numpy()
+    out['FDIR'] = wind_dir(ufbar, vfbar)
+    out['ODIR'] = wind_dir(uobar, vobar)
+    out['FBAR_SPEED'] = np.hypot(ufbar, vfbar)
+    out['OBAR_SPEED'] = np.hypot(uobar, vobar)
+    out['VDIFF_SPEED'] = np.hypot(ufbar - uobar, vfbar - vobar)
+    out['VDIFF_DIR'] = wind_dir(ufbar - uobar, vfbar - vobar)
+    out['SPEED_ERR'] = out['FBAR_SPEED'] - out['OBAR_SPEED']
+    out['SPEED_ABSERR'] = np.abs(out['SPEED_ERR'])
+    out['DIR_ERR'] = _dir_diff(out['FDIR'] - out['ODIR'])
+    out['DIR_ABSERR'] = np.abs(out['DIR_ERR'])
+    out['TOTAL_DIR'] = grouped['HAS_DIR'].sum().to_numpy()
+    out['DIR_ME'] = means['DE'].to_numpy()
+    out['DIR_MAE'] = means['ADE'].to_numpy()
+    out['DIR_MSE'] = means['DEE'].to_numpy()
+    out['DIR_RMSE'] = np.sqrt(out['DIR_MSE'])
+    return out
+
+
+def aggregate(mpr, by, line_type, set_hdr=None, alpha=DEFAULT_ALPHA):
+    """Return the stat lines of line_type (CNT or VCNT) aggregated from MPR lines grouped by the by columns."""
+    if line_type == 'CNT':
+        frame = mpr
+        values = cnt_stats(frame, by, alpha)
+    elif line_type == 'VCNT':
+        frame = pair_winds(mpr)
+        values = vcnt_stats(frame, by)
+    else:
+        raise ValueError('Line type '+line_type+' not supported, use CNT or VCNT')
+    if frame.empty:
+        return pd.DataFrame(columns=HEADER_COLUMNS + LINE_TYPE_COLUMNS[line_type])
+
+    header = group_header(frame, by, line_type, alpha, set_hdr)
+    return pd.concat([header, values], axis=1).reset_index(drop=True)
+
+
+def write_stat(lines, output_file):
+    """Write stat lines as whitespace separated columns with a header line, NA for missing values."""
+    lines = lines.copy()
+    for column in COUNT_COLUMNS & set(lines.columns):
+        lines[column] = lines[column].astype('Int64')
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    lines.to_csv(output_file, sep=' ', index=False, float_format='%.5f', na_rep='NA')
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Aggregate MPR lines into CNT and VCNT lines like stat_analysis')
+    parser.add_argument('mpr_files', nargs='+', help='MPR .stat files with a header line, e.g. -dump_row output')
+    parser.add_argument('--job', nargs=3, action='append', required=True, metavar=('LINE_TYPE', 'BY', 'OUTPUT'),
+                        help='output line type (CNT or VCNT), comma separated -by columns, and output .stat file')
+    parser.add_argument('--set-hdr', action='append', default=[], metavar='COLUMN=VALUE',
+                        help='set a header column to a value, or to the group value of a -by column in '
+                             'the jobs grouped by it, e.g. VX_MASK=OBS_SID')
+    parser.add_argument('--fcst-var', default=None, help='comma separated FCST_VAR values to keep')
+    parser.add_argument('--vx-mask', default=None, help='comma separated VX_MASK values to keep')
+    parser.add_argument('--alpha', type=float, default=DEFAULT_ALPHA, help='alpha of the normal confidence limits')
+    parser.add_argument('--elv-band-width', type=float, default=DEFAULT_ELV_BAND_WIDTH,
+                        help='width of the OBS_ELV_BAND groups in meters')
+    parser.add_argument('--station-table', default=None,
+                        help='CSV with an OBS_SID column whose other columns can be -by columns')
+    args = parser.parse_args()
+
+    set_hdr = dict(h.split('=', 1) for h in args.set_hdr)
+    filters = {}
+    if args.fcst_var:
+        filters['FCST_VAR'] = [v.strip() for v in args.fcst_var.split(',') if v.strip()]
+    if args.vx_mask:
+        filters['VX_MASK'] = [m.strip() for m in args.vx_mask.split(',') if m.strip()]
+    stat_cache = os.environ.get('STAT_PARQUET_CACHE', 'False').lower() in ('true', 'yes', '1')
+
+    start = time.perf_counter()
+    mpr = read_mpr(args.mpr_files, filters, stat_cache)
+    print(f"Read {len(mpr)} matched pairs in {time.perf_counter() - start:.3f} s")
+
+    stations = pd.read_csv(args.station_table, dtype=str) if args.station_table else None
+    all_by = sorted({c for _, by, _ in args.job for c in by.split(',')})
+    mpr = add_keys(mpr, all_by, args.elv_band_width, stations)
+
+    for line_type, by, output_file in args.job:
+        start = time.perf_counter()
+        by = by.split(',')
+        # Columns named in --set-hdr only apply to the jobs grouped by them
+        job_hdr = {c: v for c, v in set_hdr.items() if v in by or v not in mpr.columns}
+        lines = aggregate(mpr, by, line_type.upper(), job_hdr, args.alpha)
+        write_stat(lines, output_file)
+        print(f"{line_type} by {','.join(by)}: {len(lines)} lines to {output_file} in {time.perf_counter() - start:.3f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+# Pre-rendered background for the Cartopy station maps.
+#
+# Drawing the Natural Earth state borders (and optionally county borders)
+# costs more than the station markers on top of them, and is the same for
+# every map of a series.  The background is rasterized once for a given
+# extent, projection, figure size, and DPI, kept in memory and optionally in
+# a cache directory, and new maps place it behind transparent axes with the
+# same layout, so only the markers, colorbar, and title are drawn per map.
+#
+# Maps use a fixed layout (MAP_AXES_RECT and COLORBAR_AXES_RECT) rather than
+# tight_layout, so the axes line up with the cached background.
+
+import os
+import json
+import hashlib
+import tempfile
+
+import numpy as np
+import matplotlib.pyplot as plt
+import matplotlib.image as mpimg
+import cartopy.crs as ccrs
+import cartopy.feature as cfeature
+
+
+# Figure coordinates of the map axes and of the colorbar next to it
+MAP_AXES_RECT = [0.04, 0.06, 0.80, 0.84]
+COLORBAR_AXES_RECT = [0.87, 0.17, 0.03, 0.62]
+
+# Backgrounds already rendered or loaded in this process
+_BASEMAPS = {}
+
+
+def basemap_key(extent, projection, figsize, dpi, counties_file=None):
+    """Return a hash identifying a background."""
+    key = {
+        'extent': [float(e) for e in extent],
+        'projection': projection.proj4_init,
+        'figsize': [float(f) for f in figsize],
+        'dpi': float(dpi),
+        'axes': MAP_AXES_RECT,
+        'counties': None,
+    }
+    if counties_file:
+        stat = os.stat(counties_file)
+        key['counties'] = [os.path.abspath(counties_file), stat.st_size, stat.st_mtime_ns]
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def _new_axes(fig, extent, projection):
+    ax = fig.add_axes(MAP_AXES_RECT, projection=projection)
+    ax.set_extent(extent, crs=ccrs.PlateCarree())
+    return ax
+
+
+def render_basemap(extent, projection, figsize, dpi, counties_file=None):
+    """Rasterize the state (and county) borders and return the RGBA image."""
+    fig = plt.figure(figsize=figsize, dpi=dpi)
+    ax = _new_axes(fig, extent, projection)
+    ax.add_feature(cfeature.STATES, linewidth=0.5, edgecolor='black')
+    if counties_file:
+        import cartopy.io.shapereader as shpreader
+        ax.add_geometries(shpreader.Reader(counties_file).geometries(), crs=ccrs.PlateCarree(),
+                          facecolor='none', edgecolor='gray', linewidth=0.3)
+    fig.canvas.draw()
+    image = np.array(fig.canvas.buffer_rgba())
+    plt.close(fig)
+    return image
+
+
+def load_basemap(extent, projection=None, figsize=None, dpi=None, counties_file=None, cache_dir=None):
+    """Return the RGBA background image, rendering it only if it is not cached."""
+    projection = projection or ccrs.PlateCarree()
+    figsize = figsize or plt.rcParams['figure.figsize']
+    dpi = dpi or plt.rcParams['figure.dpi']
+    key = basemap_key(extent, projection, figsize, dpi, counties_file)
+
+    if key in _BASEMAPS:
+        return _BASEMAPS[key]
+
+    cfile = os.path.join(cache_dir, 'basemap_'+key+'.png') if cache_dir else None
+    image = None
+    if cfile and os.path.exists(cfile):
+        try:
+            image = (mpimg.imread(cfile) * 255).round().astype(np.uint8)
+        except (OSError, ValueError):
+            image = None
+
+    if image is None:
+        image = render_basemap(extent, projection, figsize, dpi, counties_file)
+        if cfile:
+            # Write to a temporary file and rename it so that concurrent
+            # readers never see a partial image
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix='.png')
+            os.close(fd)
+            try:
+                mpimg.imsave(tmp_file, image)
+                os.chmod(tmp_file, 0o644)
+                os.replace(tmp_file, cfile)
+            except BaseException:
+                os.remove(tmp_file)
+                raise
+
+    _BASEMAPS[key] = image
+    return image
+
+
+def new_map(extent, projection=None, figsize=None, dpi=None, counties_file=None, cache_dir=None):
+    """Return a figure and map axes drawn over the cached background.
+
+    The axes are transparent, so anything drawn on them appears over the
+    background.  Add a colorbar with colorbar_axes(fig) to keep the layout.
+    """
+    projection = projection or ccrs.PlateCarree()
+    figsize = figsize or plt.rcParams['figure.figsize']
+    dpi = dpi or plt.rcParams['figure.dpi']
+    image = load_basemap(extent, projection, figsize, dpi, counties_file, cache_dir)
+
+    fig = plt.figure(figsize=figsize, dpi=dpi)
+    # The figure draws its images after its axes at equal zorder, so keep
+    # the background below them
+    fig.figimage(image, 0, 0, origin='upper', zorder=-1)
+    ax = _new_axes(fig, extent, projection)
+    ax.patch.set_visible(False)
+    return fig, ax
+
+
+def colorbar_axes(fig):
+    """Return axes for a colorbar next to the map."""
+    return fig.add_axes(COLORBAR_AXES_RECT)
+
+
+def station_extent(lon, lat, pad=0.05):
+    """Return a lon_min, lon_max, lat_min, lat_max extent around stations, padded by a fraction."""
+    lon_min, lon_max = np.nanmin(lon), np.nanmax(lon)
+    lat_min, lat_max = np.nanmin(lat), np.nanmax(lat)
+    dlon = max(lon_max - lon_min, 0.1) * pad
+    dlat = max(lat_max - lat_min, 0.1) * pad
+    return [lon_min - dlon, lon_max + dlon, lat_min - dlat, lat_max + dlat]
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+# Convert every hour of a WRF run up front into a compressed netCDF store.
+#
+# Each wrfout file between the first and last valid time is converted with
+# the same logic as convert_wrf_sfc.py, computing every supported field, and
+# the files are spread over a pool of processes so all cores of a node are
+# used before PointStat starts.  Fields are stored as compressed float32, in
+# one store file per hour or in a single file for the whole run.  When
+# WRF_SFC_STORE_DIR points at the store, convert_wrf_sfc.py reads from it.
+#
+#   batch_convert_wrf.py 2022072000 2022072023 1H d03 /path/to/WRF /path/to/store
+#
+# Files already in the store and unchanged since they were converted are
+# skipped.  WRF_SFC_MASK_POLY and WRF_SFC_MASK_HALO crop the fields the same
+# way as in convert_wrf_sfc.py.
+
+import os
+import re
+import sys
+import time
+import argparse
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import wrf_sfc
+
+
+# Default wrfout file name, as in the PointStat configuration
+DEFAULT_TEMPLATE = 'wrfout_{domain}_%Y-%m-%d_%H:%M:%S'
+
+# Valid time format of VALID_BEG and VALID_END
+VALID_TIME_FMT = '%Y%m%d%H'
+
+STORE_LAYOUTS = ['hourly', 'run']
+
+_INCREMENT_UNITS = {'S': 1, 'M': 60, 'H': 3600, 'D': 86400}
+
+
+def parse_increment(increment):
+    """Return a METplus style increment (3600, 60M, 1H, 1D) as a timedelta."""
+    match = re.fullmatch(r'(\d+)([SMHD]?)', increment.strip().upper())
+    if match is None:
+        raise ValueError('Invalid increment '+increment)
+    return timedelta(seconds=int(match.group(1)) * _INCREMENT_UNITS[match.group(2) or 'S'])
+
+
+def valid_times(valid_beg, valid_end, increment):
+    """Return the valid times from valid_beg to valid_end inclusive."""
+    valid, times = valid_beg, []
+    while valid <= valid_end:
+        times.append(valid)
+        valid += increment
+    return times
+
+
+def convert_hour(infile, mask_polys, halo, cache_dir):
+    """Return the store index entry and fields of one wrfout file."""
+    valid, grid, fields = wrf_sfc.read_file(infile, list(wrf_sfc.VAR_INFO), mask_polys, halo, cache_dir)
+    return wrf_sfc.store_entry(infile, valid, grid, fields), fields
+
+
+def convert_hour_to_file(infile, store_file, mask_polys, halo, cache_dir):
+    """Convert one wrfout file into its own store file and return its index entry."""
+    entry, fields = convert_hour(infile, mask_polys, halo, cache_dir)
+    entry['file'] = os.path.basename(store_file)
+    wrf_sfc.write_store_file(store_file, [entry], [fields])
+    return entry
+
+
+def batch_convert(infiles, store_dir, layout='hourly', mask_polys=None, halo=wrf_sfc.DEFAULT_HALO,
+                  workers=None, run_name='run'):
+    """Convert a list of wrfout files into the store in store_dir.
+
+    Returns the number of files converted, the number skipped because they
+    are already current in the store, and the list of files that failed.
+    A file that fails is reported and left out, and the files converted are
+    still added to the store.
+    """
+    if layout not in STORE_LAYOUTS:
+        raise ValueError('Store layout '+layout+' not supported, use one of '+', '.join(STORE_LAYOUTS))
+
+    os.makedirs(store_dir, exist_ok=True)
+    subdomain_key = wrf_sfc.mask_key(mask_polys, halo) if mask_polys else None
+    index = wrf_sfc.read_store_index(store_dir)
+
+    def is_current(infile):
+        entry = index.get(wrf_sfc.store_key(infile, subdomain_key))
+        return (entry is not None and wrf_sfc.store_entry_current(infile, entry)
+                and os.path.exists(os.path.join(store_dir, entry['file'])))
+
+    todo = [infile for infile in infiles if not is_current(infile)]
+    if layout == 'run' and todo:
+        # The run file is rewritten as a whole, so convert every hour again
+        todo = list(infiles)
+    if not todo:
+        return 0, len(infiles), []
+
+    # The subdomain window is shared by every file, so store it next to the
+    # fields for the workers to reuse
+    cache_dir = store_dir if mask_polys else None
+
+    def failure(infile, err):
+        # A stale entry could point at a run file rewritten without the file
+        print(f"ERROR: {infile} failed: {err!r}")
+        index.pop(wrf_sfc.store_key(infile, subdomain_key), None)
+        failed.append(infile)
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        if layout == 'hourly':
+            futures = {pool.submit(convert_hour_to_file, infile,
+                                   os.path.join(store_dir, wrf_sfc.store_file_name(infile, subdomain_key)),
+                                   mask_polys, halo, cache_dir): infile for infile in todo}
+            for future in as_completed(futures):
+                try:
+                    index[wrf_sfc.store_key(futures[future], subdomain_key)] = future.result()
+                except Exception as err:
+                    failure(futures[future], err)
+        else:
+            futures = {infile: pool.submit(convert_hour, infile, mask_polys, halo, cache_dir) for infile in todo}
+            results = {}
+            for infile, future in futures.items():
+                try:
+                    results[infile] = future.result()
+                except Exception as err:
+                    failure(infile, err)
+            if results:
+                run_file = wrf_sfc.run_file_name(run_name, infiles, subdomain_key)
+                for entry, _ in results.values():
+                    entry['file'] = run_file
+                wrf_sfc.write_store_file(os.path.join(store_dir, run_file), [entry for entry, _ in results.values()],
+                                         [fields for _, fields in results.values()])
+                for infile, (entry, _) in results.items():
+                    index[wrf_sfc.store_key(infile, subdomain_key)] = entry
+
+    wrf_sfc.write_store_index(store_dir, index)
+    return len(todo) - len(failed), len(infiles) - len(todo), failed
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Convert the wrfout files of a run into a store for convert_wrf_sfc.py')
+    parser.add_argument('valid_beg', help='first valid time, '+VALID_TIME_FMT)
+    parser.add_argument('valid_end', help='last valid time, '+VALID_TIME_FMT)
+    parser.add_argument('valid_increment', help='time between files, e.g. 1H or 3600')
+    parser.add_argument('domain', help='WRF domain, e.g. d03')
+    parser.add_argument('input_dir', help='directory of the wrfout files')
+    parser.add_argument('store_dir', help='directory of the store')
+    parser.add_argument('--layout', choices=STORE_LAYOUTS, default='hourly',
+                        help='one store file per hour, or one for the whole run')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes, default all cores')
+    parser.add_argument('--template', default=DEFAULT_TEMPLATE,
+                        help='wrfout file name as a strftime format with {domain}, default '+DEFAULT_TEMPLATE.replace('%', '%%'))
+    args = parser.parse_args()
+
+    valid_beg = datetime.strptime(args.valid_beg, VALID_TIME_FMT)
+    valid_end = datetime.strptime(args.valid_end, VALID_TIME_FMT)
+    template = os.path.join(args.input_dir, args.template.replace('{domain}', args.domain))
+
+    infiles = []
+    for valid in valid_times(valid_beg, valid_end, parse_increment(args.valid_increment)):
+        infile = valid.strftime(template)
+        if os.path.exists(infile):
+            infiles.append(infile)
+        else:
+            print("WARNING: Missing input WRF file "+infile)
+    if not infiles:
+        print("ERROR: No input WRF files found")
+        sys.exit(1)
+
+    # Crop the fields the same way as convert_wrf_sfc.py
+    mask_polys = [p.strip() for p in os.environ.get('WRF_SFC_MASK_POLY', '').split(',') if p.strip()]
+    halo = int(os.environ.get('WRF_SFC_MASK_HALO') or wrf_sfc.DEFAULT_HALO)
+
+    start = time.perf_counter()
+    run_name = 'wrf_sfc_'+args.domain+'_'+args.valid_beg+'_'+args.valid_end
+    converted, skipped, failed = batch_convert(infiles, args.store_dir, args.layout, mask_polys, halo, args.workers,
+                                               run_name)
+    print(f"Converted {converted} and skipped {skipped} current WRF files in {time.perf_counter() - start:.3f} s")
+    if failed:
+        print(f"ERROR: {len(failed)} WRF files failed: "+', '.join(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
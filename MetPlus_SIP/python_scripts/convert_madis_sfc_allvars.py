@@ -1,117 +1,45 @@
 #!/usr/bin/env python3
 
+import os
+import re
 import sys
-import netCDF4
-from datetime import datetime
-from metpy.calc import wind_components,relative_humidity_from_dewpoint,altimeter_to_station_pressure
-from metpy.units import units
+from datetime import datetime, timedelta
+
+# The conversion logic lives next to this script.  Only lightweight modules
+# are imported here; netCDF4 is imported by the conversion itself,
+# either in a warm worker (see converter_worker.py) or in this process.
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import converter_worker
 
 
 # Get Arguments
 if len(sys.argv) != 2:
-    print("ERROR: Must supply input file to script")
+    print("ERROR: Must supply input file or valid time (YYYYMMDD_HHMMSS) to script")
     sys.exit(1)
 
 # read input data
 infile = sys.argv[1]
 
-var_list = ['temperature','dewpoint','U','V','RH','PSFC']
-
-# Read the file
-ncin = netCDF4.Dataset(infile)
-
-# Read in latitude, longitude, and elevation
-lat_arr = ncin['latitude'][:]
-lon_arr = ncin['longitude'][:]
-elev_arr = ncin['elevation'][:]
-
-dlen = len(lat_arr)
-
-# Read in the station and time
-station = ncin['stationName'][:]
-timevar = ncin['timeObs']
-timevar_cftime = netCDF4.num2date(timevar[:],timevar.units)
-valid_time = [datetime.strftime(datetime(tv.year, tv.month, tv.day, tv.hour, tv.minute, tv.second), '%Y%m%d_%H%M%S') for tv in timevar_cftime]
-
-# Set up output data list
-point_data = []
-
-# Read in or calculate variable
-for var in var_list:
-    if var == 'temperature':
-        outvar = ncin[var][:]
-        var_lvl = 2
-        var_qc = ncin[var+'DD'][:]
-
-    elif var == 'dewpoint':
-        outvar = ncin[var][:]
-        var_lvl = 2
-        var_qc = ncin[var+'DD'][:]
-
-    elif var == 'U' or var == 'V':
-        windspeed = ncin['windSpeed'][:]
-        windspeed_units = ncin['windSpeed'].units
-        winddir = ncin['windDir'][:]
-        winddir_units = ncin['windDir'].units
-
-        # Add Units
-        windspeed = units.Quantity(windspeed,windspeed_units)
-        winddir = units.Quantity(winddir,winddir_units)
-
-        # Separate to components
-        wind_speed_dir = wind_components(windspeed,winddir)
-    
-        if var == 'U': outvar = wind_speed_dir[0].magnitude
-        if var == 'V': outvar = wind_speed_dir[1].magnitude
-        var_lvl = 10
-        var_qc = ncin['windSpeedDD'][:]
-
-    elif var == 'RH':
-        tmp = ncin['temperature'][:]
-        tmp_units = ncin['temperature'].units
-        dpt = ncin['dewpoint'][:]
-        dpt_units = ncin['dewpoint'].units
-
-        # Add Units
-        tmp = units.Quantity(tmp,tmp_units)
-        dpt = units.Quantity(dpt,dpt_units)
-
-        # Calculate RH
-        rhcalc = relative_humidity_from_dewpoint(tmp,dpt).to('percent')
-        outvar = rhcalc.magnitude
-        var_lvl = 2
-        var_qc = ncin['dewpointDD'][:]
-
-    elif var == 'PSFC':
-        altimeter = ncin['altimeter'][:]
-        altimeter_units = ncin['altimeter'].units
-        elev_units = ncin['elevation'].units
-
-        # Add Units
-        altimeter = units.Quantity(altimeter,altimeter_units)
-        elev = units.Quantity(elev_arr,elev_units)
-
-        # Calculate station pressure
-        psfc_calc = altimeter_to_station_pressure(altimeter, elev)
-        outvar = psfc_calc.magnitude
-        var_lvl = 0
-        var_qc = ncin['altimeterDD'][:]
-
-    else:
-        # No support for selected variable
-        # Error with message
-        raise NameError('Variable '+ var+' not currently supported')
-        print('Use temperature, dewpoint, U, V, or RH in the input variable list')
-        sys.exit(1)
-
-
-    # Create the point_data object MET expects
-    for dl in range(dlen):
-        cur_qc = var_qc[dl].tobytes().decode('utf-8')
-        if (cur_qc != 'Z') and (cur_qc != 'X'):
-            cur_valid_time = datetime.strftime(datetime(timevar_cftime[dl].year, timevar_cftime[dl].month, 
-                timevar_cftime[dl].day, timevar_cftime[dl].hour, timevar_cftime[dl].minute, 
-                timevar_cftime[dl].second), '%Y%m%d_%H%M%S')
-            point_data.append(['ADPSFC',station[dl].tobytes().decode('utf-8').split('\x00',1)[0],cur_valid_time,
-                lat_arr[dl].item(),lon_arr[dl].item(),elev_arr[dl].item(),var,var_lvl,elev_arr[dl].item(),
-                cur_qc,outvar[dl].item()])
+# Layout of point_data: a list of lists by default, or 'columns' for a
+# dictionary of column arrays or 'structured' for a numpy structured array
+point_data_format = os.environ.get('MADIS_POINT_DATA_FORMAT', 'list')
+
+# Optional store written by ingest_madis.py.  Files that are current in the
+# store are read from it instead of parsing the MADIS file.
+store_dir = os.environ.get('MADIS_STORE_DIR')
+store_dir = os.path.abspath(store_dir) if store_dir else None
+
+# Set up the point_data object MET expects
+if re.fullmatch(r'\d{8}_\d{6}', infile):
+    # Given a valid time instead of a file, read every stored observation in
+    # the window of MADIS_STORE_WINDOW_BEGIN to MADIS_STORE_WINDOW_END seconds
+    # around it
+    valid = datetime.strptime(infile, '%Y%m%d_%H%M%S')
+    valid_beg = valid + timedelta(seconds=int(os.environ.get('MADIS_STORE_WINDOW_BEGIN') or -1800))
+    valid_end = valid + timedelta(seconds=int(os.environ.get('MADIS_STORE_WINDOW_END') or 1800))
+    point_data = converter_worker.run('madis_sfc_window', valid_beg.strftime('%Y%m%d_%H%M%S'),
+                                      valid_end.strftime('%Y%m%d_%H%M%S'), point_data_format, store_dir)
+else:
+    # Paths are made absolute, as a warm worker resolves them against its own
+    # working directory
+    point_data = converter_worker.run('madis_sfc', os.path.abspath(infile), point_data_format, store_dir)
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+# Warm worker for the PYTHON_NUMPY converter scripts.
+#
+# MET starts a new Python interpreter for every field and valid time, and each
+# one pays for importing netCDF4 and numpy before any data is read.  This
+# worker does those imports once and serves conversion requests from
+# convert_wrf_sfc.py and convert_madis_sfc_allvars.py over a Unix socket.
+# When no worker is running the scripts fall back to converting in-process.
+#
+# Start a worker before running METplus, with the same socket path that is set
+# in MET_CONVERTER_SOCKET in the [user_env_vars] section:
+#
+#   converter_worker.py serve /path/to/converter.sock &
+#   ...
+#   converter_worker.py stop /path/to/converter.sock
+
+import os
+import sys
+import time
+import errno
+import pickle
+import signal
+import socket
+import struct
+import importlib
+import traceback
+import socketserver
+
+
+# Environment variable holding the socket path
+SOCKET_ENV = 'MET_CONVERTER_SOCKET'
+
+# Conversion jobs: name -> (module, function)
+JOBS = {
+    'wrf_sfc': ('wrf_sfc', 'convert'),
+    'madis_sfc': ('madis_sfc', 'convert'),
+    'madis_sfc_window': ('madis_sfc', 'convert_window'),
+}
+
+# Modules to import up front in the worker
+PRELOAD_MODULES = ['numpy', 'netCDF4', 'thermo', 'wrf_sfc', 'madis_sfc']
+
+# Modules imported up front when they are installed (pyarrow reads the MADIS store)
+OPTIONAL_PRELOAD_MODULES = ['pyarrow.parquet']
+
+# Seconds to wait for a worker to accept a connection before falling back
+CONNECT_TIMEOUT = 1.0
+
+_HEADER = struct.Struct('!Q')
+
+
+def _send(sock, obj):
+    # Length-prefixed pickle
+    payload = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    sock.sendall(_HEADER.pack(len(payload)) + payload)
+
+
+def _recv_exact(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(min(size - len(buf), 1 << 20))
+        if not chunk:
+            raise ConnectionError('Connection closed by peer')
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def _recv(sock):
+    size, = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    return pickle.loads(_recv_exact(sock, size))
+
+
+def _run_job(job, args):
+    module_name, func_name = JOBS[job]
+    return getattr(importlib.import_module(module_name), func_name)(*args)
+
+
+def _connect(socket_path):
+    # Return a connected socket, or None if no worker is listening
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(CONNECT_TIMEOUT)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        return None
+    sock.settimeout(None)
+    return sock
+
+
+def _process_age():
+    # Seconds since this process started, which covers interpreter startup
+    # and the imports done so far (Linux only)
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+
+
+def run(job, *args):
+    """Run a conversion job on the warm worker, or in-process if none is running.
+
+    Prints the process startup time and how the job was served, so that the
+    two modes can be compared in the MET log.
+    """
+    if job not in JOBS:
+        raise ValueError('Unknown conversion job '+job)
+
+    startup = _process_age()
+    startup_str = f"startup {startup:.3f} s, " if startup is not None else ""
+
+    start = time.perf_counter()
+    socket_path = os.environ.get(SOCKET_ENV)
+    sock = _connect(socket_path) if socket_path else None
+
+    if sock is not None:
+        with sock:
+            _send(sock, ('run', job, args))
+            status, result = _recv(sock)
+        if status == 'error':
+            raise result
+        print(f"Timing: {startup_str}{job} served by warm worker in {time.perf_counter() - start:.3f} s")
+        return result
+
+    # No worker, so convert in this process.  The conversion time includes
+    # importing netCDF4 when the job needs it.
+    n_modules = len(sys.modules)
+    result = _run_job(job, args)
+    print(f"Timing: {startup_str}{job} converted in-process in {time.perf_counter() - start:.3f} s, "
+          f"{len(sys.modules) - n_modules} modules imported")
+    return result
+
+
+class _Handler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        request = _recv(self.request)
+        if request[0] == 'stop':
+            # Requests run in a forked child, so signal the listening parent
+            _send(self.request, ('ok', None))
+            os.kill(os.getppid(), signal.SIGTERM)
+            return
+
+        _, job, args = request
+        start = time.perf_counter()
+        try:
+            reply = ('ok', _run_job(job, args))
+        except Exception as err:
+            traceback.print_exc()
+            reply = ('error', err)
+        try:
+            _send(self.request, reply)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            _send(self.request, ('error', RuntimeError(repr(reply[1]))))
+        print(f"{job} {' '.join(str(a) for a in args)}: {time.perf_counter() - start:.3f} s", flush=True)
+
+
+class _Server(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    # Each request runs in a forked child that shares the already imported
+    # modules, so requests are isolated from each other and can run at once.
+    pass
+
+
+def serve(socket_path):
+    """Preload the converter imports and serve requests until stopped."""
+    start = time.perf_counter()
+    for name in PRELOAD_MODULES:
+        importlib.import_module(name)
+    for name in OPTIONAL_PRELOAD_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+    print(f"Imports loaded in {time.perf_counter() - start:.3f} s", flush=True)
+
+    # Remove a stale socket left behind by a worker that did not exit cleanly
+    if os.path.exists(socket_path):
+        if _connect(socket_path) is not None:
+            raise RuntimeError('A worker is already listening on '+socket_path)
+        os.remove(socket_path)
+
+    old_umask = os.umask(0o077)
+    try:
+        server = _Server(socket_path, _Handler)
+    finally:
+        os.umask(old_umask)
+
+    # Exit cleanly, removing the socket, when stopped or killed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    print(f"Listening on {socket_path}", flush=True)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        try:
+            os.remove(socket_path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+
+def stop(socket_path):
+    """Ask the worker on socket_path to exit."""
+    sock = _connect(socket_path)
+    if sock is None:
+        print("No worker listening on "+socket_path)
+        return
+    with sock:
+        _send(sock, ('stop',))
+        _recv(sock)
+
+
+def main():
+
+    if len(sys.argv) not in (2, 3) or sys.argv[1] not in ('serve', 'stop'):
+        print("Usage: converter_worker.py serve|stop [socket_path]")
+        sys.exit(1)
+
+    socket_path = sys.argv[2] if len(sys.argv) == 3 else os.environ.get(SOCKET_ENV)
+    if not socket_path:
+        print("ERROR: Must supply a socket path or set "+SOCKET_ENV)
+        sys.exit(1)
+
+    if sys.argv[1] == 'serve':
+        # Make the converter modules importable in the worker
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        serve(socket_path)
+    else:
+        stop(socket_path)
+
+
+if __name__ == "__main__":
+    main()
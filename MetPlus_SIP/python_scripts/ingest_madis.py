@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# Ingest hourly MADIS METAR files into a store of Parquet tables.
+#
+# Each file is parsed once with the same logic as convert_madis_sfc_allvars.py
+# and its QC-passed, derived observations are written to a compressed table.
+# A manifest records the size, modification time, and checksum of every
+# source file, and files that are unchanged since they were ingested are
+# skipped, including files downloaded again with the same contents.  When
+# MADIS_STORE_DIR points at the store, convert_madis_sfc_allvars.py reads
+# from it instead of parsing the MADIS files.
+#
+#   ingest_madis.py /path/to/store /path/to/data_ingest/MADIS/metar
+
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import madis_sfc
+
+
+def list_inputs(paths):
+    """Return the MADIS files given as files or directories of .nc files."""
+    infiles = []
+    for path in paths:
+        if os.path.isdir(path):
+            infiles.extend(sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.nc')))
+        else:
+            infiles.append(path)
+    return [os.path.abspath(infile) for infile in infiles]
+
+
+def ingest_files(infiles, store_dir, workers=None):
+    """Ingest the MADIS files that are not current in the store.
+
+    Returns the number of files ingested, the number skipped, and the list
+    of files that failed.  A file that fails is reported and left out, and
+    the manifest is still written for the files ingested.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    manifest = madis_sfc.read_manifest(store_dir)
+
+    todo, skipped = [], 0
+    for infile in infiles:
+        entry = manifest.get(infile)
+        if entry is not None and madis_sfc.source_current(infile, entry) \
+                and os.path.exists(os.path.join(store_dir, entry['file'])):
+            # Remember a new modification time so the checksum is not needed next time
+            entry['source'] = madis_sfc.source_state(infile, checksum=False) | {'sha1': entry['source']['sha1']}
+            skipped += 1
+        else:
+            todo.append(infile)
+
+    failed = []
+    if todo:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(madis_sfc.ingest, infile, store_dir): infile for infile in todo}
+            for future in as_completed(futures):
+                try:
+                    manifest[futures[future]] = future.result()
+                except Exception as err:
+                    print("ERROR: Trouble reading input MADIS file "+futures[future]+": "+repr(err))
+                    failed.append(futures[future])
+
+    madis_sfc.write_manifest(store_dir, manifest)
+    return len(todo) - len(failed), skipped, failed
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Ingest MADIS METAR files into a store for convert_madis_sfc_allvars.py')
+    parser.add_argument('store_dir', help='directory of the store')
+    parser.add_argument('inputs', nargs='+', help='MADIS files or directories of them')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes, default all cores')
+    args = parser.parse_args()
+
+    infiles = list_inputs(args.inputs)
+    if not infiles:
+        print("ERROR: No input MADIS files found")
+        sys.exit(1)
+
+    start = time.perf_counter()
+    ingested, skipped, failed = ingest_files(infiles, args.store_dir, args.workers)
+    print(f"Ingested {ingested} and skipped {skipped} current MADIS files in {time.perf_counter() - start:.3f} s")
+    if failed:
+        print(f"ERROR: {len(failed)} MADIS files failed: "+', '.join(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+
+# Shared logic for converting MADIS METAR surface observations for MET
+# PYTHON_NUMPY input.  Used by convert_madis_sfc_allvars.py.  Derived
+# variables are computed with the NumPy kernels in thermo.py.
+#
+# Hourly files can also be ingested once by ingest_madis.py into a store of
+# Parquet tables holding the QC-passed, derived observations.  convert() then
+# reads a file from the store, and convert_window() reads every stored
+# observation in a valid time window, without parsing any MADIS file.
+#
+# netCDF4 and pyarrow are imported when they are needed rather than at import
+# time, so importing this module is cheap.
+
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+from datetime import datetime
+
+import thermo
+
+
+var_list = ['temperature','dewpoint','U','V','RH','PSFC']
+
+# Columns of the point observation table, in the order MET expects
+POINT_DATA_COLUMNS = ['typ','sid','vld','lat','lon','elv','var','lvl','hgt','qc','obs']
+
+# Supported layouts for point_data: a list of lists (the classic MET layout),
+# a dictionary of column arrays, or a numpy structured array
+POINT_DATA_FORMATS = ['list','columns','structured']
+
+# Manifest of the tables in a store written by ingest_madis.py
+STORE_MANIFEST = 'manifest.json'
+
+# Bump this when the stored observations change
+STORE_VERSION = 1
+
+# Columns holding strings, which come back from Parquet as object arrays
+_STRING_COLUMNS = ['typ','sid','vld','var','qc']
+
+
+def decode_stations(station):
+    """Decode a null-padded stationName char array into an array of str."""
+    chars = np.ma.getdata(station)
+    if chars.ndim == 1:
+        return np.char.decode(chars, 'utf-8')
+
+    # Blank out everything from the first null on, then view each row of
+    # characters as one fixed-width string
+    after_null = np.cumsum(chars == b'', axis=1) > 0
+    chars = np.ascontiguousarray(np.where(after_null, b'', chars))
+    return np.char.decode(chars.view('S%d' % chars.shape[1])[:,0], 'utf-8')
+
+
+def format_valid_times(timevar):
+    """Format the observation times of a timeObs variable as MET time strings."""
+    import netCDF4
+
+    # Only a few distinct report times occur in an hourly file, so format
+    # each distinct time once and map back to the observations
+    obs_time = np.ma.getdata(timevar[:])
+    uniq_time, time_idx = np.unique(obs_time, return_inverse=True)
+    uniq_valid = [datetime.strftime(datetime(tv.year, tv.month, tv.day, tv.hour, tv.minute, tv.second), '%Y%m%d_%H%M%S')
+                  for tv in netCDF4.num2date(uniq_time,timevar.units)]
+    return np.array(uniq_valid, dtype='U15')[time_idx.ravel()]
+
+
+def read_si(ncin, name, kind):
+    """Read a MADIS variable in SI units, with missing values set to NaN."""
+    ncvar = ncin[name]
+    values = np.ma.filled(ncvar[:].astype(np.float32), np.nan)
+    return thermo.to_si(values, ncvar.units, kind)
+
+
+def empty_columns():
+    """Return observation columns holding no observations."""
+    return {c: np.array([], dtype=str if c in _STRING_COLUMNS else np.float32) for c in POINT_DATA_COLUMNS}
+
+
+def format_point_data(columns, point_data_format='list'):
+    """Return the observation columns in the requested point_data layout."""
+    if point_data_format == 'columns':
+        return columns
+
+    if point_data_format == 'structured':
+        table = np.empty(len(columns['obs']), dtype=[(c, columns[c].dtype) for c in POINT_DATA_COLUMNS])
+        for c in POINT_DATA_COLUMNS:
+            table[c] = columns[c]
+        return table
+
+    if point_data_format == 'list':
+        # tolist converts every column to Python scalars in one call
+        return [list(row) for row in zip(*[columns[c].tolist() for c in POINT_DATA_COLUMNS])]
+
+    raise ValueError('point_data format '+point_data_format+' not supported, use one of '+', '.join(POINT_DATA_FORMATS))
+
+
+def read_columns(infile):
+    """Return the QC-passed observations of a MADIS METAR file as column arrays.
+
+    Observations whose QC flag is Z or X, or whose value is missing, are
+    dropped.
+    """
+    import netCDF4
+
+    # Read the file
+    ncin = netCDF4.Dataset(infile)
+
+    # Read in latitude, longitude, and elevation
+    lat_arr = np.ma.getdata(ncin['latitude'][:])
+    lon_arr = np.ma.getdata(ncin['longitude'][:])
+    elev_arr = np.ma.getdata(ncin['elevation'][:])
+
+    # Decode the station names and format the times once per file
+    station = decode_stations(ncin['stationName'][:])
+    valid_time = format_valid_times(ncin['timeObs'])
+
+    # Set up output columns
+    columns = {c: [] for c in POINT_DATA_COLUMNS}
+
+    # Inputs shared by more than one variable are read once
+    inputs = {}
+
+    def get(name, kind):
+        if name not in inputs:
+            inputs[name] = read_si(ncin, name, kind)
+        return inputs[name]
+
+    # Read in or calculate variable
+    for var in var_list:
+        if var == 'temperature' or var == 'dewpoint':
+            outvar = get(var, 'temperature')
+            var_lvl = 2
+            var_qc = ncin[var+'DD'][:]
+
+        elif var == 'U' or var == 'V':
+            # Separate to components, computing both on the first pass
+            if 'U' not in inputs:
+                inputs['U'], inputs['V'] = thermo.wind_components(get('windSpeed', 'speed'), get('windDir', 'angle'))
+            outvar = inputs[var]
+            var_lvl = 10
+            var_qc = ncin['windSpeedDD'][:]
+
+        elif var == 'RH':
+            # Calculate RH
+            outvar = thermo.relative_humidity_from_dewpoint(get('temperature', 'temperature'), get('dewpoint', 'temperature'))
+            var_lvl = 2
+            var_qc = ncin['dewpointDD'][:]
+
+        elif var == 'PSFC':
+            # Calculate station pressure
+            elev = thermo.to_si(elev_arr.astype(np.float32), ncin['elevation'].units, 'length')
+            outvar = thermo.altimeter_to_station_pressure(get('altimeter', 'pressure'), elev)
+            var_lvl = 0
+            var_qc = ncin['altimeterDD'][:]
+
+        else:
+            # No support for selected variable
+            # Error with message
+            raise NameError('Variable '+ var+' not currently supported')
+
+
+        # Keep the observations that pass QC and are not missing
+        var_qc = np.ma.getdata(var_qc)
+        keep = (var_qc != b'Z') & (var_qc != b'X') & np.isfinite(outvar)
+        nkeep = np.count_nonzero(keep)
+
+        columns['typ'].append(np.full(nkeep, 'ADPSFC'))
+        columns['sid'].append(station[keep])
+        columns['vld'].append(valid_time[keep])
+        columns['lat'].append(lat_arr[keep])
+        columns['lon'].append(lon_arr[keep])
+        columns['elv'].append(elev_arr[keep])
+        columns['var'].append(np.full(nkeep, var))
+        columns['lvl'].append(np.full(nkeep, var_lvl))
+        columns['hgt'].append(elev_arr[keep])
+        columns['qc'].append(np.char.decode(var_qc[keep], 'utf-8'))
+        columns['obs'].append(outvar[keep])
+
+    ncin.close()
+
+    return {c: np.concatenate(columns[c]) for c in POINT_DATA_COLUMNS}
+
+
+def file_checksum(path):
+    """Return the SHA-1 of a file."""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def source_state(infile, checksum=True):
+    """Return the size, modification time, and optionally checksum of a source file."""
+    stat = os.stat(infile)
+    state = {'version': STORE_VERSION, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if checksum:
+        state['sha1'] = file_checksum(infile)
+    return state
+
+
+def source_current(infile, entry):
+    """Return True if a manifest entry was ingested from the current contents of infile.
+
+    The size and modification time are checked first.  A file with a new
+    modification time, such as one downloaded again, is compared by checksum.
+    """
+    try:
+        state = source_state(infile, checksum=False)
+    except OSError:
+        return False
+    source = entry['source']
+    if state['version'] != source['version'] or state['size'] != source['size']:
+        return False
+    return state['mtime_ns'] == source['mtime_ns'] or file_checksum(infile) == source['sha1']
+
+
+def read_manifest(store_dir):
+    """Return the manifest of a store, or an empty one if there is none."""
+    try:
+        with open(os.path.join(store_dir, STORE_MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _replace_atomic(path, write):
+    # Write to a temporary file and rename it so that concurrent readers
+    # never see a partial file
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    os.close(fd)
+    try:
+        write(tmp_file)
+        os.chmod(tmp_file, 0o644)
+        os.replace(tmp_file, path)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+
+
+def write_manifest(store_dir, manifest):
+    """Write the manifest of a store."""
+    def write(path):
+        with open(path, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+    _replace_atomic(os.path.join(store_dir, STORE_MANIFEST), write)
+
+
+def write_table(path, columns):
+    """Write observation columns to a compressed Parquet table."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.table({c: columns[c] for c in POINT_DATA_COLUMNS})
+    _replace_atomic(path, lambda tmp_file: pq.write_table(table, tmp_file, compression='zstd'))
+
+
+def read_table(path, filters=None):
+    """Return the observation columns of a Parquet table, optionally filtered by row."""
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(path, columns=POINT_DATA_COLUMNS, filters=filters)
+    columns = {}
+    for c in POINT_DATA_COLUMNS:
+        values = table.column(c).to_numpy()
+        columns[c] = values.astype(str) if c in _STRING_COLUMNS else values
+    return columns
+
+
+def ingest(infile, store_dir):
+    """Convert a MADIS METAR file into a table in the store and return its manifest entry."""
+    # Take the source state before reading, so a file that changes while it
+    # is read is ingested again next time
+    source = source_state(infile)
+    columns = read_columns(infile)
+
+    table_file = os.path.basename(infile)+'.'+hashlib.sha1(os.path.abspath(infile).encode()).hexdigest()[:12]+'.parquet'
+    write_table(os.path.join(store_dir, table_file), columns)
+
+    vld = np.unique(columns['vld'])
+    return {
+        'source': source,
+        'file': table_file,
+        'nobs': len(columns['vld']),
+        'vld_min': str(vld[0]) if len(vld) else '',
+        'vld_max': str(vld[-1]) if len(vld) else '',
+    }
+
+
+def read_store(infile, store_dir):
+    """Return the stored observation columns of a MADIS file, or None if it is not current in the store."""
+    entry = read_manifest(store_dir).get(os.path.abspath(infile))
+    if entry is None or not source_current(infile, entry):
+        return None
+    try:
+        return read_table(os.path.join(store_dir, entry['file']))
+    except OSError:
+        return None
+
+
+def read_store_window(store_dir, valid_beg, valid_end):
+    """Return the stored observations valid from valid_beg to valid_end inclusive.
+
+    Times are MET time strings (YYYYMMDD_HHMMSS).  Only the tables whose
+    observation times overlap the window are opened.
+    """
+    tables = []
+    for entry in read_manifest(store_dir).values():
+        if entry['nobs'] and entry['vld_min'] <= valid_end and entry['vld_max'] >= valid_beg:
+            tables.append(read_table(os.path.join(store_dir, entry['file']),
+                                     filters=[('vld', '>=', valid_beg), ('vld', '<=', valid_end)]))
+    if not tables:
+        raise ValueError('No observations between '+valid_beg+' and '+valid_end+' in '+store_dir)
+    return {c: np.concatenate([table[c] for table in tables]) for c in POINT_DATA_COLUMNS}
+
+
+def convert(infile, point_data_format='list', store_dir=None):
+    """Return the point_data MET expects for a MADIS METAR file.
+
+    Observations whose QC flag is Z or X, or whose value is missing, are
+    dropped.  See format_point_data for the supported layouts.  With the
+    directory of a store written by ingest_madis.py, a file that is current
+    in the store is read from it.
+    """
+    if point_data_format not in POINT_DATA_FORMATS:
+        raise ValueError('point_data format '+point_data_format+' not supported, use one of '+', '.join(POINT_DATA_FORMATS))
+
+    columns = read_store(infile, store_dir) if store_dir else None
+    if columns is None:
+        columns = read_columns(infile)
+
+    # Create the point_data object MET expects
+    return format_point_data(columns, point_data_format)
+
+
+def convert_window(valid_beg, valid_end, point_data_format='list', store_dir=None):
+    """Return the point_data MET expects for the stored observations in a valid time window."""
+    if point_data_format not in POINT_DATA_FORMATS:
+        raise ValueError('point_data format '+point_data_format+' not supported, use one of '+', '.join(POINT_DATA_FORMATS))
+    if not store_dir:
+        raise ValueError('Reading observations by valid time needs a MADIS store directory')
+
+    return format_point_data(read_store_window(store_dir, valid_beg, valid_end), point_data_format)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+# Quick-look forecast/observation pairs without running PointStat.
+#
+# WRF fields from wrf_sfc.py are interpolated to the MADIS stations with the
+# cached BILIN index from station_index.py, for every valid time of a
+# period, and written as MPR lines in the column layout of the STAT-Analysis
+# -dump_row output that plot_bias_stations.py reads.  The WRF and MADIS
+# caches and stores set up for PointStat (WRF_SFC_CACHE_DIR,
+# WRF_SFC_STORE_DIR, MADIS_STORE_DIR) are used when they are set.
+#
+#   match_pairs.py 2022072000 2022072023 1H d03 /path/to/WRF pairs_MPR.stat \
+#       --madis-template '/path/to/metar/%Y%m%d_%H%M.nc' --mask-poly masks/Front_Range.poly
+#
+# The pairs follow the PointStat configuration: BILIN width 2 interpolation,
+# temperatures in F, and all observations within the observation window of
+# each valid time.  They are meant for quick looks and are not a replacement
+# for the PointStat output.
+
+import os
+import sys
+import time
+import argparse
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import wrf_sfc
+import madis_sfc
+import station_index
+from batch_convert_wrf import DEFAULT_TEMPLATE, VALID_TIME_FMT, parse_increment, valid_times
+
+
+MET_TIME_FMT = '%Y%m%d_%H%M%S'
+
+# Header and MPR columns of the STAT-Analysis -dump_row output
+MPR_COLUMNS = ['VERSION', 'MODEL', 'DESC', 'FCST_LEAD', 'FCST_VALID_BEG', 'FCST_VALID_END',
+               'OBS_LEAD', 'OBS_VALID_BEG', 'OBS_VALID_END', 'FCST_VAR', 'FCST_UNITS', 'FCST_LEV',
+               'OBS_VAR', 'OBS_UNITS', 'OBS_LEV', 'OBTYPE', 'VX_MASK', 'INTERP_MTHD', 'INTERP_PNTS',
+               'FCST_THRESH', 'OBS_THRESH', 'COV_THRESH', 'ALPHA', 'LINE_TYPE', 'TOTAL', 'INDEX',
+               'OBS_SID', 'OBS_LAT', 'OBS_LON', 'OBS_LVL', 'OBS_ELV', 'FCST', 'OBS', 'OBS_QC',
+               'CLIMO_MEAN', 'CLIMO_STDEV', 'CLIMO_CDF']
+
+
+def k_to_f(values):
+    return (values - 273.15) * 9/5 + 32
+
+
+# Forecast variable -> (FCST_VAR, OBS_VAR, point_data variable, OBS_LEV, units, conversion),
+# as set up in the PointStat field info
+PAIR_VARS = {
+    'T2': ('T2', 'temperature', 'temperature', 'Z2', 'F', k_to_f),
+    'DPT': ('DPT', 'dewpoint', 'dewpoint', 'Z2', 'F', k_to_f),
+    'U10': ('UGRD', 'UGRD', 'U', 'Z10', 'm_s-1', None),
+    'V10': ('VGRD', 'VGRD', 'V', 'Z10', 'm_s-1', None),
+    'RH': ('RH', 'RH', 'RH', 'Z2', '%', None),
+    'PSFC': ('PSFC', 'PSFC', 'PSFC', 'L0', 'Pa', None),
+}
+
+
+def read_masks(mask_polys):
+    """Return a list of (name, vertex latitudes, vertex longitudes) for .poly mask files."""
+    masks = []
+    for poly_file in mask_polys:
+        with open(poly_file) as f:
+            name = f.readline().strip()
+        masks.append((name,) + wrf_sfc.read_poly(poly_file))
+    return masks
+
+
+def read_obs(valid_beg, valid_end, madis_store=None, madis_files=()):
+    """Return the MADIS observation columns valid from valid_beg to valid_end inclusive."""
+    if madis_store and not madis_files:
+        return madis_sfc.read_store_window(madis_store, valid_beg, valid_end)
+
+    tables = []
+    for madis_file in madis_files:
+        columns = madis_sfc.read_store(madis_file, madis_store) if madis_store else None
+        if columns is None:
+            columns = madis_sfc.read_columns(madis_file)
+        keep = (columns['vld'] >= valid_beg) & (columns['vld'] <= valid_end)
+        tables.append({c: columns[c][keep] for c in madis_sfc.POINT_DATA_COLUMNS})
+    if not tables:
+        # No MADIS files for this valid time, so there is nothing to pair
+        return madis_sfc.empty_columns()
+    return {c: np.concatenate([table[c] for table in tables]) for c in madis_sfc.POINT_DATA_COLUMNS}
+
+
+def _inside_poly(obs, rows, poly_lat, poly_lon):
+    # Stations inside a poly mask, by observation location
+    return wrf_sfc.points_in_poly(obs['lat'][rows].astype(np.float64), obs['lon'][rows].astype(np.float64),
+                                  poly_lat, poly_lon)
+
+
+def match_hour(wrf_file, obs, var_list, masks, cache_dir=None, mask_polys=None,
+               halo=wrf_sfc.DEFAULT_HALO, store_dir=None, window=(-1800, 1800)):
+    """Return the MPR columns of one wrfout file matched to the observations.
+
+    Pairs are made for every observation of each variable in var_list whose
+    station is inside the grid, for the FULL mask and each (name, lat, lon)
+    poly mask in masks.
+    """
+    pairs = []
+    index = None
+    for var in var_list:
+        fcst_var, obs_var, obs_name, obs_lev, var_units, conversion = PAIR_VARS[var]
+        met_data, attrs = wrf_sfc.convert(wrf_file, var, cache_dir, mask_polys, halo, store_dir)
+
+        # Every variable shares the grid, so the stations are indexed once
+        if index is None:
+            index = station_index.load_index(attrs['grid'], obs['sid'], obs['lat'], obs['lon'], cache_dir)
+
+        rows = np.flatnonzero(obs['var'] == obs_name)
+        fcst = station_index.interpolate(met_data, {c: index[c][rows] for c in ('points', 'weights')})
+        obs_values = obs['obs'][rows].astype(np.float64)
+        if conversion is not None:
+            fcst, obs_values = conversion(fcst), conversion(obs_values)
+
+        keep = np.isfinite(fcst) & np.isfinite(obs_values)
+        in_mask = [('FULL', keep)]
+        for name, poly_lat, poly_lon in masks:
+            in_mask.append((name, keep & _inside_poly(obs, rows, poly_lat, poly_lon)))
+
+        valid = datetime.strptime(attrs['valid'], MET_TIME_FMT)
+        for vx_mask, sel in in_mask:
+            n = np.count_nonzero(sel)
+            pairs.append({
+                'FCST_VALID_BEG': np.full(n, attrs['valid']),
+                'OBS_VALID_BEG': np.full(n, (valid + timedelta(seconds=window[0])).strftime(MET_TIME_FMT)),
+                'OBS_VALID_END': np.full(n, (valid + timedelta(seconds=window[1])).strftime(MET_TIME_FMT)),
+                'FCST_VAR': np.full(n, fcst_var),
+                'FCST_LEV': np.full(n, attrs['level']),
+                'OBS_VAR': np.full(n, obs_var),
+                'OBS_LEV': np.full(n, obs_lev),
+                'UNITS': np.full(n, var_units),
+                'VX_MASK': np.full(n, vx_mask),
+                'OBS_SID': obs['sid'][rows][sel],
+                'OBS_LAT': obs['lat'][rows][sel],
+                'OBS_LON': obs['lon'][rows][sel],
+                'OBS_LVL': obs['lvl'][rows][sel],
+                'OBS_ELV': obs['elv'][rows][sel],
+                'FCST': fcst[sel],
+                'OBS': obs_values[sel],
+                'OBS_QC': obs['qc'][rows][sel],
+            })
+    return {c: np.concatenate([p[c] for p in pairs]) for c in pairs[0]}
+
+
+def to_mpr_frame(columns, model='WRF', obtype='MADIS', version='V11.1.0'):
+    """Return matched pair columns as an MPR DataFrame in the -dump_row layout."""
+    n = len(columns['FCST'])
+    mpr = pd.DataFrame({
+        'VERSION': version,
+        'MODEL': model,
+        'DESC': 'NA',
+        'FCST_LEAD': '000000',
+        'FCST_VALID_BEG': columns['FCST_VALID_BEG'],
+        'FCST_VALID_END': columns['FCST_VALID_BEG'],
+        'OBS_LEAD': '000000',
+        'OBS_VALID_BEG': columns['OBS_VALID_BEG'],
+        'OBS_VALID_END': columns['OBS_VALID_END'],
+        'FCST_VAR': columns['FCST_VAR'],
+        'FCST_UNITS': columns['UNITS'],
+        'FCST_LEV': columns['FCST_LEV'],
+        'OBS_VAR': columns['OBS_VAR'],
+        'OBS_UNITS': columns['UNITS'],
+        'OBS_LEV': columns['OBS_LEV'],
+        'OBTYPE': obtype,
+        'VX_MASK': columns['VX_MASK'],
+        'INTERP_MTHD': 'BILIN',
+        'INTERP_PNTS': 4,
+        'FCST_THRESH': 'NA',
+        'OBS_THRESH': 'NA',
+        'COV_THRESH': 'NA',
+        'ALPHA': 'NA',
+        'LINE_TYPE': 'MPR',
+        'TOTAL': 0,
+        'INDEX': 0,
+        'OBS_SID': columns['OBS_SID'],
+        'OBS_LAT': columns['OBS_LAT'],
+        'OBS_LON': columns['OBS_LON'],
+        'OBS_LVL': columns['OBS_LVL'],
+        'OBS_ELV': columns['OBS_ELV'],
+        'FCST': columns['FCST'],
+        'OBS': columns['OBS'],
+        'OBS_QC': columns['OBS_QC'],
+        'CLIMO_MEAN': 'NA',
+        'CLIMO_STDEV': 'NA',
+        'CLIMO_CDF': 'NA',
+    }, index=np.arange(n), columns=MPR_COLUMNS)
+
+    # TOTAL and INDEX count the pairs of each variable, mask, and valid time
+    groups = mpr.groupby(['FCST_VAR', 'VX_MASK', 'FCST_VALID_BEG'], sort=False)
+    mpr['TOTAL'] = groups['FCST'].transform('size')
+    mpr['INDEX'] = groups.cumcount() + 1
+    return mpr
+
+
+def match_period(wrf_files, valids, var_list=tuple(PAIR_VARS), mask_polys=(), madis_store=None, madis_files=None,
+                 cache_dir=None, crop_polys=None, halo=wrf_sfc.DEFAULT_HALO, store_dir=None, window=(-1800, 1800)):
+    """Return the MPR DataFrame of a list of wrfout files matched to MADIS observations.
+
+    valids holds the valid time of each wrfout file.  Observations come from
+    the MADIS store by valid time window, or from madis_files, a list with
+    the MADIS files of each wrfout file.
+    """
+    masks = read_masks(mask_polys)
+    hours = []
+    for k, (wrf_file, valid) in enumerate(zip(wrf_files, valids)):
+        obs = read_obs((valid + timedelta(seconds=window[0])).strftime(MET_TIME_FMT),
+                       (valid + timedelta(seconds=window[1])).strftime(MET_TIME_FMT),
+                       madis_store, madis_files[k] if madis_files else ())
+        hours.append(match_hour(wrf_file, obs, var_list, masks, cache_dir, crop_polys, halo, store_dir, window))
+    return to_mpr_frame({c: np.concatenate([h[c] for h in hours]) for c in hours[0]})
+
+
+def write_mpr(mpr, output_file):
+    """Write an MPR DataFrame as whitespace separated columns with a header line."""
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    mpr.to_csv(output_file, sep=' ', index=False, float_format='%.5f')
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Match WRF forecasts to MADIS observations without PointStat')
+    parser.add_argument('valid_beg', help='first valid time, '+VALID_TIME_FMT)
+    parser.add_argument('valid_end', help='last valid time, '+VALID_TIME_FMT)
+    parser.add_argument('valid_increment', help='time between files, e.g. 1H or 3600')
+    parser.add_argument('domain', help='WRF domain, e.g. d03')
+    parser.add_argument('input_dir', help='directory of the wrfout files')
+    parser.add_argument('output_file', help='MPR output file')
+    parser.add_argument('--template', default=DEFAULT_TEMPLATE,
+                        help='wrfout file name as a strftime format with {domain}, default '+DEFAULT_TEMPLATE.replace('%', '%%'))
+    parser.add_argument('--madis-template', default=None,
+                        help='MADIS file path as a strftime format, for when MADIS_STORE_DIR is not set')
+    parser.add_argument('--mask-poly', action='append', default=[], help='.poly mask to pair in, besides FULL')
+    parser.add_argument('--vars', default=','.join(PAIR_VARS), help='comma separated forecast variables')
+    args = parser.parse_args()
+
+    madis_store = os.environ.get('MADIS_STORE_DIR')
+    if not madis_store and not args.madis_template:
+        print("ERROR: Must set MADIS_STORE_DIR or supply --madis-template")
+        sys.exit(1)
+
+    var_list = [v.strip() for v in args.vars.split(',') if v.strip()]
+    for var in var_list:
+        if var not in PAIR_VARS:
+            raise NameError('Variable '+ var+' not currently supported')
+
+    window = (int(os.environ.get('MADIS_STORE_WINDOW_BEGIN') or -1800),
+              int(os.environ.get('MADIS_STORE_WINDOW_END') or 1800))
+
+    template = os.path.join(args.input_dir, args.template.replace('{domain}', args.domain))
+    wrf_files, valids, madis_files = [], [], []
+    for valid in valid_times(datetime.strptime(args.valid_beg, VALID_TIME_FMT),
+                             datetime.strptime(args.valid_end, VALID_TIME_FMT),
+                             parse_increment(args.valid_increment)):
+        wrf_file = valid.strftime(template)
+        if not os.path.exists(wrf_file):
+            print("WARNING: Missing input WRF file "+wrf_file)
+            continue
+        wrf_files.append(wrf_file)
+        valids.append(valid)
+        if args.madis_template:
+            # Every hourly MADIS file that can hold observations in the window
+            hours = valid_times((valid + timedelta(seconds=window[0])).replace(minute=0, second=0),
+                                valid + timedelta(seconds=window[1]), timedelta(hours=1))
+            madis_files.append([f for f in (h.strftime(args.madis_template) for h in hours) if os.path.exists(f)])
+    if not wrf_files:
+        print("ERROR: No input WRF files found")
+        sys.exit(1)
+
+    mask_polys = [p.strip() for p in os.environ.get('WRF_SFC_MASK_POLY', '').split(',') if p.strip()]
+    halo = int(os.environ.get('WRF_SFC_MASK_HALO') or wrf_sfc.DEFAULT_HALO)
+
+    start = time.perf_counter()
+    mpr = match_period(wrf_files, valids, var_list, args.mask_poly, madis_store, madis_files or None,
+                       os.environ.get('WRF_SFC_CACHE_DIR'), mask_polys, halo, os.environ.get('WRF_SFC_STORE_DIR'), window)
+    write_mpr(mpr, args.output_file)
+    print(f"Wrote {len(mpr)} pairs for {len(wrf_files)} valid times in {time.perf_counter() - start:.3f} s")
+
+
+if __name__ == "__main__":
+    main()
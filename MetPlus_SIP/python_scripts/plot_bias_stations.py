@@ -2,6 +2,8 @@
 
 import sys
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.colors as colors
@@ -12,76 +14,176 @@ import cartopy.feature as cfeature
 import pandas as pd
 import numpy as np
 
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from stat_reader import read_stat
+import basemap_cache
 
 
-FCST_VAR = sys.argv[1]
+# Statistics that can be mapped.  BCRMSE is the bias-corrected RMSE,
+# computed as the square root of the BCMSE column.
+STAT_LIST = ['ME', 'MAE', 'RMSE', 'BCRMSE']
 
-#FCST_VAR = 'T2'
-#cnt_file = '/d1/personal/kalb/ACOM/MET_output/StatAnalysis/surface/WRF_MADIS_surface_2022072000_2022072023_separate_stations_CNT.stat'
-#mpr_file = '/d1/personal/kalb/ACOM/MET_output/StatAnalysis/surface/WRF_MADIS_surface_2022072000_2022072023_AllVars_FULL_MPR.stat'
-#plot_output_dir = '/d1/personal/kalb/ACOM/MET_output/plots/surface_maps'
+# CNT columns needed for each statistic
+STAT_COLUMNS = {'ME': 'ME', 'MAE': 'MAE', 'RMSE': 'RMSE', 'BCRMSE': 'BCMSE'}
 
-cnt_file = os.environ['MAP_CNT_FILE']
-mpr_file = os.environ['MAP_MPR_FILE']
-plot_output_dir = os.environ['MAP_OUTPUT_DIR']
 
+def load_station_data(cnt_file, mpr_file, fcst_var_list, stat_list, stat_cache=False):
+    """Return the per-station statistics of every variable with the station lat/lon.
 
-STAT = 'ME'
+    Both stat files are read once for all the variables.
+    """
+    # Read in the CNT Data
+    stat_columns = sorted({STAT_COLUMNS[stat] for stat in stat_list})
+    cnt_data = read_stat(cnt_file, columns=['FCST_VAR','VX_MASK','FCST_UNITS','FCST_VALID_BEG','FCST_VALID_END']+stat_columns,
+                         filters={'FCST_VAR': fcst_var_list}, cache=stat_cache)
+    if 'BCRMSE' in stat_list:
+        cnt_data['BCRMSE'] = np.sqrt(cnt_data['BCMSE'])
 
-# Read in the CNT Data
-cnt_data_in = pd.read_csv(cnt_file,sep=r'\s+')
+    # Read in the MPR file to get the lats/lons
+    mpr_data = read_stat(mpr_file, columns=['FCST_VAR','OBS_SID','OBS_LAT','OBS_LON'],
+                         filters={'FCST_VAR': fcst_var_list}, cache=stat_cache)
 
-# Read in the MPR file to get the lats/lons
-mpr_data_in = pd.read_csv(mpr_file,sep=r'\s+')
+    # Find the unique MPR sites of each variable
+    mpr_data_unique = mpr_data.drop_duplicates(subset=['FCST_VAR','OBS_SID'])
 
+    # Match up the lat/lon
+    return cnt_data.merge(mpr_data_unique, left_on=['FCST_VAR','VX_MASK'], right_on=['FCST_VAR','OBS_SID'])
 
-# Sort based on variable
-cnt_data = cnt_data_in.loc[cnt_data_in['FCST_VAR'].eq(FCST_VAR)]
-mpr_data = mpr_data_in.loc[mpr_data_in['FCST_VAR'].eq(FCST_VAR)]
 
-# Find the unique MPR sites
-mpr_data_unique = mpr_data.drop_duplicates(subset=['OBS_SID'])
+def plot_map(alldata, FCST_VAR, STAT, plot_output_dir, basemap):
+    """Plot a map of one statistic at the stations and return the output file.
 
-# Match up the lat/lon
-alldata = cnt_data.merge(mpr_data_unique[['OBS_SID','OBS_LAT','OBS_LON']],left_on='VX_MASK',right_on='OBS_SID')
+    basemap holds the basemap_cache.new_map arguments of the background.
+    """
 
-# Pull out some data for plotting
-station_id = alldata['OBS_SID']
-bias = alldata[STAT]
-plat = alldata['OBS_LAT']
-plon = alldata['OBS_LON']
-
-
-# Pull out some data for the title
-var_units = alldata['FCST_UNITS'].iloc[0]
-start_dates = pd.to_datetime(alldata['FCST_VALID_BEG'],format='%Y%m%d_%H%M%S')
-end_dates = pd.to_datetime(alldata['FCST_VALID_END'],format='%Y%m%d_%H%M%S')
-min_date = start_dates.min()
-max_date = end_dates.max()
-
-
-# Make plotting output directory if it does not exist
-if not os.path.isdir(plot_output_dir):
-    os.makedirs(plot_output_dir)
-
-
-# Scaling for plot size
-minbias = np.min(bias)
-maxbias = np.max(bias)
-scaledbias = (bias - minbias) / (maxbias - minbias)
-scaledbias = scaledbias*100.
-
-# Make a graphic
-ax = plt.axes(projection=ccrs.PlateCarree())
-ax.add_feature(cfeature.STATES, linewidth=0.5, edgecolor='black')
-
-cmap = plt.get_cmap('gist_rainbow_r')
-#cax = plt.scatter(plon,plat,c=bias, s=(bias+abs(np.min(bias)))*10, vmin=min(bias), vmax=max(bias),cmap=cmap,edgecolors='black')
-cax = plt.scatter(plon,plat,c=bias, s=scaledbias, vmin=min(bias), vmax=max(bias),cmap=cmap,edgecolors='black')
-cbar = plt.colorbar(cax, shrink=.78, pad=0.02)
-cbar.ax.set_title(var_units)
-plt.title(FCST_VAR+' '+STAT+' Valid '+min_date.strftime('%Y/%m/%d %H%M')+' to '+max_date.strftime('%Y/%m/%d %H%M'))
-plt.tight_layout()
-
-
-plt.savefig(os.path.join(plot_output_dir,FCST_VAR+'_'+STAT+'_map_'+min_date.strftime('%Y%m%d%H%M%S')+'_'+max_date.strftime('%Y%m%d%H%M%S')+'.png'))
+    # Pull out some data for plotting
+    station_id = alldata['OBS_SID']
+    bias = alldata[STAT]
+    plat = alldata['OBS_LAT']
+    plon = alldata['OBS_LON']
+
+
+    # Pull out some data for the title
+    var_units = alldata['FCST_UNITS'].iloc[0]
+    start_dates = pd.to_datetime(alldata['FCST_VALID_BEG'],format='%Y%m%d_%H%M%S')
+    end_dates = pd.to_datetime(alldata['FCST_VALID_END'],format='%Y%m%d_%H%M%S')
+    min_date = start_dates.min()
+    max_date = end_dates.max()
+
+
+    # Scaling for plot size
+    minbias = np.min(bias)
+    maxbias = np.max(bias)
+    scaledbias = (bias - minbias) / (maxbias - minbias)
+    scaledbias = scaledbias*100.
+
+    # Make a graphic on top of the cached state borders
+    fig, ax = basemap_cache.new_map(**basemap)
+
+    cmap = plt.get_cmap('gist_rainbow_r')
+    cax = ax.scatter(plon,plat,c=bias, s=scaledbias, vmin=min(bias), vmax=max(bias),cmap=cmap,edgecolors='black',
+                     transform=ccrs.PlateCarree())
+    cbar = fig.colorbar(cax, cax=basemap_cache.colorbar_axes(fig))
+    cbar.ax.set_title(var_units)
+    ax.set_title(FCST_VAR+' '+STAT+' Valid '+min_date.strftime('%Y/%m/%d %H%M')+' to '+max_date.strftime('%Y/%m/%d %H%M'))
+
+    output_file = os.path.join(plot_output_dir,FCST_VAR+'_'+STAT+'_map_'+min_date.strftime('%Y%m%d%H%M%S')+'_'+max_date.strftime('%Y%m%d%H%M%S')+'.png')
+    fig.savefig(output_file)
+    plt.close(fig)
+    return output_file
+
+
+def _plot_job(alldata, FCST_VAR, STAT, plot_output_dir, basemap):
+    # Run one map in a worker, timing it
+    start = time.perf_counter()
+    output_file = plot_map(alldata, FCST_VAR, STAT, plot_output_dir, basemap)
+    return output_file, time.perf_counter() - start
+
+
+def main():
+
+    # One variable as in the original use case, or a comma separated list,
+    # or ALL for every variable in the CNT file
+    if len(sys.argv) != 2:
+        print("ERROR: Must supply the variable(s) to plot, e.g. T2 or T2,RH,DPT,PSFC or ALL")
+        sys.exit(1)
+
+    #FCST_VAR = 'T2'
+    #cnt_file = '/d1/personal/kalb/ACOM/MET_output/StatAnalysis/surface/WRF_MADIS_surface_2022072000_2022072023_separate_stations_CNT.stat'
+    #mpr_file = '/d1/personal/kalb/ACOM/MET_output/StatAnalysis/surface/WRF_MADIS_surface_2022072000_2022072023_AllVars_FULL_MPR.stat'
+    #plot_output_dir = '/d1/personal/kalb/ACOM/MET_output/plots/surface_maps'
+
+    cnt_file = os.environ['MAP_CNT_FILE']
+    mpr_file = os.environ['MAP_MPR_FILE']
+    plot_output_dir = os.environ['MAP_OUTPUT_DIR']
+
+    # Statistics to map, ME by default
+    stat_list = [s.strip() for s in os.environ.get('MAP_STAT_LIST', 'ME').split(',') if s.strip()]
+    for stat in stat_list:
+        if stat not in STAT_LIST:
+            raise ValueError('Statistic '+stat+' not supported, use one of '+', '.join(STAT_LIST))
+
+    # Number of maps drawn at once, all cores by default
+    num_workers = int(os.environ.get('MAP_NUM_WORKERS') or os.cpu_count())
+
+    # Cache the parsed stat files as Parquet next to them
+    stat_cache = os.environ.get('STAT_PARQUET_CACHE', 'False').lower() in ('true', 'yes', '1')
+
+    if sys.argv[1] == 'ALL':
+        fcst_var_list = sorted(read_stat(cnt_file, columns=['FCST_VAR'], cache=stat_cache)['FCST_VAR'].unique())
+    else:
+        fcst_var_list = [v.strip() for v in sys.argv[1].split(',') if v.strip()]
+
+    start = time.perf_counter()
+    alldata = load_station_data(cnt_file, mpr_file, fcst_var_list, stat_list, stat_cache)
+    print(f"Read the station data in {time.perf_counter() - start:.3f} s")
+
+    # Make plotting output directory if it does not exist
+    if not os.path.isdir(plot_output_dir):
+        os.makedirs(plot_output_dir)
+
+    # Every map shares one extent, around all the stations unless MAP_EXTENT
+    # (lon_min, lon_max, lat_min, lat_max) is set, so the background with the
+    # state and optionally county borders is rendered once.  Rendering it
+    # before the pool starts lets the workers inherit it.
+    if os.environ.get('MAP_EXTENT'):
+        extent = [float(e) for e in os.environ['MAP_EXTENT'].split(',')]
+    else:
+        extent = basemap_cache.station_extent(alldata['OBS_LON'], alldata['OBS_LAT'])
+    basemap = {
+        'extent': extent,
+        'counties_file': os.environ.get('MAP_COUNTIES_SHAPEFILE') or None,
+        'cache_dir': os.environ.get('MAP_BASEMAP_CACHE_DIR') or None,
+    }
+    basemap_cache.load_basemap(**basemap)
+
+    jobs = []
+    for FCST_VAR in fcst_var_list:
+        var_data = alldata.loc[alldata['FCST_VAR'].eq(FCST_VAR)]
+        if var_data.empty:
+            print("WARNING: No station data for "+FCST_VAR)
+            continue
+        for STAT in stat_list:
+            jobs.append((var_data, FCST_VAR, STAT))
+
+    # Draw the maps in separate processes, reporting each one
+    failed = 0
+    with ProcessPoolExecutor(max_workers=min(num_workers, max(len(jobs), 1))) as pool:
+        futures = {pool.submit(_plot_job, var_data, FCST_VAR, STAT, plot_output_dir, basemap): (FCST_VAR, STAT)
+                   for var_data, FCST_VAR, STAT in jobs}
+        for future in as_completed(futures):
+            FCST_VAR, STAT = futures[future]
+            try:
+                output_file, elapsed = future.result()
+                print(f"{FCST_VAR} {STAT}: {output_file} in {elapsed:.3f} s")
+            except Exception as err:
+                failed += 1
+                print(f"ERROR: {FCST_VAR} {STAT} map failed: {err!r}")
+
+    print(f"Plotted {len(jobs) - failed} maps in {time.perf_counter() - start:.3f} s")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+# YAML plot configurations parsed once and filled in per plot.
+#
+# The METplotpy YAML configurations use !ENV '${VAR}' values, which
+# metcalcpy.util.read_env_vars_in_config.parse_config fills in from the
+# environment while the file is parsed.  Here the file is parsed once into a
+# template that keeps those values, and each plot fills them in from its own
+# dictionary of settings, falling back to the environment, so plots no
+# longer need os.environ to be changed between them and can run in parallel.
+#
+# As in parse_config, plain values holding ${VAR} are treated as !ENV values
+# too, and a variable that is not set is replaced by its name.
+
+import os
+import re
+import yaml
+
+
+ENV_TAG = '!ENV'
+ENV_PATTERN = re.compile(r'.*?\${(\w+)}.*?')
+ENV_VARIABLE = re.compile(r'\${(\w+)}')
+
+
+class EnvValue(str):
+    """A YAML value holding ${VAR} references still to be filled in."""
+
+
+class TemplateLoader(yaml.SafeLoader):
+    """SafeLoader keeping !ENV values as EnvValue strings."""
+
+
+def _construct_env_value(loader, node):
+    return EnvValue(loader.construct_scalar(node))
+
+
+TemplateLoader.add_implicit_resolver(ENV_TAG, ENV_PATTERN, None)
+TemplateLoader.add_constructor(ENV_TAG, _construct_env_value)
+
+
+def read_template(config_file):
+    """Parse a YAML configuration file, keeping its !ENV values to fill in later."""
+    with open(config_file) as f:
+        return yaml.load(f, Loader=TemplateLoader)
+
+
+def substitute(template, values=None):
+    """Return a copy of a template with its !ENV values filled in.
+
+    Variables are looked up in values first and then in the environment.
+    Mapping keys are filled in as well as values.
+    """
+    values = values or {}
+
+    def lookup(match):
+        name = match.group(1)
+        return str(values[name]) if name in values else os.environ.get(name, name)
+
+    if isinstance(template, EnvValue):
+        return ENV_VARIABLE.sub(lookup, template)
+    if isinstance(template, dict):
+        return {substitute(k, values): substitute(v, values) for k, v in template.items()}
+    if isinstance(template, list):
+        return [substitute(v, values) for v in template]
+    return template
@@ -1,12 +1,79 @@
 #!/usr/bin/env python3
 
 import os
+import sys
 from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import logging
 import yaml
-import metcalcpy.util.read_env_vars_in_config as readconfig
+import pandas as pd
 from metplotpy.plots.line import line
 
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from plot_config import read_template, substitute
+
+
+# Reformatted stat data of each stat_input file, read once and shared by
+# every plot in a process
+_STAT_DATA = {}
+
+
+def read_stat_input(stat_input):
+    """Read a reformatted stat file the way line.Line reads it."""
+    return pd.read_csv(stat_input, sep='\t', header='infer', float_precision='round_trip')
+
+
+class SharedDataLine(line.Line):
+    """line.Line reading its stat_input from the data loaded up front."""
+
+    def __init__(self, parameters):
+        self._stat_input = parameters['stat_input']
+        super().__init__(parameters)
+
+    def _read_input_data(self):
+        if self._stat_input not in _STAT_DATA:
+            _STAT_DATA[self._stat_input] = read_stat_input(self._stat_input)
+        # The plot may change its data, so give it a copy
+        return _STAT_DATA[self._stat_input].copy()
+
+
+def expand_jobs(plotting_vars, var_longnames, var_units, plotting_masks, yaml_files, yaml_file_dir, plot_output_dir):
+    """Return the settings of every plot, one dictionary per variable, mask, and configuration.
+
+    The settings fill in the !ENV values of the YAML configuration.
+    """
+    jobs = []
+    for v,n,u in zip(plotting_vars,var_longnames,var_units):
+        for m in plotting_masks:
+            for i in yaml_files:
+                jobs.append({
+                    'FCST_VAR_VAL1': v,
+                    'PLOTTING_CNT_LONG_VAR': n,
+                    'PLOTTING_CNT_VAR_UNITS': u,
+                    'PLOTTING_CNT_OUTPUT_FILENAME': os.path.join(plot_output_dir,v+'_'+m),
+                    'PLOTTING_CNT_MASK': m,
+                    'PLOTTING_CNT_YAML_CONFIG_NAME': os.path.join(yaml_file_dir,i),
+                })
+    return jobs
+
+
+def _init_worker(stat_data):
+    # Share the data loaded by the parent with the plots of this worker
+    _STAT_DATA.update(stat_data)
+
+
+def plot_line(settings):
+    """Create one line plot from its filled in YAML settings and return the time it took."""
+    start = perf_counter()
+    plot = SharedDataLine(settings)
+    plot.save_to_file()
+    plot.write_html()
+    plot.write_output_file()
+    execution_time = perf_counter() - start
+    plot.logger.info(f"Finished creating line plot, execution time: {execution_time} seconds")
+    return execution_time
+
+
 def main():
 
     # Read the input data, input files, and output files
@@ -23,6 +90,9 @@ def main():
     yaml_file_dir = os.environ['PLOTTING_CNT_YAML_CONFIG_DIR']
     plot_output_dir = os.environ['PLOTTING_CNT_OUTPUT_DIR']
 
+    # Number of plots created at once, all cores by default
+    num_workers = int(os.environ.get('PLOTTING_CNT_NUM_WORKERS') or os.cpu_count())
+
     # Make output plot directory if if doesn't exist
     if not os.path.exists(plot_output_dir):
         os.makedirs(plot_output_dir)
@@ -31,45 +101,49 @@ def main():
     if not len(plotting_vars) == len(var_longnames) == len(var_units):
         raise RuntimeError('The length of PLOTTING_CNT_FCST_VAR_LIST must be equal to the lengths of PLOTTING_CNT_FCST_VAR_NAME_LIST and PLOTTING_CNT_FCST_VAR_UNITS_LIST')
 
-    # Loop through the variables
-    for v,n,u in zip(plotting_vars,var_longnames,var_units):
+    # Every plot of the variables, masks, and configurations
+    jobs = expand_jobs(plotting_vars, var_longnames, var_units, plotting_masks, yaml_files, yaml_file_dir, plot_output_dir)
 
-        os.environ['FCST_VAR_VAL1'] = v
-        os.environ['PLOTTING_CNT_LONG_VAR'] = n
-        os.environ['PLOTTING_CNT_VAR_UNITS'] = u
+    # Read in each YAML configuration file once.  Environment variables in
+    # the configuration file are supported, and are filled in for each plot.
+    templates = {}
+    for config_file in sorted({job['PLOTTING_CNT_YAML_CONFIG_NAME'] for job in jobs}):
+        try:
+            templates[config_file] = read_template(config_file)
+        except yaml.YAMLError as exc:
+            logging.error(exc)
 
-        # Loop throuth masks
-        for m in plotting_masks:
+    all_settings = []
+    for job in jobs:
+        if job['PLOTTING_CNT_YAML_CONFIG_NAME'] in templates:
+            settings = substitute(templates[job['PLOTTING_CNT_YAML_CONFIG_NAME']], job)
+            logging.info(settings)
+            all_settings.append(settings)
 
-            os.environ['PLOTTING_CNT_OUTPUT_FILENAME'] = os.path.join(plot_output_dir,v+'_'+m)
-            os.environ['PLOTTING_CNT_MASK'] = m
+    # Read the reformatted data once for all the plots
+    start = perf_counter()
+    stat_data = {}
+    for stat_input in sorted({settings['stat_input'] for settings in all_settings}):
+        stat_data[stat_input] = read_stat_input(stat_input)
+    print(f"Read the plotting data in {perf_counter() - start:.3f} s")
 
-            # Loop through data
-            for i in yaml_files:
+    # Create the plots in separate processes, reporting each one
+    failed = len(jobs) - len(all_settings)
+    with ProcessPoolExecutor(max_workers=min(num_workers, max(len(all_settings), 1)),
+                             initializer=_init_worker, initargs=(stat_data,)) as pool:
+        futures = {pool.submit(plot_line, settings): settings['plot_filename'] for settings in all_settings}
+        for future in as_completed(futures):
+            plot_filename = futures[future]
+            try:
+                execution_time = future.result()
+                print(f"{plot_filename} in {execution_time:.3f} s")
+            except Exception as err:
+                failed += 1
+                print(f"ERROR: {plot_filename} failed: {err!r}")
 
-                # Build yaml config file name
-                os.environ['PLOTTING_CNT_YAML_CONFIG_NAME'] = os.path.join(yaml_file_dir,i)
-
-                # Read in the YAML configuration file.  Environment variables in
-                # the configuration file are supported.
-                try:
-                    input_config_file = os.getenv("PLOTTING_CNT_YAML_CONFIG_NAME", "custom_line.yaml")
-                    settings = readconfig.parse_config(input_config_file)
-                    logging.info(settings)
-                except yaml.YAMLError as exc:
-                    logging.error(exc)
-
-                try:
-                    start = perf_counter()
-                    plot = line.Line(settings)
-                    plot.save_to_file()
-                    plot.write_html()
-                    plot.write_output_file()
-                    end = perf_counter()
-                    execution_time = end - start
-                    plot.logger.info(f"Finished creating line plot, execution time: {execution_time} seconds")
-                except ValueError as val_er:
-                    print(val_er)
+    print(f"Created {len(jobs) - failed} line plots in {perf_counter() - start:.3f} s")
+    if failed:
+        sys.exit(1)
 
 if __name__ == "__main__":
   main()
@@ -1,12 +1,69 @@
 #!/usr/bin/env python3
 
 import os
+import sys
 from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import logging
 import yaml
-import metcalcpy.util.read_env_vars_in_config as readconfig
 from metplotpy.plots.wind_rose import wind_rose
 
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from plot_config import read_template, substitute
+from stat_reader import read_stat
+
+
+# Wind MPR rows of each rose, selected once in the parent and shared by
+# every plot in a process
+_STAT_DATA = {}
+
+
+class SharedDataWindRosePlot(wind_rose.WindRosePlot):
+    """wind_rose.WindRosePlot taking its MPR rows from the data loaded up front."""
+
+    def __init__(self, parameters, data_key):
+        self._data_key = data_key
+        super().__init__(parameters)
+
+    def _read_input_data(self):
+        # The plot may change its data, so give it a copy
+        return _STAT_DATA[self._data_key].copy()
+
+
+def parse_hours(window):
+    """Return the valid hours of a window given as HH or HH-HH (inclusive, may wrap past 23)."""
+    if '-' in window:
+        beg, end = (int(h) for h in window.split('-'))
+        return [h % 24 for h in range(beg, beg + (end - beg) % 24 + 1)]
+    return [int(window)]
+
+
+def select_rows(data, mask=None, hours=None):
+    """Return the MPR rows of one mask and of the valid hours of one time window."""
+    keep = data['FCST_VAR'].isin(['UGRD', 'VGRD'])
+    if mask:
+        keep &= data['VX_MASK'].eq(mask)
+    if hours is not None:
+        keep &= data['FCST_VALID_BEG'].str.slice(9, 11).astype(int).isin(hours)
+    return data.loc[keep].reset_index(drop=True)
+
+
+def _init_worker(stat_data):
+    # Share the data selected by the parent with the plots of this worker
+    _STAT_DATA.update(stat_data)
+
+
+def plot_wind_rose(settings, data_key):
+    """Create one wind rose from its filled in YAML settings and return the time it took."""
+    start = perf_counter()
+    plot = SharedDataWindRosePlot(settings, data_key)
+    plot.save_to_file()
+    plot.write_output_file()
+    execution_time = perf_counter() - start
+    plot.logger.info(f"Finished creating wind rose plot, execution time: {execution_time} seconds")
+    return execution_time
+
+
 def main():
 
     # Read the input files
@@ -20,41 +77,79 @@ def main():
     plot_output_file_labels_str = os.environ['WIND_ROSE_OUTPUT_LABELS'].split(',')
     plot_output_file_labels = [ol.lstrip() for ol in plot_output_file_labels_str]
 
+    # Optional masks and valid hour windows (HH or HH-HH) to make separate
+    # roses for, from each input file.  Their names are added to the labels.
+    plot_masks = [m.strip() for m in os.environ.get('WIND_ROSE_VX_MASK_LIST', '').split(',') if m.strip()]
+    plot_windows = [w.strip() for w in os.environ.get('WIND_ROSE_VALID_HOUR_LIST', '').split(',') if w.strip()]
+
+    # Number of roses drawn at once, all cores by default
+    num_workers = int(os.environ.get('WIND_ROSE_NUM_WORKERS') or os.cpu_count())
+
+    # Cache the parsed stat files as Parquet next to them
+    stat_cache = os.environ.get('STAT_PARQUET_CACHE', 'False').lower() in ('true', 'yes', '1')
+
     # Check to see that the two lists have the same number of elements
     # If they dont', error out
     if len(plot_input_files_list) != len(plot_output_file_labels):
         raise RuntimeError('The number of files in WIND_ROSE_STAT_INPUT_FILES must be equal to the number of labels in WIND_ROSE_OUTPUT_LABELS')
 
+    # Read in each YAML configuration file once.  Environment variables in
+    # the configuration file are supported, and are filled in for each rose.
+    templates = {}
+    for i in yaml_files:
+        try:
+            templates[i] = read_template(os.path.join(yaml_file_dir,i))
+        except yaml.YAMLError as exc:
+            logging.error(exc)
 
-    # Loop through data
+    # Read each input file once, and select the wind pairs of each mask and
+    # time window from it
+    start = perf_counter()
+    stat_data = {}
+    stat_inputs = {}
     for f,l in zip(plot_input_files_list,plot_output_file_labels):
-        os.environ['WIND_ROSE_STAT_INPUT'] = os.path.join(plot_input_dir,f)
-
-        os.environ['WIND_ROSE_OUTPUT_LABEL'] = l
+        stat_input = os.path.join(plot_input_dir,f)
+        data = read_stat(stat_input, filters={'FCST_VAR': ['UGRD', 'VGRD']}, cache=stat_cache)
+        for m in plot_masks or [None]:
+            for w in plot_windows or [None]:
+                label = '_'.join(s for s in [l, m, w] if s)
+                rows = select_rows(data, m, parse_hours(w) if w else None)
+                if rows.empty:
+                    print("WARNING: No wind pairs for "+label)
+                    continue
+                stat_data[label] = rows
+                stat_inputs[label] = stat_input
+    print(f"Read the wind pairs in {perf_counter() - start:.3f} s")
 
+    # One rose per configuration of each label
+    jobs = []
+    for label in stat_data:
         for i in yaml_files:
+            if i in templates:
+                settings = substitute(templates[i], {
+                    'WIND_ROSE_STAT_INPUT': stat_inputs[label],
+                    'WIND_ROSE_OUTPUT_LABEL': label,
+                })
+                logging.info(settings)
+                jobs.append((settings, label))
+    failed = len(stat_data) * len(yaml_files) - len(jobs)
 
-            os.environ['WIND_ROSE_YAML_CONFIG_NAME'] = os.path.join(yaml_file_dir,i)
-
-            # Read in the YAML configuration file.  Environment variables in
-            # the configuration file are supported.
+    # Draw the roses in separate processes, reporting each one
+    with ProcessPoolExecutor(max_workers=min(num_workers, max(len(jobs), 1)),
+                             initializer=_init_worker, initargs=(stat_data,)) as pool:
+        futures = {pool.submit(plot_wind_rose, settings, label): settings['plot_filename'] for settings, label in jobs}
+        for future in as_completed(futures):
+            plot_filename = futures[future]
             try:
-                input_config_file = os.getenv("WIND_ROSE_YAML_CONFIG_NAME", "custom_wind_rose.yaml")
-                settings = readconfig.parse_config(input_config_file)
-                logging.info(settings)
-            except yaml.YAMLError as exc:
-                logging.error(exc)
-
-            #try:
-            start = perf_counter()
-            plot = wind_rose.WindRosePlot(settings)
-            plot.save_to_file()
-            plot.write_output_file()
-            end = perf_counter()
-            execution_time = end - start
-            plot.logger.info(f"Finished creating wind rose plot, execution time: {execution_time} seconds")
-            #except ValueError as val_er:
-            #    print(val_er)
+                execution_time = future.result()
+                print(f"{plot_filename} in {execution_time:.3f} s")
+            except Exception as err:
+                failed += 1
+                print(f"ERROR: {plot_filename} failed: {err!r}")
+
+    print(f"Created {len(stat_data) * len(yaml_files) - failed} wind roses in {perf_counter() - start:.3f} s")
+    if failed:
+        sys.exit(1)
 
 if __name__ == "__main__":
   main()
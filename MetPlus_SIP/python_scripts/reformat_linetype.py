@@ -1,10 +1,30 @@
 #!/usr/bin/env python3
 
+# Reformat MET .stat output into the format METplotpy reads, using METdbLoad
+# to read the files and METreformat to write them.
+#
+# With incremental: True in the YAML configuration, each input .stat file is
+# reformatted into its own partition file, and a manifest next to the output
+# file records the path, size, modification time, and SHA-1 of every file
+# reformatted so far.  Later runs only read new or changed files, drop the
+# partitions of removed files, and rebuild the output file by concatenating
+# the partitions, which gives the same rows as a full rebuild without
+# re-reading the whole archive.
+#
+# line_type can be a list (or comma separated string) of line types.  The
+# input files are then read once, split by line type, and each line type's
+# output is written in a separate process.
+
 
 import os
 import sys
+import json
 import time
+import hashlib
 import logging
+import tempfile
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from METdbLoad.ush.read_data_files import ReadDataFiles
 from METdbLoad.ush.read_load_xml import XmlLoadFile
@@ -14,6 +34,308 @@ from metcalcpy.util import read_env_vars_in_config as readconfig
 
 logger = logging.getLogger(__name__)
 
+# Bump this when the partitions change
+MANIFEST_VERSION = 1
+
+# Settings that change the reformatted rows, so changing them rebuilds every
+# partition
+REFORMAT_SETTINGS = ['line_type', 'input_stats_aggregated', 'keep_all_mpr_cols']
+
+
+def read_files(load_files):
+    """Read .stat files with METdbLoad and return their stat data."""
+    rdf_obj: ReadDataFiles = ReadDataFiles()
+    xml_loadfile_obj: XmlLoadFile = XmlLoadFile(None)
+    rdf_obj.read_data(xml_loadfile_obj.flags, load_files, xml_loadfile_obj.line_types)
+    return rdf_obj.stat_data
+
+
+def write_reformatted(file_df, settings, output_file):
+    """Write reformatted stat data to output_file, replacing it."""
+    # WriteStatAscii appends to its output file, so start from no file
+    if os.path.exists(output_file):
+        os.remove(output_file)
+    file_settings = dict(settings, output_dir=os.path.dirname(output_file),
+                         output_filename=os.path.basename(output_file))
+    stat_lines_obj: WriteStatAscii = WriteStatAscii(file_settings, logger)
+    stat_lines_obj.write_stat_ascii(file_df, file_settings)
+
+
+def file_checksum(path):
+    """Return the SHA-1 of a file."""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def source_state(stat_file):
+    """Return the size, modification time, and checksum of an input file."""
+    stat = os.stat(stat_file)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': file_checksum(stat_file)}
+
+
+def source_current(stat_file, entry):
+    """Return True if a manifest entry was reformatted from the current contents of stat_file.
+
+    The size and modification time are checked first.  A file with a new
+    modification time but the same size is compared by checksum.
+    """
+    try:
+        stat = os.stat(stat_file)
+    except OSError:
+        return False
+    source = entry['source']
+    if stat.st_size != source['size']:
+        return False
+    return stat.st_mtime_ns == source['mtime_ns'] or file_checksum(stat_file) == source['sha1']
+
+
+def manifest_path(output_file):
+    """Return the manifest of an incremental output file."""
+    return output_file+'.manifest.json'
+
+
+def partition_dir(output_file):
+    """Return the directory of the partitions of an incremental output file."""
+    return output_file+'.parts'
+
+
+def read_manifest(output_file):
+    """Return the manifest of an output file, or an empty one if there is none."""
+    try:
+        with open(manifest_path(output_file)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _replace_atomic(path, write):
+    # Write to a temporary file and rename it so that concurrent readers
+    # never see a partial file
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            write(f)
+        os.chmod(tmp_file, 0o644)
+        os.replace(tmp_file, path)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+
+
+def write_manifest(output_file, manifest):
+    _replace_atomic(manifest_path(output_file), lambda f: json.dump(manifest, f, indent=1, sort_keys=True))
+
+
+def combine_partitions(part_files, output_file):
+    """Concatenate partition files into output_file, keeping the first header line only."""
+    def write(out):
+        header = None
+        for part_file in part_files:
+            with open(part_file) as f:
+                part_header = f.readline()
+                if header is None:
+                    header = part_header
+                    out.write(header)
+                elif part_header != header:
+                    raise RuntimeError('Columns of '+part_file+' do not match the other partitions, '
+                                       'remove '+manifest_path(output_file)+' to rebuild the output')
+                for line in f:
+                    out.write(line)
+    _replace_atomic(output_file, write)
+
+
+def line_type_list(settings):
+    """Return the line types to reformat, from a list or a comma separated string."""
+    line_types = settings['line_type']
+    if isinstance(line_types, str):
+        line_types = line_types.split(',')
+    return [lt.strip().upper() for lt in line_types if lt.strip()]
+
+
+def output_settings(settings, line_types):
+    """Return the settings of the output of each line type.
+
+    {line_type} in output_filename is replaced by the line type.  Without it,
+    the outputs of several line types get _<line type> added before the
+    extension, e.g. reformat.data gives reformat_CNT.data.
+    """
+    filename = settings['output_filename']
+    outputs = {}
+    for lt in line_types:
+        if '{line_type}' in filename:
+            lt_filename = filename.replace('{line_type}', lt)
+        elif len(line_types) > 1:
+            stem, ext = os.path.splitext(filename)
+            lt_filename = stem+'_'+lt+ext
+        else:
+            lt_filename = filename
+        outputs[lt] = dict(settings, line_type=lt, output_filename=lt_filename)
+    return outputs
+
+
+def split_line_types(file_df, line_types):
+    """Return the stat data of each line type."""
+    if file_df is None or 'line_type' not in file_df:
+        return {lt: file_df for lt in line_types}
+    file_line_types = file_df['line_type'].str.upper()
+    return {lt: file_df.loc[file_line_types.eq(lt)] for lt in line_types}
+
+
+def _write_job(file_df, settings, output_file):
+    # Write one output, timing it
+    beg_write_data = time.perf_counter()
+    write_reformatted(file_df, settings, output_file)
+    return time.perf_counter() - beg_write_data
+
+
+def write_outputs(jobs, pool=None):
+    """Write (stat data, settings, output file) jobs, on a process pool if one is given.
+
+    Returns the time taken by each output file.
+    """
+    if pool is None or len(jobs) < 2:
+        return {output_file: _write_job(file_df, settings, output_file) for file_df, settings, output_file in jobs}
+    times = {}
+    futures = {pool.submit(_write_job, *job): job[2] for job in jobs}
+    for future in as_completed(futures):
+        times[futures[future]] = future.result()
+    return times
+
+
+def _output_pool(outputs, num_workers):
+    # Several line types are written in separate processes
+    if len(outputs) < 2 or num_workers < 2:
+        return contextlib.nullcontext()
+    return ProcessPoolExecutor(max_workers=min(num_workers, len(outputs)))
+
+
+def reformat_all(outputs, load_files, num_workers):
+    """Read every input file once and reformat it into the output of each line type."""
+    beg_read_data = time.perf_counter()
+    file_df = read_files(load_files)
+    end_read_data = time.perf_counter()
+    time_to_read = end_read_data - beg_read_data
+    logger.info("Time to read input .stat data files using METdbLoad: %f", time_to_read)
+
+    beg_transform = time.perf_counter()
+    lt_dfs = split_line_types(file_df, list(outputs))
+    logger.info("Time to split the stat data into %d line types: %f", len(outputs), time.perf_counter() - beg_transform)
+
+    # Write stat files in ASCII format, replacing the output from earlier runs
+    jobs = []
+    for lt, settings in outputs.items():
+        output_file = os.path.join(settings['output_dir'], settings['output_filename'])
+        logger.info(f"Writing {lt} to {output_file}")
+        jobs.append((lt_dfs[lt], settings, output_file))
+    beg_write_data = time.perf_counter()
+    with _output_pool(outputs, num_workers) as pool:
+        times = write_outputs(jobs, pool)
+    for output_file, time_to_write in times.items():
+        logger.info("Time to write %s: %f", output_file, time_to_write)
+    logger.info("Time to write %d outputs: %f", len(jobs), time.perf_counter() - beg_write_data)
+
+
+class IncrementalOutput:
+    """Manifest and partitions of one incremental output file."""
+
+    def __init__(self, settings, load_files):
+        self.settings = settings
+        self.output_file = os.path.join(settings['output_dir'], settings['output_filename'])
+        self.parts = partition_dir(self.output_file)
+        os.makedirs(self.parts, exist_ok=True)
+
+        self.manifest = read_manifest(self.output_file)
+        reformat_settings = {k: settings.get(k) for k in REFORMAT_SETTINGS}
+        reformat_settings['version'] = MANIFEST_VERSION
+        if self.manifest.get('settings') != reformat_settings:
+            if self.manifest:
+                logger.info(f"Reformat settings of {self.output_file} changed, reformatting every file")
+            self.manifest = {'settings': reformat_settings, 'files': {}}
+        self.entries = self.manifest['files']
+
+        # Drop the partitions of files that are gone
+        for stat_file in sorted(set(self.entries) - set(load_files)):
+            logger.info(f"Removing the rows of {stat_file} from {self.output_file}")
+            if self.entries[stat_file]['partition']:
+                part_file = os.path.join(self.parts, self.entries[stat_file]['partition'])
+                if os.path.exists(part_file):
+                    os.remove(part_file)
+            del self.entries[stat_file]
+
+    def current(self, stat_file):
+        """Return True if the partition of stat_file is up to date."""
+        entry = self.entries.get(stat_file)
+        if entry is None or not source_current(stat_file, entry):
+            return False
+        return entry['partition'] is None or os.path.exists(os.path.join(self.parts, entry['partition']))
+
+    def partition_file(self, stat_file):
+        return os.path.join(self.parts, hashlib.sha1(stat_file.encode()).hexdigest()[:16]+'.data')
+
+    def record(self, stat_file, state, written):
+        # Record each file as it is done, so an interrupted run resumes
+        partition = os.path.basename(self.partition_file(stat_file)) if written else None
+        if not written and os.path.exists(self.partition_file(stat_file)):
+            os.remove(self.partition_file(stat_file))
+        self.entries[stat_file] = {'source': state, 'partition': partition}
+        write_manifest(self.output_file, self.manifest)
+
+    def combine(self, load_files):
+        # Rebuild the output in the order a full rebuild reads the files
+        part_files = [os.path.join(self.parts, self.entries[f]['partition'])
+                      for f in load_files if self.entries[f]['partition']]
+        combine_partitions(part_files, self.output_file)
+        write_manifest(self.output_file, self.manifest)
+        return len(part_files)
+
+
+def reformat_incremental(outputs, load_files, num_workers):
+    """Reformat only new or changed input files, then rebuild each output file from its partitions.
+
+    A file that is new for any of the outputs is read once for all of them.
+    """
+    load_files = [os.path.abspath(f) for f in load_files]
+    incremental = {lt: IncrementalOutput(settings, load_files) for lt, settings in outputs.items()}
+
+    new_files = [f for f in load_files if not all(out.current(f) for out in incremental.values())]
+    logger.info(f"{len(new_files)} of {len(load_files)} input files are new or changed")
+
+    time_to_read = 0.
+    time_to_transform = 0.
+    time_to_write = 0.
+    with _output_pool(outputs, num_workers) as pool:
+        for stat_file in new_files:
+            state = source_state(stat_file)
+            beg_read_data = time.perf_counter()
+            file_df = read_files([stat_file])
+            time_to_read += time.perf_counter() - beg_read_data
+
+            beg_transform = time.perf_counter()
+            stale = [lt for lt, out in incremental.items() if not out.current(stat_file)]
+            lt_dfs = split_line_types(file_df, stale)
+            time_to_transform += time.perf_counter() - beg_transform
+
+            beg_write_data = time.perf_counter()
+            jobs = [(lt_dfs[lt], incremental[lt].settings, incremental[lt].partition_file(stat_file))
+                    for lt in stale if lt_dfs[lt] is not None and not lt_dfs[lt].empty]
+            write_outputs(jobs, pool)
+            written = {job[2] for job in jobs}
+            for lt in stale:
+                incremental[lt].record(stat_file, state, incremental[lt].partition_file(stat_file) in written)
+            time_to_write += time.perf_counter() - beg_write_data
+    logger.info("Time to read input .stat data files using METdbLoad: %f", time_to_read)
+    logger.info("Time to split the stat data into line types: %f", time_to_transform)
+    logger.info("Time to write the reformatted partitions: %f", time_to_write)
+
+    for lt, out in incremental.items():
+        beg_combine = time.perf_counter()
+        num_parts = out.combine(load_files)
+        logger.info("Time to combine %d %s partitions: %f", num_parts, lt, time.perf_counter() - beg_combine)
+
+
 def main():
 
     if len(sys.argv) == 2:
@@ -22,7 +344,7 @@ def main():
         print("Must specify exactly one input yaml configuration file.")
         sys.exit(1)
 
-    # Read in the YAML configuration file.  Environment variables in the 
+    # Read in the YAML configuration file.  Environment variables in the
     # configuration file are supported.
     #input_cnt_config_file = os.getenv(input_yaml_file, "reformat_VCNT.yaml")
     settings = readconfig.parse_config(input_config_file)
@@ -30,35 +352,23 @@ def main():
 
     # Replacing the need for an XML specification file, pass in the XMLLoadFile and
     # ReadDataFile parameters
-    rdf_obj: ReadDataFiles = ReadDataFiles()
     xml_loadfile_obj: XmlLoadFile = XmlLoadFile(None)
 
     # Retrieve all the filenames in the data_dir specified in the YAML config file
     load_files = xml_loadfile_obj.filenames_from_template(settings['input_data_dir'],{})
-    flags = xml_loadfile_obj.flags
-    line_types = xml_loadfile_obj.line_types
-    beg_read_data = time.perf_counter()
-    rdf_obj.read_data(flags, load_files, line_types)
-    end_read_data = time.perf_counter()
-    time_to_read = end_read_data - beg_read_data
-    logger.info("Time to read input .stat data files using METdbLoad: %f", time_to_read)
-    file_df = rdf_obj.stat_data
 
     # Check if the output directory exists.  If not, make it
     if not os.path.exists(settings['output_dir']):
         os.makedirs(settings['output_dir'])
 
-    # Check if the output file already exists, if so, delete it to avoid
-    # appending output from subsequent runs into the same file.
-    existing_output_file = os.path.join(settings['output_dir'], settings['output_filename'])
-    logger.info("Checking if {existing_output_file}  already exists")
-    if os.path.exists(existing_output_file):
-        logger.info("Removing existing output file {existing_output_file}")
-        os.remove(existing_output_file)
-
-    # Write stat file in ASCII format
-    stat_lines_obj: WriteStatAscii = WriteStatAscii(settings, logger)
-    stat_lines_obj.write_stat_ascii(file_df, settings)
+    # One output per line type, all from one read of the input files
+    outputs = output_settings(settings, line_type_list(settings))
+    num_workers = int(settings.get('num_workers') or os.cpu_count())
+
+    if str(settings.get('incremental', False)).lower() in ('true', 'yes', '1'):
+        reformat_incremental(outputs, load_files, num_workers)
+    else:
+        reformat_all(outputs, load_files, num_workers)
 
 
 if __name__ == "__main__":
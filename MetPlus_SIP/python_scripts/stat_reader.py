@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+# Shared reader for MET .stat files with a full header line, such as the
+# STAT-Analysis -out_stat and -dump_row output read by the plotting scripts.
+#
+# Only the requested columns are parsed, rows are filtered on column values
+# (FCST_VAR, VX_MASK, ...) chunk by chunk while the file is read, so memory
+# stays bounded by the rows kept, and the parsed table can optionally be
+# cached as Parquet next to the source file.  Later reads of a cached file
+# only load the requested columns and row groups.
+#
+# Header columns that hold text (times, names, thresholds) and the station ID
+# and QC columns are read as strings, and every other column as numbers with
+# NA as missing, so the column types do not depend on the values in a chunk.
+# The Parquet cache stores every numeric column as float64.
+
+import os
+import json
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+# Header columns shared by every line type, up to and including LINE_TYPE
+HEADER_COLUMNS = [
+    'VERSION', 'MODEL', 'DESC', 'FCST_LEAD', 'FCST_VALID_BEG', 'FCST_VALID_END',
+    'OBS_LEAD', 'OBS_VALID_BEG', 'OBS_VALID_END', 'FCST_VAR', 'FCST_UNITS', 'FCST_LEV',
+    'OBS_VAR', 'OBS_UNITS', 'OBS_LEV', 'OBTYPE', 'VX_MASK', 'INTERP_MTHD', 'INTERP_PNTS',
+    'FCST_THRESH', 'OBS_THRESH', 'COV_THRESH', 'ALPHA', 'LINE_TYPE',
+]
+
+# Columns read as strings
+STRING_COLUMNS = {
+    'VERSION', 'MODEL', 'DESC', 'FCST_LEAD', 'FCST_VALID_BEG', 'FCST_VALID_END',
+    'OBS_LEAD', 'OBS_VALID_BEG', 'OBS_VALID_END', 'FCST_VAR', 'FCST_UNITS', 'FCST_LEV',
+    'OBS_VAR', 'OBS_UNITS', 'OBS_LEV', 'OBTYPE', 'VX_MASK', 'INTERP_MTHD',
+    'FCST_THRESH', 'OBS_THRESH', 'COV_THRESH', 'LINE_TYPE', 'OBS_SID', 'OBS_QC',
+}
+
+# Rows parsed at a time
+DEFAULT_CHUNKSIZE = 500000
+
+# Bump this when the cached tables change
+CACHE_VERSION = 1
+
+
+def read_header(stat_file):
+    """Return the column names in the header line of a .stat file."""
+    with open(stat_file) as f:
+        return f.readline().split()
+
+
+def _read_options(header, columns):
+    # Keep NA as text in string columns and parse it as missing elsewhere
+    return {
+        'sep': r'\s+',
+        'engine': 'c',
+        'usecols': columns,
+        'dtype': {c: str for c in columns if c in STRING_COLUMNS},
+        'keep_default_na': False,
+        'na_values': {c: ['NA'] for c in columns if c not in STRING_COLUMNS},
+    }
+
+
+def _check_columns(header, columns, stat_file):
+    missing = [c for c in columns if c not in header]
+    if missing:
+        raise KeyError('Columns '+', '.join(missing)+' not in '+stat_file)
+
+
+def _filter_mask(frame, filters):
+    keep = np.ones(len(frame), dtype=bool)
+    for column, values in filters.items():
+        values = [values] if isinstance(values, str) or np.isscalar(values) else list(values)
+        keep &= frame[column].isin(values).to_numpy()
+    return keep
+
+
+def _to_numeric(chunk):
+    # Numeric columns holding text that is not a number get NaN
+    for column in chunk.columns:
+        if column not in STRING_COLUMNS and chunk[column].dtype == object:
+            chunk[column] = pd.to_numeric(chunk[column], errors='coerce')
+    return chunk
+
+
+def iter_stat(stat_file, columns=None, filters=None, chunksize=DEFAULT_CHUNKSIZE):
+    """Yield DataFrames of the rows of a .stat file matching filters, a chunk at a time.
+
+    columns lists the columns to read, all of them by default.  filters maps
+    a column name to a value or list of values to keep.
+    """
+    header = read_header(stat_file)
+    filters = filters or {}
+    columns = list(columns) if columns else header
+    read_columns = columns + [c for c in filters if c not in columns]
+    _check_columns(header, read_columns, stat_file)
+
+    with pd.read_csv(stat_file, chunksize=chunksize, **_read_options(header, read_columns)) as reader:
+        for chunk in reader:
+            chunk = _to_numeric(chunk)
+            if filters:
+                chunk = chunk.loc[_filter_mask(chunk, filters)]
+            yield chunk[columns]
+
+
+def cache_path(stat_file):
+    """Return the Parquet cache file of a .stat file."""
+    return stat_file+'.parquet'
+
+
+def _source_key(stat_file):
+    stat = os.stat(stat_file)
+    return {'version': CACHE_VERSION, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _cache_current(stat_file, cfile):
+    import pyarrow.parquet as pq
+
+    try:
+        metadata = pq.read_schema(cfile).metadata or {}
+        return json.loads(metadata.get(b'stat_source', b'null')) == _source_key(stat_file)
+    except (OSError, ValueError):
+        return False
+
+
+def write_cache(stat_file, chunksize=DEFAULT_CHUNKSIZE):
+    """Parse a whole .stat file a chunk at a time into its Parquet cache."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    cfile = cache_path(stat_file)
+    source = json.dumps(_source_key(stat_file)).encode()
+
+    # Write to a temporary file and rename it so that concurrent readers
+    # never see a partial cache
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(cfile)), suffix='.parquet.tmp')
+    os.close(fd)
+    writer = None
+    try:
+        for chunk in iter_stat(stat_file, chunksize=chunksize):
+            # An integer column can hold NA in a later chunk, so store all
+            # numeric columns as floats
+            numeric = [c for c in chunk.columns if c not in STRING_COLUMNS]
+            chunk = chunk.astype({c: np.float64 for c in numeric})
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                schema = table.schema.with_metadata({b'stat_source': source})
+                writer = pq.ParquetWriter(tmp_file, schema, compression='zstd')
+            writer.write_table(table.cast(schema))
+        if writer is None:
+            raise ValueError('No rows in '+stat_file)
+        writer.close()
+        os.chmod(tmp_file, 0o644)
+        os.replace(tmp_file, cfile)
+    except BaseException:
+        if writer is not None:
+            writer.close()
+        os.remove(tmp_file)
+        raise
+    return cfile
+
+
+def read_stat(stat_file, columns=None, filters=None, cache=False, chunksize=DEFAULT_CHUNKSIZE):
+    """Return the rows of a .stat file matching filters as a DataFrame.
+
+    See iter_stat for columns and filters.  With cache set, the file is
+    parsed once into a Parquet cache next to it (rebuilt when the file
+    changes), and the columns and rows are read from the cache.
+    """
+    if cache:
+        cfile = cache_path(stat_file)
+        if not _cache_current(stat_file, cfile):
+            write_cache(stat_file, chunksize)
+
+        import pyarrow.parquet as pq
+
+        filters = filters or {}
+        read_columns = list(columns) if columns else None
+        if read_columns is not None:
+            _check_columns(pq.read_schema(cfile).names, read_columns + list(filters), stat_file)
+        pq_filters = [(c, 'in', [v] if isinstance(v, str) or np.isscalar(v) else list(v)) for c, v in filters.items()]
+        table = pq.read_table(cfile, columns=read_columns, filters=pq_filters or None)
+        return table.to_pandas()
+
+    chunks = list(iter_stat(stat_file, columns, filters, chunksize))
+    if not chunks:
+        return pd.DataFrame(columns=list(columns) if columns else read_header(stat_file))
+    return pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0].reset_index(drop=True)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+# Station to grid interpolation index for the WRF fields from wrf_sfc.py.
+#
+# Station latitudes and longitudes are projected onto the Lambert Conformal
+# grid described by the MET grid dictionary that wrf_sfc.convert returns,
+# and the four points and weights of the width 2 bilinear (BILIN)
+# interpolation that PointStat uses are stored for each station.  The index
+# is cached per grid, so a new set of stations only projects the stations
+# that were not seen before.
+
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+
+
+# Columns of a station index
+INDEX_COLUMNS = ['sid', 'lat', 'lon', 'x', 'y', 'points', 'weights']
+
+
+def grid_key(grid):
+    """Return a short hash identifying a MET grid dictionary."""
+    grid = {k: v for k, v in grid.items() if k != 'name'}
+    return hashlib.sha1(json.dumps(grid, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def lambert_xy(grid, lat, lon):
+    """Return the MET grid coordinates of latitudes and longitudes on a Lambert Conformal grid.
+
+    Grid coordinates are in grid points, with x increasing east and y
+    increasing north from the south-west corner at (0, 0).
+    """
+    if not grid['type'].lower().startswith('lambert'):
+        raise ValueError('Grid type '+grid['type']+' not supported')
+    if grid['hemisphere'] != 'N':
+        raise ValueError('Only northern hemisphere Lambert Conformal grids are supported')
+
+    lat1, lat2 = np.radians(grid['scale_lat_1']), np.radians(grid['scale_lat_2'])
+    if np.isclose(lat1, lat2):
+        cone = np.sin(lat1)
+    else:
+        cone = np.log(np.cos(lat1) / np.cos(lat2)) / np.log(np.tan(np.pi/4 + lat2/2) / np.tan(np.pi/4 + lat1/2))
+    scale = grid['r_km'] * np.cos(lat1) * np.tan(np.pi/4 + lat1/2)**cone / cone
+
+    def project(lat, lon):
+        # Distance from the pole and angle about it, in km and radians
+        rho = scale / np.tan(np.pi/4 + np.radians(lat)/2)**cone
+        theta = cone * np.radians((np.asarray(lon) - grid['lon_orient'] + 180) % 360 - 180)
+        return rho * np.sin(theta), -rho * np.cos(theta)
+
+    x_pin, y_pin = project(grid['lat_pin'], grid['lon_pin'])
+    x, y = project(lat, lon)
+    return grid['x_pin'] + (x - x_pin) / grid['d_km'], grid['y_pin'] + (y - y_pin) / grid['d_km']
+
+
+def bilin_weights(grid, x, y):
+    """Return the points and weights of width 2 bilinear interpolation at grid coordinates.
+
+    points holds the flat indices of the four surrounding grid points in a
+    met_data array (first row north), and weights their weights.  Points
+    outside the grid get index -1 and NaN weights.
+    """
+    nx, ny = grid['nx'], grid['ny']
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    inside = (x >= 0) & (x <= nx - 1) & (y >= 0) & (y <= ny - 1)
+
+    # Stay in the last cell for points on the east and north edges
+    x0 = np.clip(np.floor(np.where(inside, x, 0)), 0, max(nx - 2, 0)).astype(np.int64)
+    y0 = np.clip(np.floor(np.where(inside, y, 0)), 0, max(ny - 2, 0)).astype(np.int64)
+    dx, dy = x - x0, y - y0
+
+    # met_data is flipped north to south, so grid row y is array row ny-1-y
+    row0, row1 = ny - 1 - y0, ny - 2 - y0
+    points = np.stack([row0*nx + x0, row0*nx + x0 + 1, row1*nx + x0, row1*nx + x0 + 1], axis=-1)
+    weights = np.stack([(1-dx)*(1-dy), dx*(1-dy), (1-dx)*dy, dx*dy], axis=-1)
+
+    points[~inside] = -1
+    weights[~inside] = np.nan
+    return points, weights
+
+
+def build_index(grid, sid, lat, lon):
+    """Return the interpolation index of stations on a grid as a dictionary of columns."""
+    x, y = lambert_xy(grid, lat, lon)
+    points, weights = bilin_weights(grid, x, y)
+    return {
+        'sid': np.asarray(sid).astype(str),
+        'lat': np.asarray(lat, dtype=np.float64),
+        'lon': np.asarray(lon, dtype=np.float64),
+        'x': x,
+        'y': y,
+        'points': points,
+        'weights': weights,
+    }
+
+
+def _station_keys(sid, lat, lon):
+    # Stations are identified by their ID and location, since a station can
+    # report from slightly different locations over time
+    return np.char.add(np.char.add(np.asarray(sid).astype(str), '|'),
+                       np.char.add(np.char.add(np.asarray(lat, dtype=np.float64).astype(str), '|'),
+                                   np.asarray(lon, dtype=np.float64).astype(str)))
+
+
+def load_index(grid, sid, lat, lon, cache_dir=None):
+    """Return the interpolation index of stations, in the order given.
+
+    With a cache directory the index of every station seen on this grid is
+    kept in station_index_<grid hash>.npz and only new stations are projected.
+    """
+    keys = _station_keys(sid, lat, lon)
+    uniq_keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    sid, lat, lon = np.asarray(sid)[first], np.asarray(lat)[first], np.asarray(lon)[first]
+
+    cached = None
+    if cache_dir:
+        cfile = os.path.join(cache_dir, 'station_index_'+grid_key(grid)+'.npz')
+        try:
+            with np.load(cfile) as f:
+                cached = {c: f[c] for c in INDEX_COLUMNS}
+        except (OSError, ValueError, KeyError):
+            cached = None
+
+    if cached is not None:
+        cached_keys = _station_keys(cached['sid'], cached['lat'], cached['lon'])
+        new = ~np.isin(uniq_keys, cached_keys)
+    else:
+        new = np.ones(len(uniq_keys), dtype=bool)
+
+    if cached is None or new.any():
+        added = build_index(grid, sid[new], lat[new], lon[new])
+        cached = added if cached is None else {c: np.concatenate([cached[c], added[c]]) for c in INDEX_COLUMNS}
+        if cache_dir and new.any():
+            _write_index(cfile, cached)
+        cached_keys = _station_keys(cached['sid'], cached['lat'], cached['lon'])
+
+    # Map the requested stations onto rows of the index
+    order = np.argsort(cached_keys)
+    rows = order[np.searchsorted(cached_keys, uniq_keys, sorter=order)][inverse.ravel()]
+    return {c: cached[c][rows] for c in INDEX_COLUMNS}
+
+
+def _write_index(path, index):
+    # Write to a temporary file and rename it so that concurrent readers
+    # never see a partial index
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **index)
+        os.chmod(tmp_file, 0o644)
+        os.replace(tmp_file, path)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+
+
+def interpolate(met_data, index):
+    """Return the met_data field interpolated to the stations of an index.
+
+    Stations outside the grid, or next to missing grid values, get NaN.
+    """
+    flat = np.asarray(met_data, dtype=np.float64).ravel()
+    points = index['points']
+    values = np.where(points >= 0, flat[np.maximum(points, 0)], np.nan)
+    return np.sum(values * index['weights'], axis=-1)
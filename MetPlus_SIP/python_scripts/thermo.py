@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+
+# NumPy implementations of the MetPy calculations used by the converters.
+#
+# The formulas and constants follow MetPy 1.7 (saturation vapor pressure over
+# liquid water from Ambaum 2020, Bolton-style dewpoint inversion, NOAA 1976
+# altimeter setting), but work on plain arrays in SI units instead of pint
+# quantities.  Each function computes in the dtype of its inputs, so float32
+# model fields stay float32, and accepts an optional output buffer.  Where a
+# docstring says so, that buffer may be one of the inputs, which is then
+# overwritten with the result instead of allocating a new array.
+#
+# Running this file compares every kernel with MetPy on random inputs.  In
+# float64 the results agree with MetPy to a relative tolerance of 1e-10; in
+# float32 to 1e-4 (about 0.03 K in dewpoint, 0.01 % in RH and 10 Pa in
+# station pressure).
+
+import sys
+import numpy as np
+
+
+# Constants, as defined in metpy.constants
+RD = 287.04749097718457
+RV = 461.52311572606084
+EPSILON = RD / RV
+T0 = 273.16
+ZERO_DEGC = 273.15
+SAT_PRESSURE_0C = 611.2
+LV = 2500840.0
+CP_L = 4219.400000000001
+CP_V = 1860.078011865639
+G = 9.80665
+
+# Standard atmosphere used for altimeter settings
+STD_T0 = 288.0
+STD_P0 = 101325.0
+STD_LAPSE_RATE = 0.0065
+
+# Conversions to SI units: kind -> units string -> (scale, offset)
+UNITS = {
+    'temperature': {
+        'K': (1.0, 0.0), 'kelvin': (1.0, 0.0),
+        'degC': (1.0, ZERO_DEGC), 'C': (1.0, ZERO_DEGC), 'celsius': (1.0, ZERO_DEGC),
+        'degF': (5.0 / 9.0, ZERO_DEGC - 32.0 * 5.0 / 9.0), 'F': (5.0 / 9.0, ZERO_DEGC - 32.0 * 5.0 / 9.0),
+    },
+    'pressure': {
+        'Pa': (1.0, 0.0), 'pascal': (1.0, 0.0),
+        'hPa': (100.0, 0.0), 'mb': (100.0, 0.0), 'millibar': (100.0, 0.0),
+    },
+    'specific_humidity': {
+        'kg kg-1': (1.0, 0.0), 'kg/kg': (1.0, 0.0), '1': (1.0, 0.0), '': (1.0, 0.0),
+        'g kg-1': (1e-3, 0.0), 'g/kg': (1e-3, 0.0),
+    },
+    'length': {
+        'm': (1.0, 0.0), 'meter': (1.0, 0.0), 'meters': (1.0, 0.0), 'km': (1000.0, 0.0),
+        'ft': (0.3048, 0.0), 'feet': (0.3048, 0.0),
+    },
+    'speed': {
+        'm s-1': (1.0, 0.0), 'm/s': (1.0, 0.0), 'meter/sec': (1.0, 0.0), 'meters/second': (1.0, 0.0),
+        'knot': (0.514444, 0.0), 'knots': (0.514444, 0.0), 'kt': (0.514444, 0.0),
+    },
+    'angle': {
+        'degree': (1.0, 0.0), 'degrees': (1.0, 0.0), 'deg': (1.0, 0.0),
+        'radian': (180.0 / np.pi, 0.0), 'radians': (180.0 / np.pi, 0.0),
+    },
+}
+
+# SI units returned by to_si for each kind
+SI_UNITS = {'temperature': 'K', 'pressure': 'Pa', 'specific_humidity': 'kg kg-1',
+            'length': 'm', 'speed': 'm s-1', 'angle': 'degree'}
+
+
+def to_si(values, units, kind):
+    """Return values converted from units to the SI units of kind.
+
+    Angles are returned in degrees.  Raises ValueError for units that are not
+    known for kind, so that a file with unexpected units fails loudly rather
+    than producing wrong numbers.  Values already in SI units are returned
+    without a copy.
+    """
+    try:
+        scale, offset = UNITS[kind][units.strip()]
+    except KeyError:
+        raise ValueError('Units '+repr(units)+' not supported for '+kind)
+    if scale == 1.0 and offset == 0.0:
+        return values
+    return values * scale + offset
+
+
+def _out(out, *arrays):
+    # Allocate an output buffer in the common floating dtype of the inputs
+    if out is not None:
+        return out
+    dtype = np.result_type(*[np.asarray(a).dtype for a in arrays], np.float32)
+    return np.empty(np.broadcast_shapes(*[np.shape(a) for a in arrays]), dtype=dtype)
+
+
+def vapor_pressure_from_specific_humidity(pressure, specific_humidity, out=None):
+    """Water vapor pressure (Pa) from pressure (Pa) and specific humidity (kg/kg).
+
+    out may be specific_humidity.
+    """
+    # e = p w / (epsilon + w) with w = q / (1 - q), which reduces to
+    # e = p / (epsilon / q + 1 - epsilon)
+    out = _out(out, pressure, specific_humidity)
+    np.divide(EPSILON, specific_humidity, out=out)
+    np.add(out, 1.0 - EPSILON, out=out)
+    np.divide(pressure, out, out=out)
+    return out
+
+
+def log_saturation_vapor_pressure(temperature, out=None):
+    """Natural log of the saturation vapor pressure (Pa) over liquid water at temperature (K).
+
+    out may be temperature.
+    """
+    # MetPy's e_s = e_s0 (T0 / T)**hp exp((Lv / T0 - L / T) / Rv) with
+    # L = Lv - (Cp_l - Cp_v) (T - T0), rearranged as a + hp ln(T0 / T) - b / T
+    heat_power = (CP_L - CP_V) / RV
+    a = np.log(SAT_PRESSURE_0C) + (LV / T0 + (CP_L - CP_V)) / RV + heat_power * np.log(T0)
+    b = (LV + (CP_L - CP_V) * T0) / RV
+
+    out = _out(out, temperature)
+    b_over_t = np.divide(b, temperature, dtype=out.dtype)
+    np.log(temperature, out=out)
+    np.multiply(out, -heat_power, out=out)
+    np.add(out, a, out=out)
+    np.subtract(out, b_over_t, out=out)
+    return out
+
+
+def saturation_vapor_pressure(temperature, out=None):
+    """Saturation vapor pressure (Pa) over liquid water at temperature (K).
+
+    out may be temperature.
+    """
+    out = log_saturation_vapor_pressure(temperature, out=out)
+    return np.exp(out, out=out)
+
+
+def dewpoint_from_specific_humidity(pressure, specific_humidity, out=None):
+    """Dewpoint (K) from pressure (Pa) and specific humidity (kg/kg).
+
+    out may be specific_humidity.
+    """
+    out = vapor_pressure_from_specific_humidity(pressure, specific_humidity, out=out)
+
+    # Td = 0C + 243.5 val / (17.67 - val) with val = ln(e / e_s0), written as
+    # 243.5 * 17.67 / (17.67 - val) - 243.5 so no second buffer is needed
+    np.divide(out, SAT_PRESSURE_0C, out=out)
+    np.log(out, out=out)
+    np.subtract(17.67, out, out=out)
+    np.divide(243.5 * 17.67, out, out=out)
+    np.add(out, ZERO_DEGC - 243.5, out=out)
+    return out
+
+
+def relative_humidity_from_specific_humidity(pressure, temperature, specific_humidity, out=None):
+    """Relative humidity (%) from pressure (Pa), temperature (K) and specific humidity (kg/kg).
+
+    Where the saturation vapor pressure is not below the total pressure the
+    result is NaN, as in MetPy.  out may be specific_humidity.
+    """
+    out = _out(out, pressure, temperature, specific_humidity)
+    e_s = saturation_vapor_pressure(temperature, out=np.empty_like(out))
+    undefined = e_s >= pressure
+
+    # With mixing ratios w and w_s, MetPy's w / (epsilon + w) * (epsilon + w_s) / w_s
+    # reduces to e / e_s
+    vapor_pressure_from_specific_humidity(pressure, specific_humidity, out=out)
+    np.divide(out, e_s, out=out)
+    np.multiply(out, 100.0, out=out)
+    out[undefined] = np.nan
+    return out
+
+
+def relative_humidity_from_dewpoint(temperature, dewpoint, out=None):
+    """Relative humidity (%) from temperature (K) and dewpoint (K).
+
+    out may be dewpoint.
+    """
+    out = _out(out, temperature, dewpoint)
+    log_e_s = log_saturation_vapor_pressure(temperature, out=np.empty_like(out))
+    log_saturation_vapor_pressure(dewpoint, out=out)
+    np.subtract(out, log_e_s, out=out)
+    np.exp(out, out=out)
+    np.multiply(out, 100.0, out=out)
+    return out
+
+
+def wind_speed(u, v, out=None):
+    """Wind speed from the wind components.
+
+    out may be u or v.
+    """
+    out = _out(out, u, v)
+    return np.hypot(u, v, out=out)
+
+
+def wind_components(speed, direction, u_out=None, v_out=None):
+    """U and V wind components from speed and meteorological direction (degrees).
+
+    v_out may be direction.
+    """
+    u_out = _out(u_out, speed, direction)
+    v_out = _out(v_out, speed, direction)
+    np.deg2rad(direction, out=v_out)
+    np.sin(v_out, out=u_out)
+    np.cos(v_out, out=v_out)
+    np.multiply(u_out, speed, out=u_out)
+    np.multiply(v_out, speed, out=v_out)
+    np.negative(u_out, out=u_out)
+    np.negative(v_out, out=v_out)
+    return u_out, v_out
+
+
+def altimeter_to_station_pressure(altimeter, height, out=None):
+    """Station pressure (Pa) from the altimeter setting (Pa) and station elevation (m).
+
+    out may be height.
+    """
+    n = RD * STD_LAPSE_RATE / G
+    out = _out(out, altimeter, height)
+    np.multiply(height, STD_P0 ** n * STD_LAPSE_RATE / STD_T0, out=out)
+    np.subtract(np.power(altimeter, n, dtype=out.dtype), out, out=out)
+    np.power(out, 1.0 / n, out=out)
+    np.add(out, 30.0, out=out)
+    return out
+
+
+def validate(size=100000, seed=0):
+    """Compare each kernel with MetPy on random inputs and report the largest differences."""
+    import warnings
+    import metpy.calc as mpcalc
+    from metpy.units import units
+
+    rng = np.random.default_rng(seed)
+    pressure = rng.uniform(60000., 105000., size)
+    temperature = rng.uniform(240., 320., size)
+    q = rng.uniform(1e-4, 0.02, size)
+    dewpoint = temperature - rng.uniform(0., 30., size)
+    speed = rng.uniform(0., 40., size)
+    direction = rng.uniform(0., 360., size)
+    altimeter = rng.uniform(95000., 105000., size)
+    height = rng.uniform(-50., 4000., size)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        u_ref, v_ref = mpcalc.wind_components(units.Quantity(speed, 'm/s'), units.Quantity(direction, 'degree'))
+        expected = {
+            'dewpoint_from_specific_humidity': mpcalc.dewpoint_from_specific_humidity(
+                units.Quantity(pressure, 'Pa'), units.Quantity(q, 'kg/kg')).to('K').m,
+            'relative_humidity_from_specific_humidity': mpcalc.relative_humidity_from_specific_humidity(
+                units.Quantity(pressure, 'Pa'), units.Quantity(temperature, 'K'), units.Quantity(q, 'kg/kg')).to('percent').m,
+            'relative_humidity_from_dewpoint': mpcalc.relative_humidity_from_dewpoint(
+                units.Quantity(temperature, 'K'), units.Quantity(dewpoint, 'K')).to('percent').m,
+            'wind_speed': mpcalc.wind_speed(u_ref, v_ref).m,
+            'u_component': u_ref.m,
+            'v_component': v_ref.m,
+            'altimeter_to_station_pressure': mpcalc.altimeter_to_station_pressure(
+                units.Quantity(altimeter, 'Pa'), units.Quantity(height, 'm')).to('Pa').m,
+        }
+
+    tolerance = {np.float64: 1e-10, np.float32: 1e-4}
+    ok = True
+    for dtype in (np.float64, np.float32):
+        p, t, qq, td, s, d, a, h = (x.astype(dtype) for x in
+                                    (pressure, temperature, q, dewpoint, speed, direction, altimeter, height))
+        u, v = wind_components(s, d)
+        actual = {
+            'dewpoint_from_specific_humidity': dewpoint_from_specific_humidity(p, qq),
+            'relative_humidity_from_specific_humidity': relative_humidity_from_specific_humidity(p, t, qq),
+            'relative_humidity_from_dewpoint': relative_humidity_from_dewpoint(t, td),
+            'wind_speed': wind_speed(u, v),
+            'u_component': u,
+            'v_component': v,
+            'altimeter_to_station_pressure': altimeter_to_station_pressure(a, h),
+        }
+        for name, result in actual.items():
+            ref = expected[name]
+            err = np.abs(result - ref) / np.maximum(np.abs(ref), 1.0)
+            passed = result.dtype == dtype and np.nanmax(err) <= tolerance[dtype]
+            ok = ok and passed
+            print(f"{np.dtype(dtype).name:8s} {name:42s} max rel diff {np.nanmax(err):.2e} "
+                  f"{'OK' if passed else 'FAIL'}")
+    return ok
+
+
+if __name__ == "__main__":
+    sys.exit(0 if validate() else 1)
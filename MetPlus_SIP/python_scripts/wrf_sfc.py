@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+
+# Shared logic for converting WRF surface fields for MET PYTHON_NUMPY input.
+# Used by convert_wrf_sfc.py, either one variable at a time or in a single
+# pass that computes every supported field and stores them in a per-file cache.
+# Derived fields are computed with the NumPy kernels in thermo.py.
+#
+# Fields can optionally be limited to the part of the domain covering a set of
+# MET .poly masks plus a halo for interpolation.  Only that hyperslab is read
+# from the wrfout file, and the grid attributes describe the cropped grid.
+#
+# A whole run can also be converted up front by batch_convert_wrf.py into a
+# compressed netCDF store, which convert() reads from when it is given the
+# store directory.
+#
+# netCDF4 is imported when a file is converted rather than at import time, so
+# that a cache hit does not pay for importing it.
+
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+from datetime import datetime
+
+import thermo
+
+
+# Date Formats
+FILE_DATE_FORMAT = '%Y-%m-%d_%H:%M:%S'
+MET_DATE_FORMAT ='%Y%m%d_%H%M%S'
+
+# Output name, long name, and level for each supported variable
+VAR_INFO = {
+    'T2': ('T2', 'Temperature', 'Z2'),
+    'DPT': ('DPT', 'Dew Point Temperature', 'Z2'),
+    'U10': ('U', 'U Wind', 'Z10'),
+    'V10': ('V', 'V wind', 'Z10'),
+    'RH': ('RH', 'Relative Humidity', 'Z2'),
+    'PSFC': ('PSFC', 'Surface Pressure', 'Z0'),
+    'WIND': ('WIND', 'Wind Speed', 'Z10'),
+}
+
+# Bump this when the cached fields or attributes change
+CACHE_VERSION = 4
+
+# Index of the entries in a store written by batch_convert_wrf.py
+STORE_INDEX = 'index.json'
+
+# Grid points added around the poly masks so that interpolation at stations
+# near the mask edges has its full stencil
+DEFAULT_HALO = 2
+
+
+def read_valid_time(ncin):
+    """Return the valid time of a wrfout file as a datetime."""
+    return datetime.strptime(ncin.variables['Times'][:].tobytes().decode(),FILE_DATE_FORMAT)
+
+
+def compute_fields(ncin, var_list, window=None):
+    """Compute the requested variables from an open wrfout file.
+
+    Each input variable is read at most once, so asking for several fields
+    that share inputs (DPT and RH both need Q2, PSFC and T2) costs one read.
+    When a subdomain window is given only that part of the grid is read.
+    Returns a dictionary of var -> (array, units string).
+    """
+    inputs = {}
+
+    def get(name, kind=None):
+        # Read a variable once, converted to SI units when kind is given
+        if name not in inputs:
+            ncvar = ncin.variables[name]
+            if window:
+                data = ncvar[..., window['j0']:window['j1'], window['i0']:window['i1']]
+            else:
+                data = ncvar[:]
+            inputs[name] = (np.squeeze(data), ncvar.units)
+        data, data_units = inputs[name]
+        return thermo.to_si(data, data_units, kind) if kind else data
+
+    fields = {}
+    for var in var_list:
+        if var in ('T2', 'U10', 'V10', 'PSFC'):
+            fields[var] = (get(var), ncin.variables[var].units)
+
+        # Dew Point Temperature Calculation
+        elif var == 'DPT':
+            dewpt_calc = thermo.dewpoint_from_specific_humidity(get('PSFC', 'pressure'), get('Q2', 'specific_humidity'))
+            fields[var] = (dewpt_calc, 'K')
+
+        # Relative Humidity Calculation
+        elif var == 'RH':
+            rh_calc = thermo.relative_humidity_from_specific_humidity(get('PSFC', 'pressure'), get('T2', 'temperature'),
+                                                                      get('Q2', 'specific_humidity'))
+            fields[var] = (rh_calc, '%')
+
+        # Wind Speed Calculation
+        elif var == 'WIND':
+            wspeed_calc = thermo.wind_speed(get('U10', 'speed'), get('V10', 'speed'))
+            fields[var] = (wspeed_calc, 'm_s-1')
+
+        else:
+            raise NameError('Variable '+ var+' not currently supported')
+
+    # Set up variables to output to MET
+    for var, (outvar, var_units) in fields.items():
+        fields[var] = (outvar[::-1], var_units)
+
+    return fields
+
+
+def grid_attrs(ncin):
+    """Return the MET grid dictionary shared by every field in a wrfout file."""
+    # Some grid dimensions that need to be calculated
+    d_km = float(ncin.getncattr('DX')) / 1000
+    nx_var = float(ncin.dimensions['west_east'].size)
+    ny_var = float(ncin.dimensions['south_north'].size)
+    x_pin_var = (nx_var - 1)*0.5
+    y_pin_var = (ny_var - 1)*0.5
+
+    return {
+        'type': ncin.getncattr('MAP_PROJ_CHAR'),
+        'hemisphere': 'N' if float(ncin.getncattr('POLE_LAT')) > 0 else 'S',
+        'nx': int(nx_var),
+        'ny': int(ny_var),
+        'lat_pin': float(ncin.getncattr('CEN_LAT')),
+        'lon_pin': float(ncin.getncattr('CEN_LON')),
+        'x_pin': x_pin_var,
+        'y_pin': y_pin_var,
+        'lon_orient': float(ncin.getncattr('STAND_LON')),
+        'd_km': d_km,
+        'r_km': 6371.2,
+        'scale_lat_1': float(ncin.getncattr('TRUELAT1')),
+        'scale_lat_2': float(ncin.getncattr('TRUELAT2')),
+    }
+
+
+def read_poly(poly_file):
+    """Return the vertex latitudes and longitudes of a MET .poly mask."""
+    with open(poly_file) as f:
+        lines = [line.split() for line in f if line.strip()]
+
+    # The first line is the name of the mask
+    vertices = np.array(lines[1:], dtype=float)
+    return vertices[:,0], vertices[:,1]
+
+
+def points_in_poly(lat, lon, poly_lat, poly_lon):
+    """Return a boolean array marking the points inside a lat/lon polygon."""
+    # Ray casting, looping over the few polygon edges and vectorized over points
+    inside = np.zeros(np.shape(lat), dtype=bool)
+    for k in range(len(poly_lat)):
+        lat1, lon1 = poly_lat[k], poly_lon[k]
+        lat2, lon2 = poly_lat[k-1], poly_lon[k-1]
+        if lat1 == lat2:
+            continue
+        crosses = (lat1 > lat) != (lat2 > lat)
+        lon_cross = lon1 + (lat - lat1) * (lon2 - lon1) / (lat2 - lat1)
+        inside ^= crosses & (lon < lon_cross)
+    return inside
+
+
+def subdomain_window(ncin, mask_polys, halo=DEFAULT_HALO):
+    """Return the index window of the grid covering the poly masks plus a halo.
+
+    The window holds the south_north (j0:j1) and west_east (i0:i1) index
+    ranges and the latitude and longitude of its south-west grid point.
+    """
+    lat = np.squeeze(ncin.variables['XLAT'][:])
+    lon = np.squeeze(ncin.variables['XLONG'][:])
+
+    inside = np.zeros(lat.shape, dtype=bool)
+    for poly_file in mask_polys:
+        inside |= points_in_poly(lat, lon, *read_poly(poly_file))
+    if not inside.any():
+        raise ValueError('No grid points of '+ncin.filepath()+' are inside the masks '+', '.join(mask_polys))
+
+    jj, ii = np.nonzero(inside)
+    ny, nx = lat.shape
+    j0, j1 = max(jj.min() - halo, 0), min(jj.max() + halo + 1, ny)
+    i0, i1 = max(ii.min() - halo, 0), min(ii.max() + halo + 1, nx)
+
+    return {
+        'j0': int(j0), 'j1': int(j1), 'i0': int(i0), 'i1': int(i1),
+        'lat_pin': float(lat[j0,i0]),
+        'lon_pin': float(lon[j0,i0]),
+    }
+
+
+def subdomain_grid(grid, window):
+    """Return the MET grid dictionary of the cropped grid."""
+    # Pin the grid at its south-west point, which is (0, 0) in MET grid
+    # coordinates since the data are flipped north to south for MET
+    grid = dict(grid)
+    grid.update({
+        'nx': window['i1'] - window['i0'],
+        'ny': window['j1'] - window['j0'],
+        'lat_pin': window['lat_pin'],
+        'lon_pin': window['lon_pin'],
+        'x_pin': 0.0,
+        'y_pin': 0.0,
+    })
+    return grid
+
+
+def mask_key(mask_polys, halo=DEFAULT_HALO):
+    """Return a short hash identifying a set of poly masks and a halo."""
+    key = hashlib.sha1(str(halo).encode())
+    for poly_file in mask_polys:
+        with open(poly_file, 'rb') as f:
+            key.update(f.read())
+    return key.hexdigest()[:12]
+
+
+def load_subdomain_window(ncin, grid, mask_polys, halo=DEFAULT_HALO, cache_dir=None):
+    """Return the subdomain window, reusing the one stored in cache_dir for this grid."""
+    # Every wrfout file of a domain shares the same window, so it is computed
+    # from XLAT and XLONG once and stored alongside the field caches
+    if not cache_dir:
+        return subdomain_window(ncin, mask_polys, halo)
+
+    grid_key = hashlib.sha1(json.dumps(grid, sort_keys=True).encode()).hexdigest()[:12]
+    wfile = os.path.join(cache_dir, 'subdomain_'+mask_key(mask_polys, halo)+'_'+grid_key+'.json')
+    if os.path.exists(wfile):
+        try:
+            with open(wfile) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    window = subdomain_window(ncin, mask_polys, halo)
+    _write_atomic(wfile, lambda f: f.write(json.dumps(window).encode()))
+    return window
+
+
+def build_attrs(valid, grid, var, var_units):
+    """Build the attrs dictionary MET expects for one variable."""
+    var_name, var_long_name, var_lvl = VAR_INFO[var]
+    grid = dict(grid)
+    grid['name'] = var_name
+    return {
+        'valid': valid,
+        'init': valid,
+        'lead': '000000',
+        'accum': '000000',
+        'name': var_name,
+        'long_name': var_long_name,
+        'level': var_lvl,
+        'units': var_units,
+        'grid': grid,
+    }
+
+
+def cache_path(infile, cache_dir, subdomain_key=None):
+    """Return the sidecar cache file for a wrfout file."""
+    # Hash the full path so files with the same name in different
+    # directories do not share a cache entry
+    path_hash = hashlib.sha1(os.path.abspath(infile).encode()).hexdigest()[:12]
+    if subdomain_key:
+        path_hash += '.sub'+subdomain_key
+    return os.path.join(cache_dir, os.path.basename(infile)+'.'+path_hash+'.npz')
+
+
+def _source_key(infile):
+    # The cache is valid for the exact path and modification time of the source
+    return {'version': CACHE_VERSION, 'path': os.path.abspath(infile), 'mtime_ns': os.stat(infile).st_mtime_ns}
+
+
+def read_cache(infile, cache_dir, var, subdomain_key=None):
+    """Return (met_data, attrs) from the cache, or None if it is missing or stale."""
+    cfile = cache_path(infile, cache_dir, subdomain_key)
+    if not os.path.exists(cfile):
+        return None
+
+    try:
+        with np.load(cfile) as cache:
+            meta = json.loads(str(cache['meta']))
+            if meta['source'] != _source_key(infile) or var not in meta['units']:
+                return None
+            met_data = cache[var]
+    except (OSError, ValueError, KeyError):
+        # Treat an unreadable or partially written cache as a miss
+        return None
+
+    return met_data, build_attrs(meta['valid'], meta['grid'], var, meta['units'][var])
+
+
+def _write_atomic(path, write):
+    # Write to a temporary file and rename it so that concurrent readers
+    # never see a partial file
+    cache_dir = os.path.dirname(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.chmod(tmp_file, 0o644)
+        os.replace(tmp_file, path)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+
+
+def write_cache(infile, cache_dir, valid, grid, fields, subdomain_key=None):
+    """Write every computed field and the shared grid attributes to the cache."""
+    meta = {
+        'source': _source_key(infile),
+        'valid': valid,
+        'grid': grid,
+        'units': {var: var_units for var, (_, var_units) in fields.items()},
+    }
+    arrays = {var: outvar for var, (outvar, _) in fields.items()}
+    _write_atomic(cache_path(infile, cache_dir, subdomain_key),
+                  lambda f: np.savez(f, meta=json.dumps(meta), **arrays))
+
+
+def store_key(infile, subdomain_key=None):
+    """Return the key of a wrfout file in a store index."""
+    key = os.path.abspath(infile)
+    return key+'#sub'+subdomain_key if subdomain_key else key
+
+
+def store_file_name(infile, subdomain_key=None):
+    """Return the name of the hourly store file of a wrfout file."""
+    # Hash the full path as in cache_path, so runs with the same file names
+    # in one store do not overwrite each other
+    return os.path.basename(cache_path(infile, '', subdomain_key))[:-len('.npz')]+'.nc'
+
+
+def run_file_name(run_name, infiles, subdomain_key=None):
+    """Return the name of the store file holding a whole run of wrfout files."""
+    run_hash = hashlib.sha1('\n'.join(os.path.abspath(infile) for infile in infiles).encode()).hexdigest()[:12]
+    if subdomain_key:
+        run_hash += '.sub'+subdomain_key
+    return run_name+'.'+run_hash+'.nc'
+
+
+def read_store_index(store_dir):
+    """Return the index of a store, or an empty one if there is none."""
+    try:
+        with open(os.path.join(store_dir, STORE_INDEX)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_store_index(store_dir, index):
+    """Write the index of a store."""
+    _write_atomic(os.path.join(store_dir, STORE_INDEX),
+                  lambda f: f.write(json.dumps(index, indent=1, sort_keys=True).encode()))
+
+
+def store_entry(infile, valid, grid, fields):
+    """Return the store index entry of a converted wrfout file."""
+    return {
+        'source': _source_key(infile),
+        'valid': valid,
+        'grid': grid,
+        'units': {var: var_units for var, (_, var_units) in fields.items()},
+    }
+
+
+def store_entry_current(infile, entry):
+    """Return True if a store entry was converted from the current version of infile."""
+    try:
+        return entry['source'] == _source_key(infile)
+    except OSError:
+        return False
+
+
+def read_store(infile, store_dir, var, subdomain_key=None):
+    """Return (met_data, attrs) from a batch store, or None if infile is not in it or is stale."""
+    entry = read_store_index(store_dir).get(store_key(infile, subdomain_key))
+    if entry is None or var not in entry['units'] or not store_entry_current(infile, entry):
+        return None
+
+    import netCDF4
+    try:
+        with netCDF4.Dataset(os.path.join(store_dir, entry['file'])) as ncin:
+            ncvar = ncin.variables[var]
+            ncvar.set_auto_mask(False)
+            met_data = ncvar[entry['time_index']]
+    except (OSError, KeyError, IndexError):
+        return None
+
+    return met_data, build_attrs(entry['valid'], entry['grid'], var, entry['units'][var])
+
+
+def write_store_file(path, entries, fields_list, complevel=4):
+    """Write converted wrfout files to a compressed netCDF store file.
+
+    entries and fields_list hold the store index entry and the fields of each
+    file, in time order.  Fields are stored as float32, compressed and
+    chunked one time and full grid per chunk, which is how they are read.
+    The time_index of each entry is set to its position in the file.
+    """
+    import netCDF4
+
+    ny, nx = entries[0]['grid']['ny'], entries[0]['grid']['nx']
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.nc.tmp')
+    os.close(fd)
+    try:
+        with netCDF4.Dataset(tmp_file, 'w', clobber=True) as ncout:
+            ncout.createDimension('time', len(entries))
+            ncout.createDimension('y', ny)
+            ncout.createDimension('x', nx)
+            ncout.grid = json.dumps(entries[0]['grid'])
+
+            valid = ncout.createVariable('valid', str, ('time',))
+            for k, (entry, fields) in enumerate(zip(entries, fields_list)):
+                entry['time_index'] = k
+                valid[k] = entry['valid']
+
+            for var in fields_list[0]:
+                ncvar = ncout.createVariable(var, 'f4', ('time','y','x'), zlib=True, complevel=complevel,
+                                             shuffle=True, chunksizes=(1, ny, nx))
+                ncvar.units = fields_list[0][var][1]
+                for k, fields in enumerate(fields_list):
+                    ncvar[k] = fields[var][0]
+        os.chmod(tmp_file, 0o644)
+        os.replace(tmp_file, path)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+
+
+def read_file(infile, var_list, mask_polys=None, halo=DEFAULT_HALO, cache_dir=None):
+    """Return the valid time, grid dictionary, and fields of a wrfout file.
+
+    See compute_fields for the fields and convert for mask_polys and halo.
+    cache_dir is only used to store the subdomain window.
+    """
+    import netCDF4
+    ncin = netCDF4.Dataset(infile)
+    # wrfout fields have no fill values, so read plain arrays
+    ncin.set_auto_mask(False)
+    try:
+        valid = read_valid_time(ncin).strftime(MET_DATE_FORMAT)
+        grid = grid_attrs(ncin)
+        window = None
+        if mask_polys:
+            window = load_subdomain_window(ncin, grid, mask_polys, halo, cache_dir)
+            grid = subdomain_grid(grid, window)
+        fields = compute_fields(ncin, var_list, window)
+    finally:
+        ncin.close()
+
+    return valid, grid, fields
+
+
+def convert(infile, var, cache_dir=None, mask_polys=None, halo=DEFAULT_HALO, store_dir=None):
+    """Return (met_data, attrs) for one variable of a wrfout file.
+
+    Without a cache directory only the requested variable is computed.  With
+    one, the first call for a file computes every supported variable in a
+    single pass and stores them, and later calls are served from the cache.
+    With a list of .poly mask files, only the subdomain covering the masks
+    plus halo grid points is read and returned.  With the directory of a
+    store written by batch_convert_wrf.py, files in the store are read from it.
+    """
+    if var not in VAR_INFO:
+        raise NameError('Variable '+ var+' not currently supported')
+
+    subdomain_key = mask_key(mask_polys, halo) if mask_polys else None
+
+    if store_dir:
+        stored = read_store(infile, store_dir, var, subdomain_key)
+        if stored is not None:
+            return stored
+
+    if cache_dir:
+        cached = read_cache(infile, cache_dir, var, subdomain_key)
+        if cached is not None:
+            return cached
+
+    valid, grid, fields = read_file(infile, list(VAR_INFO) if cache_dir else [var], mask_polys, halo, cache_dir)
+
+    if cache_dir:
+        write_cache(infile, cache_dir, valid, grid, fields, subdomain_key)
+
+    met_data, var_units = fields[var]
+    return met_data, build_attrs(valid, grid, var, var_units)
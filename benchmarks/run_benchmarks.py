@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+
+# Benchmarks of the WRF and MADIS converters, the pairing and .stat steps,
+# and the zonal statistics, on synthetic inputs from synthetic.py.
+#
+# Each stage runs at a range of sizes: the wrfout grid size, the number of
+# MADIS stations, or the raster size.  Every run is a fresh process, so the
+# peak resident size it reports belongs to that stage alone (with the
+# interpreter, its imports and the setup of the stage), and the best time
+# of --repeat runs is kept.  Only the step being measured is timed, not the
+# setup (reading the polygons for the weights, the observations for the
+# pairs, ...).  Throughput is the work done per second, in the unit of the
+# stage: grid points, observations, pairs, .stat rows or raster cells.
+#
+# Stages needing a package that is not installed (geopandas for the zonal
+# stages, rasterio for the GeoTIFF one) are reported as skipped.  The
+# plotting drivers are not benchmarked, as the maps fetch their features
+# over the network.
+#
+# Results can be written to CSV, and compared with an earlier CSV to see
+# whether a change made a stage slower:
+#
+#   python run_benchmarks.py --output before.csv --label before
+#   python run_benchmarks.py --compare before.csv --stages wrf_convert madis_convert
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+from time import perf_counter
+from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic
+from synthetic import DEFAULT_START
+
+
+RESULT_COLUMNS = ['label', 'stage', 'axis', 'size', 'items', 'unit', 'time_s', 'peak_rss_mb', 'throughput']
+
+DEFAULT_GRIDS = [100, 200, 400]
+DEFAULT_STATIONS = [500, 2000, 8000]
+DEFAULT_RASTERS = [200, 400, 800]
+
+# wrfout grid size of the stages scaled by the station count
+DEFAULT_PAIR_GRID = 200
+
+# Valid times of the MPR files, and time steps of the zonal statistics
+DEFAULT_HOURS = 24
+DEFAULT_STEPS = 24
+
+
+def _peak_rss_mb():
+    from memory_use import peak_rss_mb
+
+    return peak_rss_mb()
+
+
+# Stages, each timing one step on the inputs of one size and returning the
+# items processed and the time taken
+
+def wrf_convert(inputs):
+    """Convert every supported variable of a wrfout file one at a time, as PointStat calls convert_wrf_sfc.py."""
+    import wrf_sfc
+
+    start = perf_counter()
+    for var in wrf_sfc.VAR_INFO:
+        met_data, _ = wrf_sfc.convert(inputs['wrfout'], var)
+    return met_data.size * len(wrf_sfc.VAR_INFO), perf_counter() - start
+
+
+def wrf_single_pass(inputs):
+    """Convert every supported variable of a wrfout file through the single-pass cache."""
+    import wrf_sfc
+
+    cache_dir = os.path.join(inputs['run_dir'], 'wrf_cache')
+    start = perf_counter()
+    for var in wrf_sfc.VAR_INFO:
+        met_data, _ = wrf_sfc.convert(inputs['wrfout'], var, cache_dir)
+    return met_data.size * len(wrf_sfc.VAR_INFO), perf_counter() - start
+
+
+def madis_convert(inputs):
+    """Convert a MADIS METAR file to the MET point_data list, as convert_madis_sfc_allvars.py does."""
+    import madis_sfc
+
+    start = perf_counter()
+    point_data = madis_sfc.convert(inputs['madis'])
+    return len(point_data), perf_counter() - start
+
+
+def match_pairs(inputs):
+    """Pair the WRF fields with the MADIS observations of one valid time, as match_pairs.py does."""
+    import madis_sfc
+    from match_pairs import match_hour, PAIR_VARS
+
+    obs = madis_sfc.read_columns(inputs['madis'])
+    start = perf_counter()
+    pairs = match_hour(inputs['wrfout'], obs, list(PAIR_VARS), [])
+    return len(pairs['FCST']), perf_counter() - start
+
+
+def stat_read(inputs):
+    """Read the MPR columns of an MPR .stat file."""
+    from stat_reader import read_stat
+    from aggregate_mpr import MPR_COLUMNS
+
+    start = perf_counter()
+    mpr = read_stat(inputs['mpr'], columns=MPR_COLUMNS)
+    return len(mpr), perf_counter() - start
+
+
+def aggregate_cnt(inputs):
+    """Aggregate MPR lines into CNT lines by variable and station, like STAT_ANALYSIS_JOB2."""
+    from aggregate_mpr import read_mpr, aggregate
+
+    mpr = read_mpr([inputs['mpr']])
+    start = perf_counter()
+    aggregate(mpr, ['FCST_VAR', 'OBS_SID'], 'CNT', {'VX_MASK': 'OBS_SID'})
+    return len(mpr), perf_counter() - start
+
+
+def station_data(inputs):
+    """Read the per-station CNT statistics and locations plot_bias_stations.py maps."""
+    from match_pairs import PAIR_VARS
+    from plot_bias_stations import load_station_data
+
+    fcst_vars = [v[0] for v in PAIR_VARS.values()]
+    start = perf_counter()
+    stations = load_station_data(inputs['cnt'], inputs['mpr'], fcst_vars, ['ME', 'RMSE'])
+    return len(stations), perf_counter() - start
+
+
+def _counties(grid):
+    from zonal_stats import read_layer, DEFAULT_LAYERS
+    from coverage_weights import layer_in_crs
+
+    shapefile = DEFAULT_LAYERS['county']
+    return layer_in_crs(shapefile, read_layer(shapefile), grid.crs)
+
+
+def zonal_weights(inputs):
+    """Compute the coverage weights of the Colorado counties on a raster grid."""
+    from coverage_weights import CoverageWeights
+
+    layer = _counties(inputs['grid'])
+    start = perf_counter()
+    CoverageWeights.from_layer(layer, inputs['grid'])
+    return int(np.prod(inputs['grid'].shape)), perf_counter() - start
+
+
+def zonal_stats(inputs):
+    """Take the statistics of a stack of rasters over the Colorado counties with their coverage weights."""
+    from coverage_weights import CoverageWeights
+    from zonal_stats import DEFAULT_STATS
+
+    weights = CoverageWeights.from_layer(_counties(inputs['grid']), inputs['grid'])
+    values = np.load(inputs['raster'])
+    start = perf_counter()
+    weights.stats(values, DEFAULT_STATS)
+    return values.size, perf_counter() - start
+
+
+def geotiff_write(inputs):
+    """Write a raster to a tiled, compressed GeoTIFF with geotiff_writer.py."""
+    from geotiff_writer import write_geotiff
+
+    values = np.load(inputs['raster'], mmap_mode='r')[0]
+    start = perf_counter()
+    write_geotiff(os.path.join(inputs['run_dir'], 'raster.tif'), values, inputs['grid'])
+    return values.size, perf_counter() - start
+
+
+# Stage name -> (function, size axis, unit of the items)
+STAGES = {
+    'wrf_convert': (wrf_convert, 'grid', 'points'),
+    'wrf_single_pass': (wrf_single_pass, 'grid', 'points'),
+    'madis_convert': (madis_convert, 'stations', 'obs'),
+    'match_pairs': (match_pairs, 'stations', 'pairs'),
+    'stat_read': (stat_read, 'stations', 'rows'),
+    'aggregate_cnt': (aggregate_cnt, 'stations', 'pairs'),
+    'station_data': (station_data, 'stations', 'stations'),
+    'zonal_weights': (zonal_weights, 'raster', 'cells'),
+    'zonal_stats': (zonal_stats, 'raster', 'cells'),
+    'geotiff_write': (geotiff_write, 'raster', 'cells'),
+}
+
+
+def run_stage(stage, inputs):
+    """Run a stage in this process, returning the items, time and peak resident size."""
+    function = STAGES[stage][0]
+    inputs = dict(inputs, run_dir=tempfile.mkdtemp(dir=inputs['work_dir']))
+    try:
+        items, seconds = function(inputs)
+    finally:
+        shutil.rmtree(inputs['run_dir'], ignore_errors=True)
+    return items, seconds, _peak_rss_mb()
+
+
+def make_inputs(work_dir, axis, size, args):
+    """Write the synthetic inputs of the stages along axis at size, and return their paths."""
+    size_dir = os.path.join(work_dir, f"{axis}_{size}")
+    os.makedirs(size_dir, exist_ok=True)
+    inputs = {'work_dir': size_dir}
+    valid = DEFAULT_START
+
+    if axis == 'grid':
+        inputs['wrfout'] = os.path.join(size_dir, 'wrfout.nc')
+        synthetic.write_wrfout(inputs['wrfout'], valid, size, size, args.seed)
+
+    elif axis == 'stations':
+        stations = synthetic.make_stations(size, args.seed)
+        inputs['wrfout'] = os.path.join(size_dir, 'wrfout.nc')
+        synthetic.write_wrfout(inputs['wrfout'], valid, args.pair_grid, args.pair_grid, args.seed)
+        inputs['madis'] = os.path.join(size_dir, 'madis.nc')
+        synthetic.write_madis(inputs['madis'], valid, stations, seed=args.seed)
+        inputs['mpr'] = os.path.join(size_dir, 'MPR.stat')
+        synthetic.write_mpr(inputs['mpr'], stations, [valid + timedelta(hours=h) for h in range(args.hours)],
+                            seed=args.seed)
+        inputs['cnt'] = os.path.join(size_dir, 'CNT.stat')
+        synthetic.write_cnt(inputs['cnt'], inputs['mpr'])
+
+    elif axis == 'raster':
+        inputs['grid'] = synthetic.raster_grid(size)
+        inputs['raster'] = os.path.join(size_dir, 'raster.npy')
+        np.save(inputs['raster'], synthetic.raster_values(inputs['grid'], args.steps, seed=args.seed))
+
+    return inputs
+
+
+def benchmark(stages, sizes, work_dir, args):
+    """Run every stage at each size of its axis, returning a row of results per stage and size."""
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for axis in ('grid', 'stations', 'raster'):
+        axis_stages = [s for s in stages if STAGES[s][1] == axis]
+        if not axis_stages:
+            continue
+        for size in sizes[axis]:
+            start = perf_counter()
+            inputs = make_inputs(work_dir, axis, size, args)
+            print(f"Made the {axis} {size} inputs in {perf_counter() - start:.3f} s")
+
+            for stage in axis_stages:
+                runs = []
+                try:
+                    for _ in range(args.repeat):
+                        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                            runs.append(pool.submit(run_stage, stage, inputs).result())
+                except ImportError as err:
+                    # Only this stage is skipped, the others may not need the package
+                    print(f"{stage} {axis} {size}: skipped, {err}")
+                    continue
+                items = runs[0][0]
+                seconds = min(r[1] for r in runs)
+                peak = max(r[2] for r in runs)
+                results.append([args.label, stage, axis, size, items, STAGES[stage][2], seconds, peak,
+                                items / seconds if seconds > 0 else np.nan])
+                print(f"{stage} {axis} {size}: {items} {STAGES[stage][2]} in {seconds:.3f} s, "
+                      f"peak RSS {peak:.0f} MB, {items / max(seconds, 1e-9):,.0f} {STAGES[stage][2]}/s")
+
+            shutil.rmtree(inputs['work_dir'], ignore_errors=True)
+    return pd.DataFrame(results, columns=RESULT_COLUMNS)
+
+
+def compare(results, baseline_file):
+    """Return the results with the time and peak resident size relative to an earlier results CSV."""
+    baseline = pd.read_csv(baseline_file)[['stage', 'axis', 'size', 'time_s', 'peak_rss_mb']]
+    merged = results.merge(baseline, on=['stage', 'axis', 'size'], how='left', suffixes=('', '_base'))
+    merged['time_ratio'] = merged['time_s'] / merged['time_s_base']
+    merged['rss_ratio'] = merged['peak_rss_mb'] / merged['peak_rss_mb_base']
+    return merged.drop(columns=['time_s_base', 'peak_rss_mb_base'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the converters, pairing, .stat and zonal steps '
+                                                 'on synthetic inputs')
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=list(STAGES),
+                        help='Stages to run (default: all)')
+    parser.add_argument('--grid', type=int, nargs='+', default=DEFAULT_GRIDS,
+                        help='wrfout grid sizes (default: %(default)s)')
+    parser.add_argument('--stations', type=int, nargs='+', default=DEFAULT_STATIONS,
+                        help='MADIS station counts (default: %(default)s)')
+    parser.add_argument('--raster', type=int, nargs='+', default=DEFAULT_RASTERS,
+                        help='Raster columns (default: %(default)s)')
+    parser.add_argument('--pair-grid', type=int, default=DEFAULT_PAIR_GRID,
+                        help='wrfout grid size of the station stages (default: %(default)s)')
+    parser.add_argument('--hours', type=int, default=DEFAULT_HOURS, help='Valid times of the MPR files (default: %(default)s)')
+    parser.add_argument('--steps', type=int, default=DEFAULT_STEPS, help='Rasters in a zonal stack (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of each stage, the best time is kept (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the inputs (default: %(default)s)')
+    parser.add_argument('--work-dir', help='Directory of the inputs, a temporary one by default')
+    parser.add_argument('--label', default='', help='Label of the results, e.g. a commit')
+    parser.add_argument('--output', help='CSV of the results')
+    parser.add_argument('--compare', help='CSV of earlier results to compare with')
+    args = parser.parse_args()
+
+    sizes = {'grid': args.grid, 'stations': args.stations, 'raster': args.raster}
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='aqe_bench_')
+    os.makedirs(work_dir, exist_ok=True)
+    start = perf_counter()
+    try:
+        results = benchmark(args.stages, sizes, work_dir, args)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.compare:
+        results = compare(results, args.compare)
+    if results.empty:
+        print("No stage ran")
+    else:
+        with pd.option_context('display.width', 200, 'display.max_columns', None, 'display.float_format', '{:.4g}'.format):
+            print(results.drop(columns='label').to_string(index=False))
+    if args.output:
+        results.to_csv(args.output, index=False)
+    print(f"Ran the benchmarks in {perf_counter() - start:.3f} s")
+
+
+if __name__ == "__main__":
+    main()
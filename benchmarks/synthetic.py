@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+
+# Synthetic inputs for the benchmarks, of any size and without network
+# access or real data:
+#
+#   wrfout files       Times, XLAT, XLONG, T2, Q2, PSFC, U10 and V10 on a
+#                      Lambert Conformal grid over Colorado, with the global
+#                      attributes wrf_sfc.grid_attrs reads
+#   MADIS METAR files  hourly station reports with the QC DD flags, missing
+#                      values and units convert_madis_sfc_allvars.py reads
+#   MPR and CNT .stat  STAT-Analysis -dump_row MPR lines in the match_pairs.py
+#                      layout, and the CNT lines by station aggregate_mpr.py
+#                      makes from them, as plot_bias_stations.py reads
+#   rasters            smooth fields on a latitude-longitude grid over the
+#                      bundled Colorado shapefiles, as arrays or GeoTIFFs
+#
+# The grid spacing follows the grid size, so every wrfout grid covers the
+# same domain, and the stations are spread over it.  A seed makes every
+# input reproducible.
+#
+# Example, a set of inputs for three hours:
+#
+#   python synthetic.py /tmp/bench_inputs --grid 400 --stations 2000 --hours 3
+
+import os
+import sys
+import argparse
+from datetime import datetime, timedelta
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+METPLUS_DIR = os.path.join(REPO_DIR, 'MetPlus_SIP', 'python_scripts')
+ENVIROSCREEN_DIR = os.path.join(REPO_DIR, 'EnviroScreenScripts', 'python_scripts')
+sys.path.insert(0, METPLUS_DIR)
+sys.path.insert(0, ENVIROSCREEN_DIR)
+
+
+# Lambert Conformal domain of the wrfout files, as in the SIP runs
+WRF_ATTRS = {
+    'MAP_PROJ': 1,
+    'MAP_PROJ_CHAR': 'Lambert Conformal',
+    'POLE_LAT': 90.,
+    'POLE_LON': 0.,
+    'CEN_LAT': 39.,
+    'CEN_LON': -105.5,
+    'STAND_LON': -105.5,
+    'TRUELAT1': 30.,
+    'TRUELAT2': 60.,
+}
+
+# Width of the wrfout domain in m, whatever the grid size
+WRF_EXTENT = 900000.
+
+# Radius of the WRF sphere in m
+WRF_EARTH_RADIUS = 6370000.
+
+# Latitude and longitude bounds of the stations and rasters, around Colorado
+BOUNDS = (-109.5, 36.5, -101.5, 41.5)
+
+WRF_TIME_FORMAT = '%Y-%m-%d_%H:%M:%S'
+MADIS_TIME_FORMAT = '%Y%m%d_%H%M'
+MET_TIME_FORMAT = '%Y%m%d_%H%M%S'
+
+# MADIS missing value
+MADIS_FILL = np.float32(3.4028235e+38)
+
+# MADIS QC flags of accepted reports, and of rejected ones
+QC_PASS = [b'V', b'S', b'C', b'G']
+QC_FAIL = [b'Z', b'X']
+
+# Width of the MADIS station names
+STATION_NAME_LEN = 5
+
+DEFAULT_START = datetime(2022, 7, 20)
+
+
+def smooth_field(x, y, mean, amplitude, rng, noise=0.):
+    """Return a smooth field of waves over x and y, with optional white noise."""
+    kx, ky, phase = rng.uniform(1., 4., 3)
+    field = mean + amplitude * np.sin(kx * x + phase) * np.cos(ky * y - phase)
+    if noise:
+        field = field + rng.normal(0., noise, field.shape)
+    return field.astype(np.float32)
+
+
+def wrf_latlon(ny, nx):
+    """Return the latitudes and longitudes of the mass points of an ny by nx wrfout grid."""
+    from pyproj import Proj
+
+    proj = Proj(proj='lcc', lat_1=WRF_ATTRS['TRUELAT1'], lat_2=WRF_ATTRS['TRUELAT2'], lat_0=WRF_ATTRS['CEN_LAT'],
+                lon_0=WRF_ATTRS['STAND_LON'], R=WRF_EARTH_RADIUS)
+    dx = WRF_EXTENT / nx
+    x = (np.arange(nx) - (nx - 1) / 2) * dx
+    y = (np.arange(ny) - (ny - 1) / 2) * dx
+    lon, lat = proj(*np.meshgrid(x, y), inverse=True)
+    return lat.astype(np.float32), lon.astype(np.float32)
+
+
+def write_wrfout(path, valid, ny, nx, seed=0):
+    """Write a wrfout-like file with the surface fields of one valid time."""
+    import netCDF4
+
+    rng = np.random.default_rng(seed)
+    lat, lon = wrf_latlon(ny, nx)
+    x, y = np.meshgrid(np.linspace(0., np.pi, nx), np.linspace(0., np.pi, ny))
+    fields = {
+        'T2': (smooth_field(x, y, 295., 10., rng, 0.5), 'K', 'TEMP at 2 M'),
+        'Q2': (np.maximum(smooth_field(x, y, 8e-3, 4e-3, rng, 2e-4), 1e-5), 'kg kg-1', 'QV at 2 M'),
+        'PSFC': (smooth_field(x, y, 80000., 8000., rng, 50.), 'Pa', 'SFC PRESSURE'),
+        'U10': (smooth_field(x, y, 2., 5., rng, 1.), 'm s-1', 'U at 10 M'),
+        'V10': (smooth_field(x, y, -1., 5., rng, 1.), 'm s-1', 'V at 10 M'),
+    }
+
+    with netCDF4.Dataset(path, 'w') as ncout:
+        ncout.createDimension('Time', None)
+        ncout.createDimension('DateStrLen', 19)
+        ncout.createDimension('south_north', ny)
+        ncout.createDimension('west_east', nx)
+        ncout.setncatts({**WRF_ATTRS, 'DX': WRF_EXTENT / nx, 'DY': WRF_EXTENT / nx,
+                         'WEST-EAST_GRID_DIMENSION': nx + 1, 'SOUTH-NORTH_GRID_DIMENSION': ny + 1,
+                         'TITLE': 'Synthetic wrfout for benchmarks'})
+
+        times = ncout.createVariable('Times', 'S1', ('Time', 'DateStrLen'))
+        times[0] = np.array(list(valid.strftime(WRF_TIME_FORMAT)), dtype='S1')
+
+        dims = ('Time', 'south_north', 'west_east')
+        for name, values, units, description in [('XLAT', lat, 'degree_north', 'LATITUDE, SOUTH IS NEGATIVE'),
+                                                 ('XLONG', lon, 'degree_east', 'LONGITUDE, WEST IS NEGATIVE')] + \
+                                                [(n, v, u, d) for n, (v, u, d) in fields.items()]:
+            ncvar = ncout.createVariable(name, 'f4', dims)
+            ncvar.setncatts({'FieldType': 104, 'MemoryOrder': 'XY ', 'description': description, 'units': units,
+                             'stagger': ''})
+            ncvar[0] = values
+
+
+def make_stations(count, seed=0):
+    """Return the IDs, latitudes, longitudes and elevations of count stations spread over BOUNDS."""
+    rng = np.random.default_rng(seed)
+    west, south, east, north = BOUNDS
+    # IDs like the METAR ones, K and three letters or digits, or four of
+    # them past 36**3 stations
+    symbols = np.array(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'))
+    width = 3 if count <= 36**3 else STATION_NAME_LEN - 1
+    digits = np.arange(count)[:, None] // 36 ** np.arange(width - 1, -1, -1) % 36
+    prefix = 'K' if width == 3 else ''
+    sid = np.array([prefix + ''.join(s) for s in symbols[digits]])
+    return {
+        'sid': sid,
+        'lat': rng.uniform(south, north, count).astype(np.float32),
+        'lon': rng.uniform(west, east, count).astype(np.float32),
+        'elv': rng.uniform(1000., 4000., count).astype(np.float32),
+    }
+
+
+def write_madis(path, valid, stations, reports=1.2, missing=0.02, rejected=0.03, seed=0):
+    """Write a MADIS METAR-like file of the reports within half an hour of valid.
+
+    Each station reports on average reports times, a fraction missing of
+    the values are missing and a fraction rejected fail QC (Z or X flags).
+    """
+    import netCDF4
+
+    rng = np.random.default_rng(seed)
+    nsta = len(stations['sid'])
+    rec_station = np.concatenate([np.arange(nsta), rng.choice(nsta, int(nsta * (reports - 1)))])
+    nrec = len(rec_station)
+    start = (valid - timedelta(minutes=30) - datetime(1970, 1, 1)).total_seconds()
+    obs_time = start + rng.integers(0, 60, nrec) * 60.
+
+    temperature = rng.normal(295., 8., nrec).astype(np.float32)
+    values = {
+        'temperature': (temperature, 'kelvin'),
+        'dewpoint': (temperature - rng.gamma(2., 4., nrec).astype(np.float32), 'kelvin'),
+        'windSpeed': (rng.gamma(2., 2., nrec).astype(np.float32), 'meter/sec'),
+        'windDir': (rng.uniform(0., 360., nrec).round(-1).astype(np.float32), 'degree'),
+        'altimeter': (rng.normal(101500., 800., nrec).astype(np.float32), 'pascal'),
+    }
+
+    with netCDF4.Dataset(path, 'w') as ncout:
+        ncout.createDimension('recNum', None)
+        ncout.createDimension('maxStaNamLen', STATION_NAME_LEN)
+
+        names = ncout.createVariable('stationName', 'S1', ('recNum', 'maxStaNamLen'))
+        names.long_name = 'alphanumeric station name'
+        names[:] = stations['sid'][rec_station].astype(f"S{STATION_NAME_LEN}").view('S1').reshape(nrec, -1)
+
+        timevar = ncout.createVariable('timeObs', 'f8', ('recNum',))
+        timevar.setncatts({'long_name': 'time of observation', 'units': 'seconds since 1970-1-1 00:00:00.0'})
+        timevar[:] = obs_time
+
+        for name, units in [('latitude', 'degree_north'), ('longitude', 'degree_east'), ('elevation', 'meter')]:
+            ncvar = ncout.createVariable(name, 'f4', ('recNum',), fill_value=MADIS_FILL)
+            ncvar.units = units
+            ncvar[:] = stations[name[:3] if name != 'elevation' else 'elv'][rec_station]
+
+        for name, (data, units) in values.items():
+            data = np.where(rng.random(nrec) < missing, MADIS_FILL, data)
+            ncvar = ncout.createVariable(name, 'f4', ('recNum',), fill_value=MADIS_FILL)
+            ncvar.units = units
+            ncvar[:] = np.ma.masked_equal(data, MADIS_FILL)
+            if name != 'windDir':
+                flags = np.array(QC_PASS)[rng.integers(0, len(QC_PASS), nrec)]
+                fail = rng.random(nrec) < rejected
+                flags[fail] = np.array(QC_FAIL)[rng.integers(0, len(QC_FAIL), np.count_nonzero(fail))]
+                qc = ncout.createVariable(name+'DD', 'S1', ('recNum',))
+                qc.long_name = name+' QC summary value'
+                qc[:] = flags
+
+
+def mpr_columns(stations, valids, var_list=None, seed=0):
+    """Return matched pair columns like match_pairs.match_hour for every station, variable and valid time."""
+    from match_pairs import PAIR_VARS, MET_TIME_FMT
+
+    rng = np.random.default_rng(seed)
+    var_list = list(var_list or PAIR_VARS)
+    nsta = len(stations['sid'])
+    obs_scale = {'T2': (75., 10.), 'DPT': (45., 10.), 'U10': (0., 4.), 'V10': (0., 4.), 'RH': (50., 20.),
+                 'PSFC': (80000., 5000.)}
+
+    blocks = []
+    for valid in valids:
+        for var in var_list:
+            fcst_var, obs_var, _, obs_lev, var_units, _ = PAIR_VARS[var]
+            mean, spread = obs_scale[var]
+            obs = rng.normal(mean, spread, nsta)
+            fcst = obs + rng.normal(0.05 * spread, 0.3 * spread, nsta)
+            blocks.append({
+                'FCST_VALID_BEG': np.full(nsta, valid.strftime(MET_TIME_FMT)),
+                'OBS_VALID_BEG': np.full(nsta, (valid - timedelta(minutes=30)).strftime(MET_TIME_FMT)),
+                'OBS_VALID_END': np.full(nsta, (valid + timedelta(minutes=30)).strftime(MET_TIME_FMT)),
+                'FCST_VAR': np.full(nsta, fcst_var),
+                'FCST_LEV': np.full(nsta, 'Z10' if var in ('U10', 'V10') else 'Z2' if var != 'PSFC' else 'Z0'),
+                'OBS_VAR': np.full(nsta, obs_var),
+                'OBS_LEV': np.full(nsta, obs_lev),
+                'UNITS': np.full(nsta, var_units),
+                'VX_MASK': np.full(nsta, 'FULL'),
+                'OBS_SID': stations['sid'],
+                'OBS_LAT': stations['lat'],
+                'OBS_LON': stations['lon'],
+                'OBS_LVL': np.full(nsta, 0.),
+                'OBS_ELV': stations['elv'],
+                'FCST': fcst,
+                'OBS': obs,
+                'OBS_QC': np.array(QC_PASS).astype(str)[rng.integers(0, len(QC_PASS), nsta)],
+            })
+    return {c: np.concatenate([b[c] for b in blocks]) for c in blocks[0]}
+
+
+def write_mpr(path, stations, valids, var_list=None, seed=0):
+    """Write an MPR .stat file in the -dump_row layout with a pair per station, variable and valid time."""
+    from match_pairs import to_mpr_frame, write_mpr as write_mpr_frame
+
+    write_mpr_frame(to_mpr_frame(mpr_columns(stations, valids, var_list, seed)), path)
+
+
+def write_cnt(path, mpr_file):
+    """Write the CNT lines by variable and station of an MPR .stat file, like STAT_ANALYSIS_JOB2."""
+    from aggregate_mpr import read_mpr, aggregate, write_stat
+
+    lines = aggregate(read_mpr([mpr_file]), ['FCST_VAR', 'OBS_SID'], 'CNT', {'VX_MASK': 'OBS_SID'})
+    write_stat(lines, path)
+
+
+def raster_grid(size, bounds=BOUNDS):
+    """Return the Grid of a north-up latitude-longitude raster of size columns over bounds."""
+    from coverage_weights import Grid
+
+    west, south, east, north = bounds
+    res = (east - west) / size
+    rows = int(np.ceil((north - south) / res))
+    return Grid((res, 0., west, 0., -res, north), (rows, size), 'EPSG:4326')
+
+
+def raster_values(grid, steps=1, missing=0.01, seed=0):
+    """Return steps smooth rasters on a Grid, shaped (steps, rows, columns), with a fraction missing as NaN."""
+    rng = np.random.default_rng(seed)
+    rows, cols = grid.shape
+    x, y = np.meshgrid(np.linspace(0., 2 * np.pi, cols), np.linspace(0., np.pi, rows))
+    values = np.stack([smooth_field(x, y, 40., 15., rng, 1.) for _ in range(steps)]).astype(np.float64)
+    values[rng.random(values.shape) < missing] = np.nan
+    return values
+
+
+def write_raster(path, grid, values):
+    """Write one raster to a tiled GeoTIFF with geotiff_writer.py (needs rasterio)."""
+    from geotiff_writer import write_geotiff
+
+    write_geotiff(path, values, grid)
+
+
+def write_inputs(output_dir, grid=200, stations=1000, hours=1, start=DEFAULT_START, domain='d03', seed=0):
+    """Write the wrfout, MADIS, MPR and CNT inputs of hours valid times to output_dir, and return their paths."""
+    from batch_convert_wrf import DEFAULT_TEMPLATE
+
+    os.makedirs(output_dir, exist_ok=True)
+    valids = [start + timedelta(hours=h) for h in range(hours)]
+    sta = make_stations(stations, seed)
+    paths = {'wrfout': [], 'madis': []}
+    for k, valid in enumerate(valids):
+        wrf_file = os.path.join(output_dir, valid.strftime(DEFAULT_TEMPLATE.format(domain=domain)))
+        write_wrfout(wrf_file, valid, grid, grid, seed + k)
+        madis_file = os.path.join(output_dir, valid.strftime(MADIS_TIME_FORMAT) + '.nc')
+        write_madis(madis_file, valid, sta, seed=seed + k)
+        paths['wrfout'].append(wrf_file)
+        paths['madis'].append(madis_file)
+
+    paths['mpr'] = os.path.join(output_dir, 'point_stat_MPR.stat')
+    write_mpr(paths['mpr'], sta, valids, seed=seed)
+    paths['cnt'] = os.path.join(output_dir, 'point_stat_CNT.stat')
+    write_cnt(paths['cnt'], paths['mpr'])
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write synthetic wrfout, MADIS, MPR and CNT inputs for the benchmarks')
+    parser.add_argument('output_dir', help='Directory of the inputs')
+    parser.add_argument('--grid', type=int, default=200, help='wrfout grid points along each side (default: 200)')
+    parser.add_argument('--stations', type=int, default=1000, help='MADIS stations (default: 1000)')
+    parser.add_argument('--hours', type=int, default=1, help='Valid times (default: 1)')
+    parser.add_argument('--start', default=DEFAULT_START.strftime('%Y%m%d%H'), help='First valid time, YYYYMMDDHH')
+    parser.add_argument('--raster', type=int, default=None, help='Also write a GeoTIFF of this many columns')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (default: 0)')
+    args = parser.parse_args()
+
+    paths = write_inputs(args.output_dir, args.grid, args.stations, args.hours,
+                         datetime.strptime(args.start, '%Y%m%d%H'), seed=args.seed)
+    if args.raster:
+        grid = raster_grid(args.raster)
+        paths['raster'] = os.path.join(args.output_dir, f"raster_{args.raster}.tif")
+        write_raster(paths['raster'], grid, raster_values(grid, seed=args.seed)[0])
+
+    for kind, files in paths.items():
+        for f in files if isinstance(files, list) else [files]:
+            print(f"{kind}: {f}")
+
+
+if __name__ == "__main__":
+    main()